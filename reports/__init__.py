@@ -7,25 +7,64 @@
 
 import json
 
+import transaction
+from ZODB.POSException import ConflictError
 from Products.CMFPlone.utils import _createObjectByType
 from bika.lims import bikaMessageFactory as _
+from bika.lims import api
 from bika.lims.utils import isAttributeHidden
 from bika.lims.browser import BrowserView
 from bika.lims.browser.bika_listing import BikaListingView
+from bika.lims.browser.reports.admission import get_admission
+from bika.lims.browser.reports.aggregates import get_aggregates
+from bika.lims.browser.reports.cache import CachedReport
+from bika.lims.browser.reports.cancel import ReportCancelled
+from bika.lims.browser.reports.cancel import TIMEOUT
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.cancel import get_token
+from bika.lims.browser.reports.cache import cache_key
+from bika.lims.browser.reports.cache import get_cache
+from bika.lims.browser.reports.cache import criteria_key
+from bika.lims.browser.reports.config import REPORT_ADMISSION_TIMEOUT
+from bika.lims.browser.reports.config import REPORT_BUDGET
+from bika.lims.browser.reports.config import REPORT_PDF_CHUNK_ROWS
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.coalesce import get_coalescer
+from bika.lims.browser.reports.jobs import QUEUED
+from bika.lims.browser.reports.jobs import RUNNING
+from bika.lims.browser.reports.jobs import ReportJob
+from bika.lims.browser.reports.jobs import freeze_form
+from bika.lims.browser.reports.jobs import get_queue
+from bika.lims.browser.reports.jobs import job_environ
+from bika.lims.browser.reports.pdf import PdfTimeout
+from bika.lims.browser.reports.pdf import get_renderer
+from bika.lims.browser.reports.profiling import RunProfile
+from bika.lims.browser.reports.profiling import get_stored_profile
+from bika.lims.browser.reports.profiling import store_profile
+from bika.lims.browser.reports.registry import COST_NORMAL
+from bika.lims.browser.reports.registry import get_registry
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
-from bika.lims.utils import createPdf
+from bika.lims.browser.reports.snapshot import get_snapshot_store
+from bika.lims.browser.reports.storage import get_artifact
+from bika.lims.browser.reports.storage import get_file_size
+from bika.lims.browser.reports.storage import get_report_data
+from bika.lims.browser.reports.storage import get_store
+from bika.lims.browser.reports.storage import new_report_id
+from bika.lims.browser.reports.storage import set_artifact
+from bika.lims.browser.reports.timing import count_rows
+from bika.lims.browser.reports.timing import finish_stats
+from bika.lims.browser.reports.timing import get_history
+from bika.lims.browser.reports.timing import get_stats
+from bika.lims.browser.reports.timing import start_stats
+from bika.lims.browser.reports.timing import store_stats
 from bika.lims.utils import getUsers, logged_in_client
 from bika.lims.utils import to_unicode as _u
 from bika.lims.utils import to_utf8 as _c
-from bika.lims.interfaces import IProductivityReport
-from bika.lims.interfaces import IQualityControlReport
-from bika.lims.interfaces import IAdministrationReport
 from bika.lims.catalog.report_catalog import CATALOG_REPORT_LISTING
 from DateTime import DateTime
 from plone.app.layout.globals.interfaces import IViewView
 from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
-from zope.component import getAdapters
 from zope.interface import implements
 import os
 import plone
@@ -48,12 +87,8 @@ class ProductivityView(BrowserView):
         self.getAnalysts = getUsers(self.context,
                                     ['Manager', 'LabManager', 'Analyst'])
 
-        self.additional_reports = []
-        adapters = getAdapters((self.context, ), IProductivityReport)
-        for name, adapter in adapters:
-            report_dict = adapter(self.context, self.request)
-            report_dict['id'] = name
-            self.additional_reports.append(report_dict)
+        self.additional_reports = get_registry().additional_reports(
+            'productivity', self.context, self.request)
 
         return self.template()
 
@@ -73,12 +108,8 @@ class QualityControlView(BrowserView):
         self.selection_macros = SelectionMacrosView(self.context, self.request)
         self.icon = self.portal_url + "/++resource++bika.lims.images/report_big.png"
 
-        self.additional_reports = []
-        adapters = getAdapters((self.context, ), IQualityControlReport)
-        for name, adapter in adapters:
-            report_dict = adapter(self.context, self.request)
-            report_dict['id'] = name
-            self.additional_reports.append(report_dict)
+        self.additional_reports = get_registry().additional_reports(
+            'qualitycontrol', self.context, self.request)
 
         return self.template()
 
@@ -101,12 +132,8 @@ class AdministrationView(BrowserView):
         self.selection_macros = SelectionMacrosView(self.context, self.request)
         self.icon = self.portal_url + "/++resource++bika.lims.images/report_big.png"
 
-        self.additional_reports = []
-        adapters = getAdapters((self.context, ), IAdministrationReport)
-        for name, adapter in adapters:
-            report_dict = adapter(self.context, self.request)
-            report_dict['id'] = name
-            self.additional_reports.append(report_dict)
+        self.additional_reports = get_registry().additional_reports(
+            'administration', self.context, self.request)
 
         return self.template()
 
@@ -179,6 +206,16 @@ class ReportHistoryView(BikaListingView):
                 'attr': 'getClientTitle',
                 'replace_url': 'getClientURL', }
 
+        # Reports still being generated in the background are not listed
+        user = api.get_current_user()
+        userid = user.getId()
+        if 'Manager' in user.getRoles():
+            userid = None
+        if get_queue().get_jobs(userid):
+            self.context_actions[_('Report jobs')] = {
+                'url': 'report_jobs',
+                'icon': '++resource++bika.lims.images/report.png'}
+
         return super(ReportHistoryView, self).__call__()
 
     def lookupMime(self, name):
@@ -194,14 +231,24 @@ class ReportHistoryView(BikaListingView):
         # https://github.com/collective/uwosh.pfg.d2c/issues/20
         # https://github.com/collective/uwosh.pfg.d2c/pull/21
         item['replace']['Title'] = \
-             "<a href='%s/ReportFile'>%s</a>" % \
-             (item['url'], item['Title'])
+             "<a href='%s/report_artifact?uid=%s'>%s</a>" % \
+             (self.context.absolute_url(), item['uid'], item['Title'])
         item['replace']['created'] = self.ulocalized_time(item['created'])
+        if not item.get('file_size'):
+            # The files of the artifact store are not in the ReportFile field
+            size = get_file_size(api.get_object(obj))
+            if size is not None:
+                item['file_size'] = size
+                item['replace']['file_size'] = size
         return item
 
     def folderitems(self):
         return BikaListingView.folderitems(self, classic=False)
 
+# How many times the Report object is created again on conflict
+STORE_RETRIES = 5
+
+
 class SubmitForm(BrowserView):
     """ Redirect to specific report
     """
@@ -209,6 +256,11 @@ class SubmitForm(BrowserView):
     frame_template = ViewPageTemplateFile("templates/report_frame.pt")
     # default and errors use this template:
     template = ViewPageTemplateFile("templates/productivity.pt")
+    # status of the job queued for background generation, see enqueue
+    job_template = ViewPageTemplateFile("templates/report_job_status.pt")
+    job = None
+    # RunProfile of the report run, if profiled
+    profile = None
 
     def __init__(self, context, request):
         BrowserView.__init__(self, context, request)
@@ -218,15 +270,7 @@ class SubmitForm(BrowserView):
     def __call__(self):
         """Create and render selected report
         """
-
-        # if there's an error, we return productivity.pt which requires these.
-        self.selection_macros = SelectionMacrosView(self.context, self.request)
-        self.additional_reports = []
-        adapters = getAdapters((self.context, ), IProductivityReport)
-        for name, adapter in adapters:
-            report_dict = adapter(self.context, self.request)
-            report_dict['id'] = name
-            self.additional_reports.append(report_dict)
+        self.setup_form_view()
 
         report_id = self.request.get('report_id', '')
         if not report_id:
@@ -235,6 +279,40 @@ class SubmitForm(BrowserView):
             self.context.plone_utils.addPortalMessage(message, 'error')
             return self.template()
 
+        if self.run_in_background():
+            return self.enqueue(report_id)
+
+        output = self.create(report_id)
+
+        # if CSV output is chosen, report returns None
+        if not output:
+            return
+
+        if type(output) in (str, unicode, bytes):
+            return output
+
+        setheader = self.request.RESPONSE.setHeader
+        setheader('Server-Timing', get_stats(self.request).server_timing())
+        setheader('Content-Type', output['content_type'])
+        setheader("Content-Disposition",
+                  "attachment;filename=\"%s\"" % _c(output['filename']))
+        self.request.RESPONSE.write(output['report_data'])
+
+        return
+
+    def setup_form_view(self):
+        """Sets the attributes required by productivity.pt, rendered when
+        the report can not be generated
+        """
+        # if there's an error, we return productivity.pt which requires these.
+        self.selection_macros = SelectionMacrosView(self.context, self.request)
+        self.additional_reports = get_registry().additional_reports(
+            'productivity', self.context, self.request)
+
+    def setup_frame(self):
+        """Sets the reporter, laboratory and client attributes rendered by
+        report_frame.pt
+        """
         self.date = DateTime()
         username = self.context.portal_membership.getAuthenticatedMember().getUserName()
         self.reporter = self.user_fullname(username)
@@ -258,106 +336,663 @@ class SubmitForm(BrowserView):
 
         client = logged_in_client(self.context)
         if client:
-            clientuid = client.UID()
+            self.clientuid = client.UID()
             self.client_title = client.Title()
             self.client_address = client.getPrintAddress()
         else:
-            clientuid = None
+            self.clientuid = None
             self.client_title = None
             self.client_address = None
 
-        # Render form output
+    def get_report_class(self, report_id):
+        """Returns the Report class of the report_id passed in, or None
+        """
+        info = get_registry().get(report_id, self.context, self.request)
+        if info is None:
+            message = "Report %s not found (shouldn't happen)" % report_id
+            self.logger.error(message)
+            self.context.plone_utils.addPortalMessage(message, 'error')
+            return None
 
-        # the report can add file names to this list; they will be deleted
-        # once the PDF has been generated.  temporary plot image files, etc.
-        self.request['to_remove'] = []
+        module = self.request.get("report_module", info.module)
+        if module != info.module:
+            message = "Report module %s is not registered for %s" % (
+                module, report_id)
+            self.logger.error(message)
+            self.context.plone_utils.addPortalMessage(message, 'error')
+            return None
 
-        if "report_module" in self.request:
-            module = self.request["report_module"]
-        else:
-            module = "bika.lims.browser.reports.%s" % report_id
         try:
-            exec ("from %s import Report" % module)
-            # required during error redirect: the report must have a copy of
-            # additional_reports, because it is used as a surrogate view.
-            Report.additional_reports = self.additional_reports
+            Report = info.get_report_class()
         except ImportError:
             message = "Report %s.Report not found (shouldn't happen)" % module
             self.logger.error(message)
             self.context.plone_utils.addPortalMessage(message, 'error')
+            return None
+
+        # required during error redirect: the report must have a copy of
+        # additional_reports, because it is used as a surrogate view.
+        Report.additional_reports = self.additional_reports
+        return Report
+
+    def render(self, report_id):
+        """Runs the report and returns the file to be stored, as a dict with
+        report_title, report_data, content_type and filename. Returns None
+        when there is nothing to store (CSV output is written directly to
+        the response by the report) or the rendered template when the report
+        could not be generated
+        """
+        Report = self.get_report_class(report_id)
+        if Report is None:
             return self.template()
 
+        self.setup_frame()
+
+        # Render form output
+
+        # the report can add file names to this list; they will be deleted
+        # once the PDF has been generated.  temporary plot image files, etc.
+        self.request['to_remove'] = []
+
         # Report must return dict with:
         # - report_title - title string for pdf/history listing
         # - report_data - rendered report
-        output = Report(self.context, self.request)()
+        stats = get_stats(self.request)
+        report = Report(self.context, self.request)
+        with stats.stage('report'):
+            if self.profile is not None:
+                with self.profile.profile():
+                    output = report()
+            else:
+                output = report()
+        stats.rows = count_rows(report)
+        check_cancelled(self.request)
 
         # if CSV output is chosen, report returns None
         if not output:
-            return
+            return None
 
         if type(output) in (str, unicode, bytes):
-            # remove temporary files
-            for f in self.request['to_remove']:
-                os.remove(f)
+            self.remove_temporary_files()
             return output
+
         if output.get('is_excel') is not None:
             # It si an excel file
-            self.reportout = output['report_data']
-            # Create new report object
-            reportid = self.aq_parent.generateUniqueId('Report')
-            report = _createObjectByType("Report", self.aq_parent, reportid)
-            report.edit(Client=clientuid)
-            report.processForm()
-
-            # write xmls to report object
-            report.edit(
-                title=output['report_title'], ReportFile=self.reportout)
-            report.reindexObject()
-
             fn = "%s-%s.xlsx" % (self.date.strftime(self.date_format_short),
-                              _u(output['report_title']))
-
-            setheader = self.request.RESPONSE.setHeader
-            setheader('Content-Type', 'application/xlsx')
-            setheader("Content-Disposition",
-                      "attachment;filename=\"%s\"" % _c(fn))
-            self.request.RESPONSE.write(self.reportout)
-
-            return
+                                 _u(output['report_title']))
+            return {'report_title': output['report_title'],
+                    'report_data': output['report_data'],
+                    'content_type': 'application/xlsx',
+                    'filename': fn}
 
         # The report output gets pulled through report_frame.pt
         self.reportout = output['report_data']
-        framed_output = self.frame_template()
+        with stats.stage('frame'):
+            chunks = self.render_chunks(report)
 
         # this is the good part
-        result = createPdf(framed_output)
+        with stats.stage('pdf'):
+            try:
+                result = get_renderer().render_chunks(chunks)
+            except PdfTimeout:
+                self.remove_temporary_files()
+                message = _("The PDF of the report took too long to render. "
+                            "Please narrow down the criteria")
+                self.context.plone_utils.addPortalMessage(message, 'error')
+                return self.template()
+
+        self.remove_temporary_files()
+
+        if not result:
+            return None
+
+        fn = "%s - %s" % (self.date.strftime(self.date_format_short),
+                          _u(output['report_title']))
+        return {'report_title': output['report_title'],
+                'report_data': result,
+                'content_type': 'application/pdf',
+                'filename': fn}
+
+    def render_chunks(self, report):
+        """Returns the html chunks to be converted to PDF. Reports rendered
+        with report_out.pt are split in chunks of rows if the PDF renderer
+        can convert them in parallel. Only the first chunk is framed and has
+        the header and parameters, the footer goes in the last one
+        """
+        chunk_rows = get_setting(REPORT_PDF_CHUNK_ROWS, 500, int)
+        if chunk_rows <= 0 or not get_renderer().can_render_chunks():
+            return [self.frame_template()]
+
+        template = getattr(report, 'template', None)
+        filename = getattr(template, 'filename', '') or ''
+        if not filename.endswith('report_out.pt'):
+            return [self.frame_template()]
+
+        content = getattr(report, 'report_content', None) or {}
+        datalines = content.get('datalines', [])
+        if len(datalines) <= chunk_rows:
+            return [self.frame_template()]
+
+        chunks = []
+        try:
+            for start in range(0, len(datalines), chunk_rows):
+                end = start + chunk_rows
+                chunk_content = dict(content)
+                chunk_content['datalines'] = datalines[start:end]
+                if start > 0:
+                    chunk_content['headings'] = {}
+                    chunk_content['parms'] = []
+                if end < len(datalines):
+                    chunk_content['footings'] = []
+                    chunk_content['footnotes'] = []
+                report.report_content = chunk_content
+                self.reportout = report.template()
+                if start > 0:
+                    chunks.append(self.reportout)
+                else:
+                    chunks.append(self.frame_template())
+        finally:
+            report.report_content = content
+        return chunks
 
-        # remove temporary files
-        for f in self.request['to_remove']:
+    def remove_temporary_files(self):
+        """Removes the temporary files created by the report
+        """
+        for f in self.request.get('to_remove', []):
             os.remove(f)
+        self.request['to_remove'] = []
 
-        if result:
-            # Create new report object
-            reportid = self.aq_parent.generateUniqueId('Report')
-            report = _createObjectByType("Report", self.aq_parent, reportid)
-            report.edit(Client=clientuid)
+    def store(self, output):
+        """Writes the file rendered by the report to the artifact store and
+        creates a new Report object in the reports folder that points to it.
+        The Report object is committed right away, with the stats and the
+        profile of the run. On conflict, only the Report object is created
+        again, the report is not run twice
+        """
+        digest = get_store().put(output['report_data'])
+        stats = get_stats(self.request)
+        for attempt in range(STORE_RETRIES):
+            report = _createObjectByType("Report", self.context,
+                                         new_report_id())
+            report.edit(Client=self.clientuid)
             report.processForm()
-
-            # write pdf to report object
-            report.edit(title=output['report_title'], ReportFile=result)
+            report.edit(title=output['report_title'])
+            set_artifact(report, digest, len(output['report_data']),
+                         output['content_type'], output['filename'])
             report.reindexObject()
 
-            fn = "%s - %s" % (self.date.strftime(self.date_format_short),
-                              _u(output['report_title']))
+            stats.finish()
+            store_stats(report, stats)
+            if self.profile is not None:
+                store_profile(report, self.profile)
+            try:
+                transaction.commit()
+                return report
+            except ConflictError:
+                transaction.abort()
+                self.logger.warn("Conflict while storing the report "
+                                 "(attempt %s)" % (attempt + 1))
+        raise ConflictError("Could not store the report")
+
+    def create(self, report_id):
+        """Returns the output of the report, as returned by render, with the
+        Report object it is stored in. Reports generated before with the
+        same criteria are served from the report cache, and concurrent
+        requests with the same criteria share the same run
+        """
+        stats = start_stats(self.request, report_id)
+        get_token(self.request)
+        try:
+            return self.run(report_id, stats)
+        except ReportCancelled as e:
+            stats.cancelled = e.reason
+            self.remove_temporary_files()
+            return self.cancelled(report_id, e.reason)
+        finally:
+            finish_stats(stats)
+
+    def run(self, report_id, stats):
+        """Runs the report, or takes its output from the cache or from a
+        concurrent run, recording the timings of each stage in stats
+        """
+        self.profile = self.get_profile()
+        if self.profile is not None:
+            # The profile has to be taken from an actual run of the report
+            return self.run_report(report_id, stats)
+        if self.request.get('output_format', '') == 'CSV':
+            # CSV is written to the response, there is no Report object to
+            # cache nor to share with concurrent requests
+            return self.run_report(report_id, stats)
+
+        criteria = criteria_key(report_id, self.selection_macros,
+                                self.request, self.get_client_uid())
+        with stats.stage('cache'):
+            output = self.from_cache(criteria)
+        if output:
+            stats.cached = True
+            return output
 
-            setheader = self.request.RESPONSE.setHeader
-            setheader('Content-Type', 'application/pdf')
-            setheader("Content-Disposition",
-                      "attachment;filename=\"%s\"" % _c(fn))
-            self.request.RESPONSE.write(result)
+        with get_coalescer().flight(criteria) as flight:
+            if not flight.leader:
+                # The report was generated by a concurrent request. Sync the
+                # connection, so the Report object it stored is visible
+                with stats.stage('wait'):
+                    self.context._p_jar.sync()
+                    output = flight.result and flight.result.get_output()
+                if output:
+                    self.logger.info("Report %s shared with a concurrent "
+                                     "request" % report_id)
+                    stats.cached = True
+                    return output
+
+            output = self.run_report(report_id, stats)
+            if not output or type(output) in (str, unicode, bytes):
+                return output
+
+            entry = CachedReport.from_output(output)
+            get_cache().set(cache_key(criteria, self.context), entry)
+
+            # The Report object is committed by store, so it is visible to
+            # the requests waiting for this run
+            flight.publish(entry)
+        return output
+
+    def run_report(self, report_id, stats):
+        """Renders the report and stores it in a new Report object, together
+        with the stats and the profile of the run. The run has to be
+        admitted by the admission control first
+        """
+        with stats.stage('admission'):
+            ticket = self.admit(report_id)
+        if ticket is None:
+            return self.reject(report_id)
+        get_token(self.request).set_budget(self.get_budget(report_id))
+        try:
+            output = self.render(report_id)
+        finally:
+            get_admission().release(ticket)
+        if not output or type(output) in (str, unicode, bytes):
+            return output
 
-        return
+        with stats.stage('store'):
+            output['report'] = self.store(output)
+        if self.profile is not None:
+            self.logger.info("Profile of report %s: %s/report_profile?uid=%s"
+                             % (report_id, self.context.absolute_url(),
+                                api.get_uid(output['report'])))
+        return output
+
+    def admit(self, report_id):
+        """Returns the admission Ticket of the report run, or None if too
+        many reports are running. Background jobs wait for their turn
+        """
+        info = get_registry().get(report_id, self.context, self.request)
+        cost = info and info.cost or COST_NORMAL
+        timeout = 0
+        if self.request.get('report_job', None):
+            timeout = get_setting(REPORT_ADMISSION_TIMEOUT, 600, int)
+        userid = api.get_current_user().getId()
+        return get_admission().admit(userid, report_id, cost, timeout)
+
+    def get_budget(self, report_id):
+        """Returns the seconds the report can run before it is aborted, or 0
+        """
+        info = get_registry().get(report_id, self.context, self.request)
+        if info is not None and info.budget is not None:
+            return info.budget
+        return get_setting(REPORT_BUDGET, 0, int)
+
+    def cancelled(self, report_id, reason):
+        """Handles a report run aborted because it was cancelled or it
+        exceeded its budget
+        """
+        self.logger.warn("Report %s aborted (%s)" % (report_id, reason))
+        if reason == TIMEOUT:
+            message = _("The report took too long and has been aborted. "
+                        "Please narrow down the criteria")
+        else:
+            message = _("The report has been cancelled")
+        self.context.plone_utils.addPortalMessage(message, 'warning')
+        return self.template()
+
+    def reject(self, report_id):
+        """Handles a report run not admitted. Interactive requests are
+        queued for background generation when possible
+        """
+        if self.request.get('report_job', None):
+            message = _("Too many reports running, please try again later")
+            self.context.plone_utils.addPortalMessage(message, 'error')
+            return None
+        if self.request.get('output_format', '') != 'CSV':
+            return self.enqueue(report_id)
+        message = _("Too many reports running, please try again later")
+        self.context.plone_utils.addPortalMessage(message, 'warning')
+        return self.template()
+
+    def get_profile(self):
+        """Returns a RunProfile if the current user is a Manager and asked
+        for the run to be profiled, None otherwise
+        """
+        if not self.request.form.get('profile', False):
+            return None
+        if 'Manager' not in api.get_current_user().getRoles():
+            self.logger.warn("Report profile requested by a non Manager")
+            return None
+        trace_memory = self.request.form.get('profile_memory', False)
+        return RunProfile(trace_memory=bool(trace_memory))
+
+    def from_cache(self, criteria):
+        """Returns the output of the report stored for the same criteria,
+        if none of the catalogs changed since then
+        """
+        key = cache_key(criteria, self.context)
+        entry = get_cache().get(key)
+        if entry is None:
+            return None
+        output = entry.get_output()
+        if not output:
+            get_cache().remove(key)
+            return None
+        self.logger.info("Report %s served from cache" % criteria[0])
+        return output
+
+    def get_client_uid(self):
+        """Returns the UID of the client the current user belongs to
+        """
+        client = logged_in_client(self.context)
+        return client and client.UID() or None
+
+    def generate(self):
+        """Generates the requested report and stores it in the reports folder
+        without writing it to the response. Used by the report job workers.
+        Returns the Report object created, or None
+        """
+        self.setup_form_view()
+        report_id = self.request.get('report_id', '')
+        if not report_id:
+            return None
+        output = self.create(report_id)
+        if not output or type(output) in (str, unicode, bytes):
+            return None
+        return output['report']
+
+    def run_in_background(self):
+        """Returns whether the report has to be queued for generation in the
+        background. CSV output is written directly to the response, so it
+        is always generated within the request
+        """
+        if not self.request.form.get('run_in_background', False):
+            return False
+        return self.request.get('output_format', '') != 'CSV'
+
+    def enqueue(self, report_id):
+        """Queues the report for generation by the report workers
+        """
+        portal = api.get_portal()
+        job = ReportJob(report_id,
+                        freeze_form(self.request.form),
+                        api.get_current_user().getId(),
+                        "/".join(portal.getPhysicalPath()),
+                        "/".join(self.context.getPhysicalPath()),
+                        job_environ(self.request))
+        queue = get_queue()
+        queue.enqueue(job)
+        position = queue.position(job.id)
+
+        status = job.to_dict()
+        status['position'] = position
+        status['status_url'] = "%s/reportjob_status?job_id=%s" % (
+            self.context.absolute_url(), job.id)
+        status['cancel_url'] = "%s/reportjob_cancel?job_id=%s" % (
+            self.context.absolute_url(), job.id)
+        if self.request.get('HTTP_X_REQUESTED_WITH', '') == 'XMLHttpRequest':
+            self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+            return json.dumps(status)
+
+        message = _("The report has been queued at position ${position}. It "
+                    "will be listed in the reports history once generated",
+                    mapping={"position": position})
+        self.context.plone_utils.addPortalMessage(message, 'info')
+        # The form shows the status of the job until the report is ready
+        self.job = status
+        return self.template()
+
+
+class ReportArtifactView(BrowserView):
+    """ Downloads the file of a Report object of the reports folder
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        uid = self.request.form.get('uid', '')
+        report = api.get_object_by_uid(uid, default=None)
+        mtool = getToolByName(self.context, 'portal_membership')
+        if report is None or api.get_parent(report) != self.context or \
+                not mtool.checkPermission('View', report):
+            self.request.RESPONSE.setStatus(404)
+            return "Report %s not found" % uid
+
+        artifact = get_artifact(report)
+        if artifact is None:
+            # Reports stored in the ZODB before the artifact store
+            return self.request.RESPONSE.redirect(
+                "%s/ReportFile" % report.absolute_url())
+
+        data = get_report_data(report)
+        if data is None:
+            self.request.RESPONSE.setStatus(404)
+            return "The file of report %s does not exist" % uid
+
+        setheader = self.request.RESPONSE.setHeader
+        setheader('Content-Type', artifact['content_type'])
+        setheader('Content-Length', len(data))
+        setheader("Content-Disposition",
+                  "attachment;filename=\"%s\"" % _c(artifact['filename']))
+        return data
+
+
+def get_user_job(job_id):
+    """Returns the report job with the id passed in if the current user
+    submitted it or is a Manager, or None
+    """
+    job = get_queue().get(job_id)
+    user = api.get_current_user()
+    if not job or (job.userid != user.getId() and
+                   'Manager' not in user.getRoles()):
+        return None
+    return job
+
+
+class ReportJobStatusView(BrowserView):
+    """ Status of a report queued for background generation, as json
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        job_id = self.request.form.get('job_id', '')
+        job = get_user_job(job_id)
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        if not job:
+            return json.dumps({'id': job_id, 'status': 'unknown'})
+        status = job.to_dict()
+        status['position'] = get_queue().position(job_id)
+        return json.dumps(status)
+
+
+class ReportJobCancelView(BrowserView):
+    """ Cancels a queued or running report job. Returns the job status as
+    json to ajax requests, and redirects to the report jobs otherwise
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        plone.protect.CheckAuthenticator(self.request)
+        job_id = self.request.form.get('job_id', '')
+        job = get_user_job(job_id)
+        if job:
+            get_queue().cancel(job_id)
+
+        if self.request.get('HTTP_X_REQUESTED_WITH', '') != 'XMLHttpRequest':
+            if not job:
+                message = _("The report job was not found")
+                self.context.plone_utils.addPortalMessage(message, 'error')
+            else:
+                message = _("The report job has been cancelled")
+                self.context.plone_utils.addPortalMessage(message, 'info')
+            return self.request.RESPONSE.redirect(
+                "%s/report_jobs" % self.context.absolute_url())
+
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        if not job:
+            return json.dumps({'id': job_id, 'status': 'unknown'})
+        return json.dumps(job.to_dict())
+
+
+class ReportJobsView(BrowserView):
+    """ Reports queued for background generation by the current user, or
+    by all users for Managers, with the button to cancel the queued and
+    running ones
+    """
+    template = ViewPageTemplateFile("templates/report_jobs.pt")
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        user = api.get_current_user()
+        userid = user.getId()
+        if 'Manager' in user.getRoles():
+            userid = None
+        queue = get_queue()
+        self.jobs = []
+        for job in queue.get_jobs(userid):
+            item = job.to_dict()
+            item['userid'] = job.userid
+            item['created'] = self.ulocalized_time(job.created,
+                                                   long_format=1)
+            item['position'] = queue.position(job.id)
+            item['cancellable'] = job.status in (QUEUED, RUNNING)
+            self.jobs.append(item)
+        self.title = _("Report jobs")
+        self.description = _("Reports generated in the background by this "
+                             "instance. Queued and running reports can be "
+                             "cancelled")
+        return self.template()
+
+
+class ReportRunStatsView(BrowserView):
+    """ Reports ranked by the p50/p95 duration of their latest runs in this
+    Zope instance. Returns json with format=json
+    """
+    template = ViewPageTemplateFile("templates/reports_stats.pt")
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        self.ranking = get_history().ranking()
+        if self.request.form.get('format', '') == 'json':
+            self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+            return json.dumps(self.ranking)
+        self.title = _("Report run times")
+        self.description = _("Duration of the latest runs of each report in "
+                             "this instance, in seconds. Reports served "
+                             "from the cache are not counted")
+        return self.template()
+
+    def format_stages(self, stages):
+        return ", ".join(["%s: %.2f" % (name, seconds) for name, seconds
+                          in stages.items()])
+
+
+class ReportProfileView(BrowserView):
+    """ Downloads the profile of a report run, stored with the Report object.
+    file=pstats returns the pstats dump, otherwise the summary and the top
+    allocation sites are returned as text
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        uid = self.request.form.get('uid', '')
+        report = api.get_object_by_uid(uid, default=None)
+        profile = report and get_stored_profile(report) or None
+        if not profile:
+            self.request.RESPONSE.setStatus(404)
+            return "No profile found for report %s" % uid
+
+        setheader = self.request.RESPONSE.setHeader
+        if self.request.form.get('file', '') == 'pstats':
+            setheader('Content-Type', 'application/octet-stream')
+            setheader('Content-Disposition',
+                      'attachment;filename="%s.pstats"' % report.getId())
+            return profile['pstats']
+
+        setheader('Content-Type', 'text/plain')
+        text = profile['summary']
+        if profile['allocations']:
+            text = "%s\n\nTop allocation sites:\n\n%s" % (
+                text, profile['allocations'])
+        return text
+
+
+class ReportAggregatesRebuildView(BrowserView):
+    """ Counts all the analyses in the daily aggregates the productivity
+    reports are answered from, and enables them. Returns json
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        plone.protect.CheckAuthenticator(self.request)
+        store = get_aggregates()
+        num = store.rebuild(self.request)
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps({'analyses': num, 'built': str(store.built)})
+
+
+class ReportSnapshotRefreshView(BrowserView):
+    """ Updates the columnar snapshot of the analyses the statistics reports
+    are read from, or rebuilds it with full=1. Returns json
+    """
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self.context = context
+        self.request = request
+
+    def __call__(self):
+        plone.protect.CheckAuthenticator(self.request)
+        full = bool(self.request.form.get('full', False))
+        store = get_snapshot_store()
+        num = store.refresh(self.request, full=full)
+        state = store.read_state() or {}
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps({'analyses': num,
+                           'rows': state.get('rows', 0),
+                           'refreshed': state.get('refreshed', None)})
 
 
 class ReferenceAnalysisQC_Samples(BrowserView):
@@ -9,6 +9,10 @@ from bika.lims.workflow import getTransitionDate
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -16,6 +20,18 @@ from bika.lims.utils import formatDateQuery, formatDateParms
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the Analysis Request brains
+COLUMNS = (
+    Column("ClientTitle", metadata="getClientTitle",
+           accessor=lambda ar: ar.aq_parent.Title()),
+    Column("getId"),
+    Column("getSampleTypeTitle"),
+    Column("getSamplePointTitle"),
+    Column("DatePublished", metadata="getDatePublished",
+           accessor=lambda ar: getTransitionDate(ar, 'publish')),
+    Column("getTotalPrice"),
+)
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -85,34 +101,41 @@ class Report(BrowserView):
         categories = {}
         services = {}
 
-        for ar_proxy in bc(query):
-            ar = ar_proxy.getObject()
+        with stage(self.request, 'query'):
+            brains = bc(query)
+
+        with stage(self.request, 'rows'):
+            extractor = RowExtractor(self.request, COLUMNS)
+            for ar_proxy in brains:
+                check_cancelled(self.request)
+                ar = extractor.extract(ar_proxy)
 
-            dataline = []
+                dataline = []
 
-            dataitem = {'value': ar.aq_parent.Title()}
-            dataline.append(dataitem)
+                dataitem = {'value': ar['ClientTitle']}
+                dataline.append(dataitem)
 
-            dataitem = {'value': ar.getId()}
-            dataline.append(dataitem)
+                dataitem = {'value': ar['getId']}
+                dataline.append(dataitem)
 
-            dataitem = {'value': ar.getSampleTypeTitle()}
-            dataline.append(dataitem)
+                dataitem = {'value': ar['getSampleTypeTitle']}
+                dataline.append(dataitem)
 
-            dataitem = {'value': ar.getSamplePointTitle()}
-            dataline.append(dataitem)
+                dataitem = {'value': ar['getSamplePointTitle']}
+                dataline.append(dataitem)
 
-            dataitem = {'value':
-                        self.ulocalized_time(getTransitionDate(ar, 'publish'),
-                                             long_format=True)}
-            dataline.append(dataitem)
+                dataitem = {'value':
+                            self.ulocalized_time(ar['DatePublished'],
+                                                 long_format=True)}
+                dataline.append(dataitem)
 
-            dataitem = {'value': ar.getTotalPrice()}
-            dataline.append(dataitem)
+                dataitem = {'value': ar['getTotalPrice']}
+                dataline.append(dataitem)
 
-            datalines.append(dataline)
+                datalines.append(dataline)
 
-            count_all += 1
+                count_all += 1
+            extractor.finish()
 
         # table footer data
         footlines = []
@@ -10,7 +10,9 @@ from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 from bika.lims.utils import getUsers
@@ -95,7 +97,8 @@ class Report(BrowserView):
                 {'title': _('User'), 'value': ("%s (%s)" % (userfullname, user))})
 
         # Query the catalog and store results in a dictionary
-        entities = self.bika_setup_catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            entities = self.bika_setup_catalog(self.contentFilter)
 
         if not entities:
             message = _("No historical actions matched your query")
@@ -106,65 +109,67 @@ class Report(BrowserView):
         tmpdatalines = {}
         footlines = {}
 
-        for entity in entities:
-            entity = entity.getObject()
-            entitytype = _(entity.__class__.__name__)
-
-            # Workflow states retrieval
-            for workflowid, workflow in entity.workflow_history.iteritems():
-                for action in workflow:
-                    actiontitle = _('Created')
-                    if not action['action'] or (
-                        action['action'] and action['action'] == 'create'):
-                        if workflowid == 'bika_inactive_workflow':
-                            continue
+        with stage(self.request, 'rows'):
+            for entity in entities:
+                check_cancelled(self.request)
+                entity = entity.getObject()
+                entitytype = _(entity.__class__.__name__)
+
+                # Workflow states retrieval
+                for workflowid, workflow in entity.workflow_history.iteritems():
+                    for action in workflow:
                         actiontitle = _('Created')
-                    else:
-                        actiontitle = _(action['action'])
-
-                    if (user == '' or action['actor'] == user):
-                        actorfullname = userfullname == '' and mt.getMemberById(
-                            user) or userfullname
-                        dataline = {'EntityNameOrId': entity.title_or_id(),
-                                    'EntityAbsoluteUrl': entity.absolute_url(),
-                                    'EntityCreationDate': entity.CreationDate(),
-                                    'EntityModificationDate': entity.ModificationDate(),
-                                    'EntityType': entitytype,
-                                    'Workflow': _(workflowid),
-                                    'Action': actiontitle,
-                                    'ActionDate': action['time'],
-                                    'ActionDateStr': self.ulocalized_time(
-                                        action['time'], 1),
-                                    'ActionActor': action['actor'],
-                                    'ActionActorFullName': actorfullname,
-                                    'ActionComments': action['comments']
-                        }
-                        tmpdatalines[action['time']] = dataline
-
-            # History versioning retrieval
-            history = rt.getHistoryMetadata(entity)
-            if history:
-                hislen = history.getLength(countPurged=False)
-                for index in range(hislen):
-                    meta = history.retrieve(index)['metadata']['sys_metadata']
-                    metatitle = _(meta['comment'])
-                    if (user == '' or meta['principal'] == user):
-                        actorfullname = userfullname == '' and \
-                            mt.getMemberById(user) or userfullname
-                        dataline = {'EntityNameOrId': entity.title_or_id(),
-                                    'EntityAbsoluteUrl': entity.absolute_url(),
-                                    'EntityCreationDate': entity.CreationDate(),
-                                    'EntityModificationDate': entity.ModificationDate(),
-                                    'EntityType': entitytype,
-                                    'Workflow': '',
-                                    'Action': metatitle,
-                                    'ActionDate': meta['timestamp'],
-                                    'ActionDateStr': meta['timestamp'],
-                                    'ActionActor': meta['principal'],
-                                    'ActionActorFullName': actorfullname,
-                                    'ActionComments': ''
-                        }
-                        tmpdatalines[meta['timestamp']] = dataline
+                        if not action['action'] or (
+                            action['action'] and action['action'] == 'create'):
+                            if workflowid == 'bika_inactive_workflow':
+                                continue
+                            actiontitle = _('Created')
+                        else:
+                            actiontitle = _(action['action'])
+
+                        if (user == '' or action['actor'] == user):
+                            actorfullname = userfullname == '' and mt.getMemberById(
+                                user) or userfullname
+                            dataline = {'EntityNameOrId': entity.title_or_id(),
+                                        'EntityAbsoluteUrl': entity.absolute_url(),
+                                        'EntityCreationDate': entity.CreationDate(),
+                                        'EntityModificationDate': entity.ModificationDate(),
+                                        'EntityType': entitytype,
+                                        'Workflow': _(workflowid),
+                                        'Action': actiontitle,
+                                        'ActionDate': action['time'],
+                                        'ActionDateStr': self.ulocalized_time(
+                                            action['time'], 1),
+                                        'ActionActor': action['actor'],
+                                        'ActionActorFullName': actorfullname,
+                                        'ActionComments': action['comments']
+                            }
+                            tmpdatalines[action['time']] = dataline
+
+                # History versioning retrieval
+                history = rt.getHistoryMetadata(entity)
+                if history:
+                    hislen = history.getLength(countPurged=False)
+                    for index in range(hislen):
+                        meta = history.retrieve(index)['metadata']['sys_metadata']
+                        metatitle = _(meta['comment'])
+                        if (user == '' or meta['principal'] == user):
+                            actorfullname = userfullname == '' and \
+                                mt.getMemberById(user) or userfullname
+                            dataline = {'EntityNameOrId': entity.title_or_id(),
+                                        'EntityAbsoluteUrl': entity.absolute_url(),
+                                        'EntityCreationDate': entity.CreationDate(),
+                                        'EntityModificationDate': entity.ModificationDate(),
+                                        'EntityType': entitytype,
+                                        'Workflow': '',
+                                        'Action': metatitle,
+                                        'ActionDate': meta['timestamp'],
+                                        'ActionDateStr': meta['timestamp'],
+                                        'ActionActor': meta['principal'],
+                                        'ActionActorFullName': actorfullname,
+                                        'ActionComments': ''
+                            }
+                            tmpdatalines[meta['timestamp']] = dataline
         if len(tmpdatalines) == 0:
             message = _(
                 "No actions found for user ${user}",
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Admission control of report runs.
+
+Each report declares a cost in the registry. The sum of the costs of the
+reports running in this Zope instance can not exceed BIKA_REPORTS_MAX_COST,
+and the sum of the costs of the reports run by the same user can not
+exceed BIKA_REPORTS_USER_MAX_COST. Interactive requests over the caps are
+not run, SubmitForm queues them for background generation or asks the user
+to try later. Background jobs wait for their turn.
+"""
+
+import threading
+import time
+
+from bika.lims import logger
+from bika.lims.browser.reports.config import REPORT_MAX_COST
+from bika.lims.browser.reports.config import REPORT_USER_MAX_COST
+from bika.lims.browser.reports.config import get_setting
+
+
+class Ticket(object):
+    """Admission of a report run, to be released when the run finishes
+    """
+
+    def __init__(self, userid, report_id, cost):
+        self.userid = userid
+        self.report_id = report_id
+        self.cost = cost
+
+
+class AdmissionController(object):
+    """Keeps track of the cost of the reports running in this instance
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.total = 0
+        self.users = {}
+
+    @property
+    def max_cost(self):
+        return get_setting(REPORT_MAX_COST, 8, int)
+
+    @property
+    def user_max_cost(self):
+        return get_setting(REPORT_USER_MAX_COST, 4, int)
+
+    def fits(self, userid, cost):
+        """Returns whether a run of the cost passed in fits within the caps
+        """
+        if self.total + cost > self.max_cost:
+            return False
+        return self.users.get(userid, 0) + cost <= self.user_max_cost
+
+    def admit(self, userid, report_id, cost, timeout=0):
+        """Returns a Ticket for the report run, or None if the run does not
+        fit within the caps after waiting timeout seconds
+        """
+        # A report more expensive than the caps runs alone
+        cost = max(min(cost, self.max_cost, self.user_max_cost), 1)
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.fits(userid, cost):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.info("Report {} not admitted for {}: {} of {} "
+                                "running".format(report_id, userid,
+                                                 self.total, self.max_cost))
+                    return None
+                self.condition.wait(remaining)
+            self.total += cost
+            self.users[userid] = self.users.get(userid, 0) + cost
+        return Ticket(userid, report_id, cost)
+
+    def release(self, ticket):
+        """Releases the cost of the finished run
+        """
+        with self.condition:
+            self.total -= ticket.cost
+            cost = self.users.get(ticket.userid, 0) - ticket.cost
+            if cost > 0:
+                self.users[ticket.userid] = cost
+            else:
+                self.users.pop(ticket.userid, None)
+            self.condition.notify_all()
+
+
+# The admission controller of this Zope instance
+controller = AdmissionController()
+
+
+def get_admission():
+    """Returns the admission controller of this Zope instance
+    """
+    return controller
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Daily counters of analyses, maintained by workflow events.
+
+The productivity reports that count analyses per service, sample type,
+client or department used to scan every analysis of the date range on each
+run. The AggregateStore keeps the number of analyses per day and per key
+(service, client, sample type, department, review state, cancellation
+state, whether the analysis has a result and whether its Analysis Request
+is published) in the annotations of the portal, so these reports can be
+answered in time proportional to the number of days and groups.
+
+The counters are partitioned by day of creation and by day requested (the
+two date indexes the reports filter by). The store remembers the day and
+key each analysis is counted with, so each workflow transition of an
+analysis (or of its Analysis Request) moves its count to the new key. The
+counters are BTrees.Length objects, so concurrent transactions updating
+the same counter do not conflict.
+
+The store is not used until it is built with the reports_aggregates_rebuild
+view, that counts all the existing analyses from the catalog. From then on
+it is kept up to date by the event subscribers, and report modules ask it
+first:
+
+    counts = count_query(query, 'getServiceUID')
+    if counts is None:
+        # not built, or the query filters by something it does not count
+        counts = count_by(bac, query, 'getServiceUID')
+
+The dates of a query are taken at day granularity.
+
+The counters do not apply the security of the catalog: they count all the
+analyses, whoever asks. They only answer the users that can see all the
+analyses anyway (ALL_ANALYSES_ROLES), the reports of the other users count
+them from the catalog.
+
+The store also counts the changes of the counters of each day, so the
+partial aggregates of a day cached by daycache.py are recomputed when an
+analysis of that day changes.
+"""
+
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from AccessControl import getSecurityManager
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.resolver import ARStates
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+import transaction
+
+# Key of the aggregates in the annotations of the portal
+ANNOTATION_KEY = "bika.lims.reports.aggregates"
+
+# Fields of the key of each counter. The day of creation is part of the key
+# too, so the counters partitioned by day requested can be grouped by it
+FIELDS = ("service", "client", "sampletype", "department", "review_state",
+          "cancellation_state", "performed", "ar_published", "created_day")
+
+# Date indexes of the analysis catalog the counters are partitioned by
+DATE_INDEXES = ("created", "getDateRequested")
+
+# Indexes of the analysis catalog a query can filter by -> field
+INDEX_FIELDS = {
+    "getServiceUID": "service",
+    "getClientUID": "client",
+    "getSampleTypeUID": "sampletype",
+    "getDepartmentUID": "department",
+    "review_state": "review_state",
+    "cancellation_state": "cancellation_state",
+}
+
+# Query keys that do not filter the analyses
+IGNORED_KEYS = ("portal_type", "sort_on", "sort_order")
+
+# Roles that can see all the analyses, the only ones the counters answer to
+ALL_ANALYSES_ROLES = ("Manager", "LabManager")
+
+# Number of analyses counted between savepoints while rebuilding
+SAVEPOINT_EVERY = 1000
+
+
+def to_day(date):
+    """Returns the day of the date passed in as an int (YYYYmmdd), or None
+    """
+    date = api.to_date(date, None)
+    if date is None:
+        return None
+    return int(date.strftime("%Y%m%d"))
+
+
+def from_day(day):
+    """Returns the DateTime of the beginning of the day passed in
+    """
+    return DateTime("%04d-%02d-%02d" % (day // 10000, day // 100 % 100,
+                                        day % 100))
+
+
+def call(obj, name, default=None):
+    """Returns the value of the attribute or method of the object passed in
+    """
+    value = getattr(obj, name, default)
+    if callable(value):
+        value = value()
+    return value
+
+
+def get_state(obj, state_var="review_state"):
+    """Returns the workflow state of the object passed in, or None
+    """
+    wf_tool = api.get_tool("portal_workflow")
+    return wf_tool.getInfoFor(obj, state_var, None)
+
+
+def get_values(analysis):
+    """Returns the values the analysis object passed in is counted by
+    """
+    created = analysis.created()
+    return {
+        "service": call(analysis, "getServiceUID"),
+        "client": call(analysis, "getClientUID"),
+        "sampletype": call(analysis, "getSampleTypeUID"),
+        "department": call(analysis, "getDepartmentUID"),
+        "review_state": get_state(analysis),
+        "cancellation_state": get_state(analysis, "cancellation_state"),
+        "performed": bool(call(analysis, "getResult")),
+        "ar_published": get_state(analysis.aq_parent) == "published",
+        "created": created,
+        "getDateRequested": call(analysis, "getDateRequested") or created,
+    }
+
+
+# Columns of the analysis brains the store is rebuilt from
+COLUMNS = (
+    Column("service", metadata="getServiceUID"),
+    Column("client", metadata="getClientUID"),
+    Column("sampletype", metadata="getSampleTypeUID"),
+    Column("department", metadata="getDepartmentUID"),
+    Column("review_state", accessor=get_state),
+    Column("cancellation_state",
+           accessor=lambda obj: get_state(obj, "cancellation_state")),
+    Column("performed", metadata="getResult", convert=bool,
+           accessor=lambda obj: bool(call(obj, "getResult"))),
+    Column("created"),
+    Column("getDateRequested",
+           accessor=lambda obj: call(obj, "getDateRequested") or obj.created()),
+)
+
+
+def get_entry(values):
+    """Returns the days and the key an analysis with the values passed in is
+    counted with
+    """
+    days = tuple(to_day(values.get(index)) for index in DATE_INDEXES)
+    values = dict(values, created_day=to_day(values.get("created")))
+    key = tuple(values.get(field) for field in FIELDS)
+    return days, key
+
+
+def matches(values, filters):
+    """Returns whether the values of a counter pass the filters (field ->
+    value or list of values)
+    """
+    for field, allowed in filters.items():
+        if isinstance(allowed, (list, tuple, set)):
+            if values[field] not in allowed:
+                return False
+        elif values[field] != allowed:
+            return False
+    return True
+
+
+class AggregateStore(object):
+    """Daily counters of analyses stored in the annotations of the portal
+    """
+
+    def __init__(self, portal):
+        self.portal = portal
+
+    def get_data(self, create=False):
+        annotations = IAnnotations(self.portal)
+        data = annotations.get(ANNOTATION_KEY, None)
+        if data is None and create:
+            data = self.reset()
+        return data
+
+    def reset(self):
+        """Removes all the counters
+        """
+        data = PersistentMapping()
+        for index in DATE_INDEXES:
+            # day -> key -> Length
+            data[index] = IOBTree()
+        # uid -> days and key the analysis is counted with
+        data["entries"] = OOBTree()
+        # date index -> day -> number of changes of the counters of the day
+        data["changes"] = PersistentMapping()
+        for index in DATE_INDEXES:
+            data["changes"][index] = IOBTree()
+        data["built"] = None
+        IAnnotations(self.portal)[ANNOTATION_KEY] = data
+        return data
+
+    @property
+    def built(self):
+        """Returns the date the store was built, or None if it is not
+        """
+        data = self.get_data()
+        return data and data.get("built", None) or None
+
+    def add(self, data, days, key, num):
+        changes = data.get("changes", None)
+        for index, day in zip(DATE_INDEXES, days):
+            if day is None:
+                continue
+            partition = data[index]
+            counters = partition.get(day, None)
+            if counters is None:
+                counters = partition[day] = OOBTree()
+            counter = counters.get(key, None)
+            if counter is None:
+                counter = counters[key] = Length()
+            counter.change(num)
+            if changes is not None:
+                stamp = changes[index].get(day, None)
+                if stamp is None:
+                    stamp = changes[index][day] = Length()
+                stamp.change(1)
+
+    def stamps(self, date_index, day_from, day_to):
+        """Returns a dict of day -> number of changes of the counters of the
+        day, for the days from day_from to day_to. Returns None if the store
+        does not keep them
+        """
+        data = self.get_data()
+        changes = data and data.get("changes", None) or None
+        if changes is None or date_index not in changes:
+            return None
+        return dict((day, stamp()) for day, stamp in
+                    changes[date_index].items(day_from, day_to))
+
+    def update(self, uid, values):
+        """Counts the analysis with the UID passed in with its current values
+        """
+        data = self.get_data(create=True)
+        entry = get_entry(values)
+        old = data["entries"].get(uid, None)
+        if old == entry:
+            return
+        if old is not None:
+            self.add(data, old[0], old[1], -1)
+        self.add(data, entry[0], entry[1], 1)
+        data["entries"][uid] = entry
+
+    def remove(self, uid):
+        """Stops counting the analysis with the UID passed in
+        """
+        data = self.get_data()
+        if data is None:
+            return
+        old = data["entries"].get(uid, None)
+        if old is None:
+            return
+        self.add(data, old[0], old[1], -1)
+        del data["entries"][uid]
+
+    def rebuild(self, request=None):
+        """Counts all the analyses of the analysis catalog from scratch.
+        Returns the number of analyses counted
+        """
+        self.reset()
+        catalog = api.get_tool("bika_analysis_catalog")
+        analyses = catalog(portal_type="Analysis")
+        extractor = RowExtractor(request, COLUMNS)
+        ar_states = ARStates(analyses)
+        num = 0
+        for num, brain in enumerate(analyses, 1):
+            if request is not None:
+                check_cancelled(request)
+            row = extractor.extract(brain)
+            values = dict((name, row[name]) for name in extractor.columns)
+            values["ar_published"] = ar_states.is_published(brain)
+            self.update(api.get_uid(brain), values)
+            if num % SAVEPOINT_EVERY == 0:
+                transaction.savepoint(optimistic=True)
+        if request is not None:
+            extractor.finish()
+        self.get_data()["built"] = DateTime()
+        logger.info("Aggregates of {} analyses rebuilt".format(num))
+        return num
+
+    def counts(self, date_index, date_from, date_to, group_by, filters=None):
+        """Returns a dict of tuple of the values of the group_by fields ->
+        number of analyses, for the analyses of the days from date_from to
+        date_to (both included, None for no limit) that pass the filters.
+        group_by can contain "day" too
+        """
+        data = self.get_data()
+        if data is None:
+            return {}
+        day_from = date_from and to_day(date_from) or None
+        day_to = date_to and to_day(date_to) or None
+        result = {}
+        for day, counters in data[date_index].items(day_from, day_to):
+            for key, counter in counters.items():
+                num = counter()
+                if not num:
+                    continue
+                values = dict(zip(FIELDS, key))
+                values["day"] = day
+                if filters and not matches(values, filters):
+                    continue
+                group = tuple(values[field] for field in group_by)
+                result[group] = result.get(group, 0) + num
+        return result
+
+
+def get_aggregates():
+    """Returns the AggregateStore of the portal
+    """
+    return AggregateStore(api.get_portal())
+
+
+def get_day_stamps(date_index, day_from, day_to):
+    """Returns a dict of day -> number of changes of the analyses of the day
+    (by the date index passed in), or None if the aggregates are not built
+    """
+    store = get_aggregates()
+    if not store.built:
+        return None
+    return store.stamps(date_index, day_from, day_to)
+
+
+def get_date_range(value):
+    """Returns the (from, to) dates of a date query of the catalog, None for
+    no limit. Returns None if the query is not a range
+    """
+    if not isinstance(value, dict):
+        return None
+    dates = value.get("query", None)
+    if not isinstance(dates, (list, tuple)):
+        dates = [dates]
+    range_ = value.get("range", "")
+    if range_ == "min:max" and len(dates) == 2:
+        return dates[0], dates[1]
+    if range_ == "min":
+        return min(dates), None
+    if range_ == "max":
+        return None, max(dates)
+    return None
+
+
+def get_query_filters(query):
+    """Returns the date index, date range and filters of the fields of the
+    aggregates of the catalog query passed in, or None if the aggregates can
+    not answer it (e.g. it filters by two date indexes)
+    """
+    if query.get("portal_type", "Analysis") != "Analysis":
+        return None
+    date_index = None
+    date_range = (None, None)
+    filters = {}
+    for key, value in query.items():
+        if key in IGNORED_KEYS:
+            continue
+        if key in DATE_INDEXES:
+            if date_index is not None:
+                # the counters are kept per day of a single date index
+                return None
+            date_index = key
+            date_range = get_date_range(value)
+            if date_range is None:
+                return None
+        elif key in INDEX_FIELDS:
+            if isinstance(value, dict):
+                if set(value.keys()) != set(["query"]):
+                    return None
+                value = value["query"]
+            filters[INDEX_FIELDS[key]] = value
+        else:
+            return None
+    return date_index or DATE_INDEXES[0], date_range, filters
+
+
+def sees_all_analyses():
+    """Returns whether the current user has one of the roles that can see
+    all the analyses
+    """
+    user = getSecurityManager().getUser()
+    roles = user.getRolesInContext(api.get_portal())
+    return bool(set(roles).intersection(ALL_ANALYSES_ROLES))
+
+
+def count_groups(query, group_by):
+    """Returns a dict of tuple of the values of the group_by fields ->
+    number of analyses the catalog query returns, counted from the
+    aggregates. Returns None if the aggregates are not built or can not
+    answer the query, or if the current user can not see all the analyses
+    """
+    store = get_aggregates()
+    if not store.built or not sees_all_analyses():
+        return None
+    parsed = get_query_filters(query)
+    if parsed is None:
+        return None
+    date_index, (date_from, date_to), filters = parsed
+    return store.counts(date_index, date_from, date_to, group_by, filters)
+
+
+def count_query(query, index):
+    """Returns a dict of value of the index -> number of analyses the query
+    returns with that value, counted from the aggregates. Returns None if
+    the aggregates are not built or can not answer the query, or if the
+    current user can not see all the analyses
+    """
+    counts = count_groups(query, (INDEX_FIELDS[index], ))
+    if counts is None:
+        return None
+    return dict((group[0], num) for group, num in counts.items())
+
+
+def recount(analysis):
+    """Updates the counters of the analysis passed in, if the store is built
+    """
+    if api.get_portal_type(analysis) != "Analysis":
+        return
+    store = get_aggregates()
+    if not store.built:
+        return
+    store.update(api.get_uid(analysis), get_values(analysis))
+
+
+def analysis_transition(analysis, event):
+    """Event handler called after a workflow transition of an analysis
+    """
+    recount(analysis)
+
+
+def analysis_initialized(analysis, event):
+    """Event handler called once an analysis has been created and its fields
+    have been set
+    """
+    recount(analysis)
+
+
+def analysis_removed(analysis, event):
+    """Event handler called when an analysis is deleted
+    """
+    if api.get_portal_type(analysis) != "Analysis":
+        return
+    store = get_aggregates()
+    if store.built:
+        store.remove(api.get_uid(analysis))
+
+
+def analysisrequest_transition(ar, event):
+    """Event handler called after a workflow transition of an Analysis
+    Request. Its analyses are counted by whether it is published
+    """
+    store = get_aggregates()
+    if not store.built:
+        return
+    for analysis in ar.objectValues("Analysis"):
+        recount(analysis)
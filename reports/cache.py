@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Cache of generated reports.
+
+Generating the same report twice with the same criteria returns the same
+file, as long as nothing has been indexed in the catalogs in the meantime.
+The cache maps the normalized report request to the Report object that was
+stored the first time, so the file can be served again without querying the
+catalogs nor rendering the PDF.
+
+The file names the user who generated it (reporter, signature), so it is
+only served again to that user.
+
+The cache is kept in memory, it is size bounded and evicts the least
+recently used entries first.
+"""
+
+import threading
+from collections import OrderedDict
+
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.config import REPORT_CACHE_SIZE
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.storage import get_report_data
+from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
+from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
+
+# Catalogs queried by the reports. A report is only served from the cache if
+# none of them changed since it was generated
+REPORT_CATALOGS = (
+    "portal_catalog",
+    "bika_catalog",
+    "bika_analysis_catalog",
+    "bika_setup_catalog",
+    CATALOG_ANALYSIS_LISTING,
+    CATALOG_ANALYSIS_REQUEST_LISTING,
+    "bikahealth_catalog_patient_listing",
+)
+
+# Form keys that do not change the output of the report
+IGNORED_FORM_KEYS = ("_authenticator", "submit", "run_in_background",
+                     "report_module", "profile", "profile_memory")
+
+# Form keys replaced by the contentFilter of the SelectionMacrosView parser
+PARSED_FORM_KEYS = {
+    "ClientUID": "parse_client",
+    "SampleTypeUID": "parse_sampletype",
+    "SamplePointUID": "parse_samplepoint",
+    "ServiceUID": "parse_analysisservice",
+}
+
+
+class CachedReport(object):
+    """A report stored in the reports folder that can be served again
+    """
+
+    def __init__(self, uid, report_title, content_type, filename):
+        self.uid = uid
+        self.report_title = report_title
+        self.content_type = content_type
+        self.filename = filename
+
+    @classmethod
+    def from_output(cls, output):
+        """Returns the CachedReport of the output returned by SubmitForm.create
+        """
+        return cls(api.get_uid(output["report"]), output["report_title"],
+                   output["content_type"], output["filename"])
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["uid"], data["report_title"], data["content_type"],
+                   data["filename"])
+
+    def to_dict(self):
+        return {"uid": self.uid,
+                "report_title": self.report_title,
+                "content_type": self.content_type,
+                "filename": self.filename}
+
+    def get_output(self):
+        """Returns the output of the report as returned by SubmitForm.render
+        or None if the Report object or its file do not exist anymore
+        """
+        report = api.get_object_by_uid(self.uid, default=None)
+        if report is None:
+            return None
+        report_data = get_report_data(report)
+        if not report_data:
+            return None
+        return {"report_title": self.report_title,
+                "report_data": report_data,
+                "content_type": self.content_type,
+                "filename": self.filename,
+                "report": report}
+
+
+class ReportCache(object):
+    """Least recently used cache of generated reports
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return get_setting(REPORT_CACHE_SIZE, 100, int)
+
+    def get(self, key):
+        """Returns the CachedReport for the key passed in or None
+        """
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # move to the most recently used end
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        """Stores the entry and evicts the least recently used ones above
+        the size limit
+        """
+        max_size = self.max_size
+        if key is None or max_size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def normalize_value(value):
+    """Returns a hashable and order independent version of the form value
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted([normalize_value(v) for v in value]))
+    if isinstance(value, dict):
+        return tuple(sorted([(k, normalize_value(v))
+                             for k, v in value.items()]))
+    if isinstance(value, basestring):
+        return value.strip()
+    return value
+
+
+def normalized_form(selection_macros, request):
+    """Returns the request form as a sorted tuple of (key, value). The
+    criteria understood by the SelectionMacrosView are replaced by the
+    contentFilter its parse_* functions return for them
+    """
+    form = dict(request.form)
+    items = []
+
+    for key, parser in PARSED_FORM_KEYS.items():
+        if not form.get(key):
+            continue
+        try:
+            parsed = getattr(selection_macros, parser)(request)
+        except Exception:
+            # Not an existing object, keep the raw value
+            continue
+        if parsed:
+            form.pop(key)
+            items.append(("parsed", normalize_value(parsed["contentFilter"])))
+
+    date_fields = set()
+    for key in form.keys():
+        for suffix in ("_fromdate", "_todate"):
+            if key.endswith(suffix):
+                date_fields.add(key[:-len(suffix)])
+    for field_id in date_fields:
+        parsed = selection_macros.parse_daterange(request, field_id, field_id)
+        form.pop("%s_fromdate" % field_id, None)
+        form.pop("%s_todate" % field_id, None)
+        if parsed:
+            items.append(("parsed", normalize_value(parsed["contentFilter"])))
+
+    for key, value in form.items():
+        if key in IGNORED_FORM_KEYS:
+            continue
+        items.append((key, normalize_value(value)))
+    return tuple(sorted(items))
+
+
+def catalogs_counter(context):
+    """Returns the change counters of the report catalogs, or None if a
+    catalog does not keep a change counter
+    """
+    counters = []
+    for name in REPORT_CATALOGS:
+        catalog = api.get_tool(name, context=context, default=None)
+        if catalog is None:
+            continue
+        get_counter = getattr(catalog, "getCounter", None)
+        if get_counter is None:
+            return None
+        counters.append(get_counter())
+    return tuple(counters)
+
+
+def criteria_key(report_id, selection_macros, request, client_uid):
+    """Returns the key that identifies the criteria of the report request.
+    The frame of the report names the user who ran it (reporter, signature),
+    so reports are only shared between the requests of the same user
+    """
+    form = normalized_form(selection_macros, request)
+    userid = api.get_current_user().getId()
+    return (report_id, form, client_uid, userid)
+
+
+def cache_key(criteria, context):
+    """Returns the cache key of the criteria key passed in, or None if
+    the report can not be cached
+    """
+    counter = catalogs_counter(context)
+    if counter is None:
+        logger.debug("Catalogs without change counter, report not cached")
+        return None
+    return criteria + (counter, )
+
+
+# The cache of this Zope instance
+cache = ReportCache()
+
+
+def get_cache():
+    """Returns the report cache of this Zope instance
+    """
+    return cache
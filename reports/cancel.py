@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Cooperative cancellation of report runs.
+
+Each report run has a CancelToken in the request. The row loops of the
+report modules call check_cancelled(self.request), that raises
+ReportCancelled once the run has been cancelled (e.g. a background job
+cancelled by its owner) or it exceeded its wall-clock budget. SubmitForm
+catches the exception, so the run aborts without storing anything.
+
+The budget of a report is the one declared in the registry, or
+BIKA_REPORTS_BUDGET seconds (0 means no budget).
+"""
+
+import threading
+import time
+
+# Key of the cancel token of the current run in the request
+TOKEN_REQUEST_KEY = "report_cancel_token"
+
+# Reasons of a cancellation
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+
+
+class ReportCancelled(Exception):
+    """Raised within a report run that has to be aborted
+    """
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+class CancelToken(object):
+    """Tells a report run whether it has to be aborted
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.deadline = None
+        self.reason = None
+
+    def set_budget(self, seconds):
+        """Sets the seconds the run can last from now, None or 0 for no limit
+        """
+        self.deadline = seconds and time.time() + seconds or None
+
+    def cancel(self, reason=CANCELLED):
+        self.reason = reason
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        if self.event.is_set():
+            return True
+        if self.deadline is not None and time.time() > self.deadline:
+            self.cancel(TIMEOUT)
+            return True
+        return False
+
+    def check(self):
+        """Raises ReportCancelled if the run has to be aborted
+        """
+        if self.cancelled:
+            raise ReportCancelled(self.reason)
+
+
+def get_token(request):
+    """Returns the CancelToken of the report run of the request passed in,
+    created if it does not exist yet
+    """
+    token = request.get(TOKEN_REQUEST_KEY, None)
+    if not isinstance(token, CancelToken):
+        token = CancelToken()
+        request[TOKEN_REQUEST_KEY] = token
+    return token
+
+
+def set_token(request, token):
+    """Sets the CancelToken of the report run of the request passed in
+    """
+    request[TOKEN_REQUEST_KEY] = token
+
+
+def check_cancelled(request):
+    """Raises ReportCancelled if the report run of the request passed in
+    has been cancelled or exceeded its budget
+    """
+    token = request.get(TOKEN_REQUEST_KEY, None)
+    if token is not None:
+        token.check()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Coalescing of concurrent identical report requests.
+
+Only one run of a report with the same criteria is done at a time. The first
+request becomes the leader of the run, the requests that arrive while it is
+running wait for it and serve the Report object the leader stored. The
+criteria include the user (see cache.criteria_key), as the file names the
+user who generated it.
+
+Within a Zope instance the requests wait on a threading event. Instances
+that share the same lock directory (BIKA_REPORTS_LOCK_DIR) coordinate with a
+file lock per report request: the leader holds it while the report runs and
+writes the result next to it before releasing it.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from bika.lims import logger
+from bika.lims.browser.reports.cache import CachedReport
+from bika.lims.browser.reports.config import REPORT_FLIGHT_TIMEOUT
+from bika.lims.browser.reports.config import REPORT_LOCK_DIR
+from bika.lims.browser.reports.config import get_setting
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on this platform, only coalesce within this instance
+    fcntl = None
+
+# Seconds between two attempts to acquire the file lock
+LOCK_POLL_INTERVAL = 0.5
+
+# Result files older than this are removed by the leaders
+RESULT_MAX_AGE = 3600
+
+
+class Flight(object):
+    """A run of a report, shared by all the requests with the same criteria
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.leader = True
+        self.result = None
+        self.event = threading.Event()
+
+    def publish(self, result):
+        """Sets the result of the run. Result must be json serializable
+        with to_dict, so it can be shared with other instances
+        """
+        self.result = result
+
+
+class FileLock(object):
+    """Exclusive lock shared by the Zope instances of the same host
+    """
+
+    def __init__(self, name):
+        directory = get_setting(REPORT_LOCK_DIR, None)
+        if not directory:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     "bika-reports-locks")
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another instance in the meantime
+                pass
+        self.directory = directory
+        self.path = os.path.join(directory, "{}.lock".format(name))
+        self.result_path = os.path.join(directory, "{}.result".format(name))
+        self.fd = None
+
+    def acquire(self, timeout):
+        """Acquires the lock. Returns whether another instance was holding
+        it, or None if the lock could not be acquired before the timeout
+        """
+        if fcntl is None:
+            return False
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        waited = False
+        start = time.time()
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except IOError:
+                waited = True
+                if time.time() - start > timeout:
+                    os.close(self.fd)
+                    self.fd = None
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def read_result(self, since):
+        """Returns the result written after since, or None
+        """
+        try:
+            if os.path.getmtime(self.result_path) < since:
+                return None
+            with open(self.result_path) as result_file:
+                return json.load(result_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_result(self, result):
+        tmp_path = "{}.tmp".format(self.result_path)
+        with open(tmp_path, "w") as result_file:
+            json.dump(result, result_file)
+        os.rename(tmp_path, self.result_path)
+
+    def cleanup(self):
+        """Removes the result files of old runs
+        """
+        limit = time.time() - RESULT_MAX_AGE
+        for name in os.listdir(self.directory):
+            if not name.endswith(".result"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class SingleFlight(object):
+    """Keeps track of the report runs in progress in this instance
+    """
+
+    def __init__(self, result_factory):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.result_factory = result_factory
+
+    @property
+    def timeout(self):
+        return get_setting(REPORT_FLIGHT_TIMEOUT, 600, int)
+
+    @contextmanager
+    def flight(self, key):
+        """Yields the Flight of the key passed in. If flight.leader is True
+        the caller has to run the report and publish its result. Otherwise
+        flight.result is the result of the run the caller waited for, or None
+        if that run failed
+        """
+        with self.lock:
+            current = self.flights.get(key, None)
+            if current is None:
+                current = Flight(key)
+                self.flights[key] = current
+                leading = True
+            else:
+                leading = False
+
+        if not leading:
+            logger.info("Waiting for a running report with same criteria")
+            current.event.wait(self.timeout)
+            follower = Flight(key)
+            follower.leader = False
+            follower.result = current.result
+            yield follower
+            return
+
+        name = hashlib.sha1(repr(key)).hexdigest()
+        file_lock = FileLock(name)
+        start = time.time()
+        try:
+            waited = file_lock.acquire(self.timeout)
+            if waited:
+                # Another instance ran the report while we were waiting
+                result = file_lock.read_result(start)
+                if result is not None:
+                    logger.info("Report run by another instance")
+                    current.leader = False
+                    current.result = self.result_factory(result)
+            yield current
+            if current.leader and current.result is not None:
+                file_lock.write_result(current.result.to_dict())
+                file_lock.cleanup()
+        finally:
+            file_lock.release()
+            with self.lock:
+                del self.flights[key]
+            current.event.set()
+
+
+# The report runs of this Zope instance
+coalescer = SingleFlight(CachedReport.from_dict)
+
+
+def get_coalescer():
+    """Returns the SingleFlight of this Zope instance
+    """
+    return coalescer
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Instance level settings for report generation.
+
+The settings are read from the process environment, so they can be set in
+the <environment> section of zope.conf (buildout: ``environment-vars``):
+
+    environment-vars =
+        BIKA_REPORTS_WORKERS 2
+"""
+
+import os
+
+# Number of background threads that generate queued reports
+REPORT_WORKERS = "BIKA_REPORTS_WORKERS"
+
+# Maximum number of finished jobs kept in memory for the status view
+REPORT_JOBS_HISTORY = "BIKA_REPORTS_JOBS_HISTORY"
+
+# Maximum number of generated reports kept in the report cache, 0 disables it
+REPORT_CACHE_SIZE = "BIKA_REPORTS_CACHE_SIZE"
+
+# Directory of the locks shared by the instances to coalesce report runs
+REPORT_LOCK_DIR = "BIKA_REPORTS_LOCK_DIR"
+
+# Seconds a request waits for a running report with the same criteria
+REPORT_FLIGHT_TIMEOUT = "BIKA_REPORTS_FLIGHT_TIMEOUT"
+
+# Number of processes that convert reports to PDF, 0 converts in the request
+REPORT_PDF_PROCESSES = "BIKA_REPORTS_PDF_PROCESSES"
+
+# Maximum number of PDF conversions running at the same time
+REPORT_PDF_CONCURRENCY = "BIKA_REPORTS_PDF_CONCURRENCY"
+
+# Seconds to wait for the PDF conversion of a report
+REPORT_PDF_TIMEOUT = "BIKA_REPORTS_PDF_TIMEOUT"
+
+# Rows of a report rendered per PDF chunk, 0 renders the report in one piece
+REPORT_PDF_CHUNK_ROWS = "BIKA_REPORTS_PDF_CHUNK_ROWS"
+
+# Number of runs per report kept in memory for the run stats view
+REPORT_STATS_HISTORY = "BIKA_REPORTS_STATS_HISTORY"
+
+# Maximum cost of the reports running at the same time
+REPORT_MAX_COST = "BIKA_REPORTS_MAX_COST"
+
+# Maximum cost of the reports of the same user running at the same time
+REPORT_USER_MAX_COST = "BIKA_REPORTS_USER_MAX_COST"
+
+# Seconds a background job waits for the reports running to finish
+REPORT_ADMISSION_TIMEOUT = "BIKA_REPORTS_ADMISSION_TIMEOUT"
+
+# Seconds a report can run before it is aborted, 0 for no limit. Reports
+# can declare their own budget in the registry
+REPORT_BUDGET = "BIKA_REPORTS_BUDGET"
+
+# Directory where the generated report files are stored
+REPORT_ARTIFACTS_DIR = "BIKA_REPORTS_ARTIFACTS_DIR"
+
+# Bytes of CSV output buffered before they are written to the response
+REPORT_CSV_CHUNK_SIZE = "BIKA_REPORTS_CSV_CHUNK_SIZE"
+
+# Directory of the columnar snapshot of the analyses
+REPORT_SNAPSHOT_DIR = "BIKA_REPORTS_SNAPSHOT_DIR"
+
+# Seconds after which a report starts a refresh of the snapshot
+REPORT_SNAPSHOT_MAX_AGE = "BIKA_REPORTS_SNAPSHOT_MAX_AGE"
+
+# Directory of the partial aggregates of the reports per day
+REPORT_DAY_CACHE_DIR = "BIKA_REPORTS_DAY_CACHE_DIR"
+
+# Number of most recent days, today included, whose partial aggregates are
+# always computed again
+REPORT_DAY_CACHE_OPEN_DAYS = "BIKA_REPORTS_DAY_CACHE_OPEN_DAYS"
+
+# Command that runs a script in a Zope process connected to the database,
+# e.g. "/srv/lims/bin/client2 run". Aggregations are only sharded if set
+REPORT_SHARD_COMMAND = "BIKA_REPORTS_SHARD_COMMAND"
+
+# Maximum number of worker processes an aggregation is sharded in
+REPORT_SHARDS = "BIKA_REPORTS_SHARDS"
+
+# Minimum number of days of the date range of each shard
+REPORT_SHARD_MIN_DAYS = "BIKA_REPORTS_SHARD_MIN_DAYS"
+
+
+def get_setting(name, default=None, type_=str):
+    """Returns the value of the setting with the name passed in, converted
+    with type_. Returns default if the setting is not set or not valid
+    """
+    value = os.environ.get(name, None)
+    if value is None or value.strip() == "":
+        return default
+    if type_ is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    try:
+        return type_(value.strip())
+    except (TypeError, ValueError):
+        return default
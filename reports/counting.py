@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Group-by counting of catalog results.
+
+Count-style reports (analyses per service, per sample type, per client)
+used to search the catalog once per group, e.g. once per analysis service.
+count_by searches the catalog once with the filter of the report, and
+buckets the results by the value of an index:
+
+    counts = count_by(bac, query, "getServiceUID", request=self.request)
+    for service in services:
+        count = counts.get(service.UID, 0)
+
+When every key of the query is an index of the catalog, no brains are
+created at all: the record ids matching the filter are intersected from
+the BTrees of the indexes, as ZCatalog does, and the counts per value are
+the sizes of the intersections with the records of each value of the
+grouping index. count(catalog, query) returns the number of results the
+same way. Otherwise both fall back to a regular search.
+
+As CatalogTool.searchResults does, the records the current user is not
+allowed to see are left out.
+"""
+
+from AccessControl import getSecurityManager
+from BTrees.IIBTree import intersection
+from DateTime import DateTime
+from Products.CMFCore.permissions import AccessInactivePortalContent
+from Products.CMFCore.utils import _checkPermission
+from bika.lims.browser.reports.cancel import check_cancelled
+
+# Number of results counted between checks for cancellation
+CHECK_EVERY = 1000
+
+# Keys of a catalog query that do not filter the results
+NON_FILTER_KEYS = ("sort_on", "sort_order", "sort_limit", "b_start",
+                   "b_size")
+
+
+def get_index(catalog, name):
+    """Returns the index of the catalog with the name passed in, or None
+    """
+    try:
+        return catalog._catalog.getIndex(name)
+    except (AttributeError, KeyError):
+        return None
+
+
+def get_index_value(index, brain, name):
+    """Returns the value the index stores for the brain passed in. Falls back
+    to the metadata of the brain if the index does not keep them by id
+    """
+    unindex = getattr(index, "_unindex", None)
+    if unindex is not None:
+        return unindex.get(brain.getRID(), None)
+    return getattr(brain, name, None)
+
+
+def get_security_query(catalog):
+    """Returns the query keys CatalogTool.searchResults adds to restrict the
+    results to the ones the current user is allowed to see
+    """
+    query = {}
+    list_allowed = getattr(catalog, "_listAllowedRolesAndUsers", None)
+    if list_allowed is not None:
+        user = getSecurityManager().getUser()
+        query["allowedRolesAndUsers"] = list_allowed(user)
+    if get_index(catalog, "effectiveRange") is not None and \
+            not _checkPermission(AccessInactivePortalContent, catalog):
+        query["effectiveRange"] = DateTime()
+    return query
+
+
+def get_rids(catalog, query):
+    """Returns the set of record ids of the catalog that match the query,
+    intersected from the indexes without creating any brain. Returns None if
+    the query can not be resolved from the indexes
+    """
+    query = dict(query)
+    query.update(get_security_query(catalog))
+    rids = None
+    for key, value in query.items():
+        if key in NON_FILTER_KEYS:
+            continue
+        index = get_index(catalog, key)
+        if index is None:
+            # ZCatalog ignores the keys that are not indexes
+            continue
+        apply_index = getattr(index, "_apply_index", None)
+        if apply_index is None:
+            return None
+        try:
+            result = apply_index({key: value})
+        except (TypeError, ValueError):
+            return None
+        if result is None:
+            return None
+        if rids is None:
+            rids = result[0]
+        else:
+            rids = intersection(rids, result[0])
+        if not rids:
+            # Nothing matches, no need to check the other indexes
+            break
+    return rids
+
+
+def count(catalog, query):
+    """Returns the number of results of the query
+    """
+    rids = get_rids(catalog, query)
+    if rids is None:
+        return len(catalog(query))
+    return len(rids)
+
+
+def count_rids_by(index, rids, request=None):
+    """Returns a dict of value of the index -> number of the record ids
+    passed in with that value
+    """
+    counts = {}
+    values = index._index
+    if len(rids) < len(values):
+        # Fewer records than values, look up the value of each record
+        unindex = index._unindex
+        for num, rid in enumerate(rids):
+            if request is not None and num % CHECK_EVERY == 0:
+                check_cancelled(request)
+            value = unindex.get(rid, None)
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for item in value:
+                counts[item] = counts.get(item, 0) + 1
+        return counts
+
+    # Intersect the records of each value with the records of the filter
+    for num, (value, docs) in enumerate(values.items()):
+        if request is not None and num % CHECK_EVERY == 0:
+            check_cancelled(request)
+        if isinstance(docs, int):
+            # A single record has this value
+            matches = docs in rids and 1 or 0
+        else:
+            matches = len(intersection(docs, rids))
+        if matches:
+            counts[value] = matches
+    return counts
+
+
+def count_by(catalog, query, name, request=None):
+    """Returns a dict of value of the index `name` -> number of results of
+    the query with that value. Results with multiple values (keyword indexes)
+    are counted once for each value
+    """
+    index = get_index(catalog, name)
+    if hasattr(index, "_index") and hasattr(index, "_unindex"):
+        rids = get_rids(catalog, query)
+        if rids is not None:
+            return count_rids_by(index, rids, request=request)
+
+    counts = {}
+    for num, brain in enumerate(catalog(query)):
+        if request is not None and num % CHECK_EVERY == 0:
+            check_cancelled(request)
+        value = get_index_value(index, brain, name)
+        if isinstance(value, (list, tuple)):
+            values = value
+        else:
+            values = [value]
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+    return counts
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Cache of the partial aggregates of reports per day.
+
+Users pick arbitrary date ranges, so caching the whole result of a report
+(cache.py) rarely hits. Reports that aggregate analyses can instead compute
+their aggregates per day of the date index they filter by, and cache the
+partial aggregate of each day. The partials of the days of any range are
+then combined from the cache, and only the days not cached yet are
+computed:
+
+    def compute(date_from, date_to):
+        # day (YYYYmmdd) -> partial aggregate of the day, json serializable
+        ...
+
+    day_cache = DayCache("productivity_analysestats", criteria, "created")
+    totals = {}
+    for partial in day_cache.get_partials(date_from, date_to, compute):
+        merge_counts(totals, partial)
+
+The days missing are computed in runs of consecutive days, with a single
+call to compute each.
+
+Only closed days are cached: the last BIKA_REPORTS_DAY_CACHE_OPEN_DAYS days
+(today by default) are always computed, and so are the days the range
+covers partially. A range that ends in the last minute of a day (e.g. at
+23:59, as the date range of the report forms does) covers the whole day. A
+closed day is served from the cache for as long as the daily aggregates
+(aggregates.py) do not record any change of its analyses: the analyses of
+a closed day still change afterwards (e.g. they are published), so nothing
+is cached without the daily aggregates built.
+
+The partials are stored in json files, one per day, in
+BIKA_REPORTS_DAY_CACHE_DIR (by default the report-daycache folder of the
+Zope client home), so they are shared by all the Zope processes of the host.
+"""
+
+import datetime
+import hashlib
+import json
+import numbers
+import os
+import uuid
+
+from DateTime import DateTime
+from bika.lims.browser.reports.aggregates import from_day
+from bika.lims.browser.reports.aggregates import get_day_stamps
+from bika.lims.browser.reports.aggregates import to_day
+from bika.lims.browser.reports.config import REPORT_DAY_CACHE_DIR
+from bika.lims.browser.reports.config import REPORT_DAY_CACHE_OPEN_DAYS
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.storage import get_default_directory
+
+
+def to_date(day):
+    """Returns the datetime.date of the day (YYYYmmdd) passed in
+    """
+    return datetime.date(day // 10000, day // 100 % 100, day % 100)
+
+
+def iter_days(day_from, day_to):
+    """Generates the days (YYYYmmdd) from day_from to day_to, both included
+    """
+    date = to_date(day_from)
+    last = to_date(day_to)
+    while date <= last:
+        yield int(date.strftime("%Y%m%d"))
+        date += datetime.timedelta(days=1)
+
+
+def get_runs(days):
+    """Returns the (first, last) runs of consecutive days of the sorted list
+    of days passed in
+    """
+    runs = []
+    for day in days:
+        date = to_date(day)
+        if runs and to_date(runs[-1][1]) + datetime.timedelta(days=1) == date:
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+
+def end_of_day(day):
+    """Returns the DateTime of the last second of the day passed in
+    """
+    return from_day(day) + (1 - 1.0 / 86400)
+
+
+def covers_day(date_from, date_to, day):
+    """Returns whether the range from date_from to date_to covers the whole
+    day passed in. A range that ends in the last minute of the day covers it
+    """
+    if date_from > from_day(day):
+        return False
+    return to_day(date_to) > day or \
+        date_to >= end_of_day(day) - 1.0 / 1440
+
+
+def date_query(date_from, date_to):
+    """Returns the catalog query of the dates from date_from to date_to (None
+    for no limit), or None if both are None
+    """
+    if date_from is not None and date_to is not None:
+        return {"query": [date_from, date_to], "range": "min:max"}
+    if date_from is not None:
+        return {"query": date_from, "range": "min"}
+    if date_to is not None:
+        return {"query": date_to, "range": "max"}
+    return None
+
+
+def merge_counts(total, partial):
+    """Adds the numbers of the nested dicts of partial to the ones of total.
+    Values that are not numbers are taken from partial
+    """
+    for key, value in partial.items():
+        if isinstance(value, dict):
+            merge_counts(total.setdefault(key, {}), value)
+        elif isinstance(value, numbers.Number) and \
+                not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+        else:
+            total[key] = value
+    return total
+
+
+def merge_days(total, partial):
+    """Merges the dicts of day -> partial aggregate of two ranges of days
+    that do not overlap
+    """
+    total.update(partial)
+    return total
+
+
+class DayCache(object):
+    """Partial aggregates per day of a report with some criteria. The
+    version is increased when the partial aggregates of the report change,
+    so the ones cached before are not used
+    """
+
+    def __init__(self, report, criteria, date_index, version=1):
+        self.date_index = date_index
+        key = json.dumps([report, version, criteria, date_index],
+                         sort_keys=True, default=str)
+        self.key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    @property
+    def directory(self):
+        directory = get_setting(REPORT_DAY_CACHE_DIR, None) or \
+            get_default_directory("report-daycache")
+        return os.path.join(directory, self.key[:2], self.key)
+
+    def get_path(self, day):
+        return os.path.join(self.directory, "{}.json".format(day))
+
+    def read(self, day, stamp):
+        """Returns the entry of the day passed in, or None if it is not
+        cached or it was cached with another stamp
+        """
+        try:
+            with open(self.get_path(day)) as day_file:
+                entry = json.load(day_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("stamp", None) != stamp:
+            return None
+        return entry
+
+    def write(self, day, stamp, partial):
+        directory = self.directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another thread or instance in the meantime
+                pass
+        path = self.get_path(day)
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written file
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as day_file:
+            json.dump({"stamp": stamp, "partial": partial}, day_file)
+        os.rename(tmp_path, path)
+
+    def get_partials(self, date_from, date_to, compute):
+        """Returns the partial aggregates of the days from date_from to
+        date_to, from the cache or from compute(date_from, date_to), that
+        returns a dict of day -> partial aggregate. Days without partial
+        aggregate are left out. The dates can be None for no limit, in which
+        case nothing is cached
+        """
+        if date_from is None or date_to is None:
+            return compute(date_from, date_to).values()
+
+        date_from = DateTime(date_from)
+        date_to = DateTime(date_to)
+        day_from = to_day(date_from)
+        day_to = to_day(date_to)
+        open_days = get_setting(REPORT_DAY_CACHE_OPEN_DAYS, 1, int)
+        last_closed = to_day(DateTime() - max(open_days, 1))
+        stamps = get_day_stamps(self.date_index, day_from, day_to)
+
+        def cacheable(day):
+            return stamps is not None and day <= last_closed and \
+                covers_day(date_from, date_to, day)
+
+        def get_stamp(day):
+            return stamps is not None and stamps.get(day, 0) or None
+
+        partials = []
+        missing = []
+        for day in iter_days(day_from, day_to):
+            entry = cacheable(day) and self.read(day, get_stamp(day)) or None
+            if entry is None:
+                missing.append(day)
+            elif entry["partial"] is not None:
+                partials.append(entry["partial"])
+
+        for first, last in get_runs(missing):
+            start = max(from_day(first), date_from)
+            end = min(end_of_day(last), date_to)
+            if covers_day(date_from, date_to, last):
+                # the whole last day, as it is cached
+                end = end_of_day(last)
+            computed = compute(start, end)
+            # The days are strings if the partials went through json, e.g.
+            # in a sharded aggregation
+            computed = dict((int(day), partial)
+                            for day, partial in computed.items()
+                            if str(day).isdigit())
+            for day in iter_days(first, last):
+                partial = computed.get(day, None)
+                if cacheable(day):
+                    self.write(day, get_stamp(day), partial)
+                if partial is not None:
+                    partials.append(partial)
+        return partials
+
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Extraction of report rows from catalog brains.
+
+A report declares the columns it reads from each brain. Each column names
+the catalog metadata it is read from, and how it is obtained from the
+object when the catalog does not have that metadata (or has no value for
+the brain). The object is only woken up when such a column is read:
+
+    COLUMNS = (
+        Column("getKeyword"),
+        Column("Title"),
+        Column("department", metadata="getDepartmentUID",
+               accessor="getDepartmentUID"),
+    )
+
+    extractor = RowExtractor(self.request, COLUMNS)
+    for brain in brains:
+        row = extractor.extract(brain)
+        keyword = row["getKeyword"]
+    extractor.finish()
+
+The number of rows extracted and of objects woken up are added to the
+RunStats of the report run.
+"""
+
+import Missing
+from collections import OrderedDict
+
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.timing import get_stats
+
+# Marker of values not available in the catalog metadata
+MISSING = object()
+
+
+class Column(object):
+    """A value of a report row
+    """
+
+    def __init__(self, name, metadata=None, accessor=None, convert=None):
+        self.name = name
+        # metadata column of the catalog, None if not in the catalog
+        self.metadata = metadata or name
+        # attribute, method or function (with the object as argument) that
+        # returns the value from the object
+        self.accessor = accessor or self.metadata
+        # function applied to the metadata value. Can return MISSING
+        self.convert = convert
+
+    def from_brain(self, brain, schema):
+        """Returns the value from the brain metadata, or MISSING
+        """
+        if self.metadata not in schema:
+            return MISSING
+        value = getattr(brain, self.metadata, MISSING)
+        if value is Missing.Value:
+            return MISSING
+        if self.convert is not None and value is not MISSING:
+            value = self.convert(value)
+        return value
+
+    def from_object(self, obj):
+        """Returns the value from the object
+        """
+        if callable(self.accessor):
+            return self.accessor(obj)
+        value = getattr(obj, self.accessor, None)
+        if callable(value):
+            value = value()
+        return value
+
+
+class Row(object):
+    """The columns of a brain, read on demand
+    """
+
+    def __init__(self, extractor, brain):
+        self.extractor = extractor
+        self.brain = brain
+        self.schema = getattr(brain, "__record_schema__", {})
+        self.values = {}
+        self.obj = None
+
+    def __getitem__(self, name):
+        if name in self.values:
+            return self.values[name]
+        if self.brain is None:
+            # e.g. the related brain of the row was not found
+            return None
+        column = self.extractor.columns[name]
+        value = column.from_brain(self.brain, self.schema)
+        if value is MISSING:
+            value = column.from_object(self.get_object(name))
+        self.values[name] = value
+        return value
+
+    def get(self, name, default=None):
+        value = self[name]
+        return default if value is None else value
+
+    def get_object(self, name=None):
+        """Returns the object of the brain, woken up once
+        """
+        if self.obj is None:
+            self.obj = api.get_object(self.brain)
+            self.extractor.woken(name)
+        return self.obj
+
+
+class RowExtractor(object):
+    """Reads the columns of report rows from brains
+    """
+
+    def __init__(self, request, columns):
+        self.request = request
+        self.columns = OrderedDict((column.name, column) for column in columns)
+        self.rows = 0
+        self.woken_objects = 0
+        # column that woke up the objects -> number of objects
+        self.wakers = {}
+
+    def extract(self, brain):
+        """Returns the Row of the brain passed in
+        """
+        self.rows += 1
+        return Row(self, brain)
+
+    def woken(self, name):
+        self.woken_objects += 1
+        self.wakers[name] = self.wakers.get(name, 0) + 1
+
+    def finish(self):
+        """Adds the counters to the stats of the report run
+        """
+        stats = get_stats(self.request)
+        stats.count("rows_extracted", self.rows)
+        stats.count("objects_woken", self.woken_objects)
+        if self.wakers:
+            logger.info("Objects woken up for columns {} of {} rows".format(
+                self.wakers, self.rows))
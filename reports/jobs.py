@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Background generation of reports.
+
+SubmitForm can hand over a report request to the job queue instead of
+generating it inside the HTTP request. The queue keeps a copy of the request
+form and the user that submitted it, and a pool of worker threads generates
+the report with its own ZODB connection. The Report object is stored in the
+reports folder exactly as it is when the report is generated synchronously.
+
+Once the report is queued, the reports form shows the status of the job
+(polling the reportjob_status view) and the link to the report when it is
+done. The report_jobs view lists the jobs, with a button to cancel them.
+
+Jobs are kept in memory, so the status of a job can only be queried in the
+Zope instance that accepted it.
+"""
+
+import Queue
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from DateTime import DateTime
+from bika.lims import logger
+from bika.lims.browser.reports.cancel import CancelToken
+from bika.lims.browser.reports.cancel import set_token
+from bika.lims.browser.reports.config import REPORT_JOBS_HISTORY
+from bika.lims.browser.reports.config import REPORT_WORKERS
+from bika.lims.browser.reports.config import get_setting
+from zope.component.hooks import setSite
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Form keys that must not be replayed by the worker
+IGNORED_FORM_KEYS = ("_authenticator", "submit", "run_in_background")
+
+# Request environment keys needed to compute absolute urls in the worker
+ENVIRON_KEYS = ("SERVER_NAME", "SERVER_PORT", "HTTP_HOST", "HTTPS",
+                "SERVER_URL", "REMOTE_ADDR")
+
+
+def freeze_form(form):
+    """Returns a plain copy of the request form that can be replayed later
+    """
+    frozen = {}
+    for key, value in form.items():
+        if key in IGNORED_FORM_KEYS:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = list(value)
+        elif not isinstance(value, (basestring, int, long, float, bool)):
+            # File uploads and records can not be replayed
+            continue
+        frozen[key] = value
+    return frozen
+
+
+class ReportJob(object):
+    """A report request waiting to be generated, or already generated
+    """
+
+    def __init__(self, report_id, form, userid, site_path, folder_path,
+                 environ=None):
+        self.id = uuid.uuid4().hex
+        self.report_id = report_id
+        self.form = form
+        self.userid = userid
+        self.site_path = site_path
+        self.folder_path = folder_path
+        self.environ = environ or {}
+        self.status = QUEUED
+        self.created = DateTime()
+        self.started = None
+        self.finished = None
+        self.report_path = None
+        self.report_url = None
+        self.message = ""
+        self.token = CancelToken()
+
+    def to_dict(self):
+        """Returns the json serializable status of the job
+        """
+        return {
+            "id": self.id,
+            "report_id": self.report_id,
+            "status": self.status,
+            "created": self.created and self.created.ISO8601(),
+            "started": self.started and self.started.ISO8601(),
+            "finished": self.finished and self.finished.ISO8601(),
+            "url": self.report_url,
+            "message": self.message,
+        }
+
+
+class ReportJobQueue(object):
+    """Queue of report jobs consumed by a pool of worker threads
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def start(self):
+        """Starts the worker threads, if not started yet
+        """
+        with self.lock:
+            self.workers = filter(lambda w: w.is_alive(), self.workers)
+            num_workers = get_setting(REPORT_WORKERS, 2, int)
+            while len(self.workers) < num_workers:
+                worker = threading.Thread(
+                    target=self.work,
+                    name="report-worker-{}".format(len(self.workers) + 1))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def enqueue(self, job):
+        """Adds the job to the queue and returns it
+        """
+        with self.lock:
+            self.jobs[job.id] = job
+            self.purge()
+        self.start()
+        self.queue.put(job.id)
+        logger.info("Report job {} queued for '{}'".format(
+            job.id, job.report_id))
+        return job
+
+    def get(self, job_id):
+        """Returns the job with the id passed in or None
+        """
+        return self.jobs.get(job_id, None)
+
+    def get_jobs(self, userid=None):
+        """Returns the jobs submitted by the user passed in, or all of them
+        if not set, the newest first
+        """
+        with self.lock:
+            jobs = self.jobs.values()
+        return [job for job in reversed(jobs)
+                if userid is None or job.userid == userid]
+
+    def position(self, job_id):
+        """Returns the position of the job in the queue, 1 being the next
+        job to run, or 0 if it is not queued
+        """
+        position = 0
+        for queued_id, job in self.jobs.items():
+            if job.status != QUEUED:
+                continue
+            position += 1
+            if queued_id == job_id:
+                return position
+        return 0
+
+    def cancel(self, job_id):
+        """Cancels the job with the id passed in. Queued jobs are not run,
+        running jobs are aborted at the next cancellation check. Returns the
+        job, or None
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished = DateTime()
+                job.message = "Cancelled before it started"
+            elif job.status == RUNNING:
+                job.token.cancel()
+        logger.info("Report job {} cancelled".format(job.id))
+        return job
+
+    def purge(self):
+        """Forgets the oldest finished jobs above the history limit
+        """
+        max_jobs = get_setting(REPORT_JOBS_HISTORY, 500, int)
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.status in (DONE, FAILED, CANCELLED)]
+        while len(self.jobs) > max_jobs and finished:
+            del self.jobs[finished.pop(0)]
+
+    def work(self):
+        """Worker thread main loop
+        """
+        while True:
+            job = self.get(self.queue.get())
+            try:
+                with self.lock:
+                    # the job might have been cancelled in the meantime
+                    runnable = job and job.status == QUEUED
+                    if runnable:
+                        job.status = RUNNING
+                if runnable:
+                    self.execute(job)
+            except Exception:
+                logger.error("Report job failed: {}".format(
+                    traceback.format_exc()))
+            finally:
+                self.queue.task_done()
+
+    def execute(self, job):
+        """Generates the report of the job with a new ZODB connection
+        """
+        job.started = DateTime()
+        # Conflicts while storing the Report object are retried by
+        # SubmitForm.store, the report itself is never run twice
+        try:
+            report = self.generate(job)
+        except Exception as e:
+            logger.error("Report job {} failed: {}".format(
+                job.id, traceback.format_exc()))
+            job.status = FAILED
+            job.message = "{}: {}".format(e.__class__.__name__, e)
+            job.finished = DateTime()
+            return
+
+        if job.token.reason is not None:
+            job.status = CANCELLED
+        elif report is None:
+            job.status = FAILED
+        else:
+            job.status = DONE
+        job.finished = DateTime()
+        logger.info("Report job {} finished with status '{}'".format(
+            job.id, job.status))
+
+    def generate(self, job):
+        """Opens a new connection to the database, runs SubmitForm against
+        the reports folder as the user that submitted the job and commits
+        """
+        import Zope2
+        from Testing.makerequest import makerequest
+        from bika.lims.browser.reports import SubmitForm
+        from Products.statusmessages.interfaces import IStatusMessage
+
+        environ = dict(job.environ)
+        app = makerequest(Zope2.app(), stdout=NullOutput(), environ=environ)
+        try:
+            site = app.unrestrictedTraverse(job.site_path)
+            setSite(site)
+            user = site.acl_users.getUserById(job.userid)
+            acl_users = site.acl_users
+            if user is None:
+                user = app.acl_users.getUserById(job.userid)
+                acl_users = app.acl_users
+            if user is None:
+                raise ValueError("User {} not found".format(job.userid))
+            newSecurityManager(None, user.__of__(acl_users))
+
+            request = app.REQUEST
+            server_url = environ.get("SERVER_URL")
+            if server_url:
+                protocol, host = server_url.split("://", 1)
+                host, port = (host.split(":", 1) + [None])[:2]
+                request.setServerURL(protocol, host, port)
+            request.form.update(job.form)
+            request.other.update(job.form)
+            request["report_id"] = job.report_id
+            request["report_job"] = job.id
+            set_token(request, job.token)
+
+            folder = site.unrestrictedTraverse(job.folder_path)
+            view = SubmitForm(folder, request).__of__(folder)
+            report = view.generate()
+            if report is None:
+                messages = IStatusMessage(request).show()
+                job.message = " ".join([m.message for m in messages])
+                transaction.abort()
+                return None
+
+            transaction.commit()
+            job.report_path = "/".join(report.getPhysicalPath())
+            job.report_url = "{}/report_artifact?uid={}".format(
+                folder.absolute_url(), report.UID())
+            return report
+        except Exception:
+            transaction.abort()
+            raise
+        finally:
+            noSecurityManager()
+            setSite(None)
+            app._p_jar.close()
+
+
+class NullOutput(object):
+    """Response output of the worker requests, discarded
+    """
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def job_environ(request):
+    """Returns the request environment values the worker needs to compute
+    the same absolute urls as the request that queued the job
+    """
+    environ = {}
+    for key in ENVIRON_KEYS:
+        value = request.get(key, None)
+        if isinstance(value, basestring):
+            environ[key] = value
+    return environ
+
+
+# The queue of this Zope instance
+queue = ReportJobQueue()
+
+
+def get_queue():
+    """Returns the report job queue of this Zope instance
+    """
+    return queue
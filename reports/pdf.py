@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Rendering of report PDFs.
+
+With BIKA_REPORTS_PDF_PROCESSES set, the HTML of the reports is converted to
+PDF by a pool of processes, so conversions run in parallel instead of being
+serialized by the interpreter lock of the Zope instance. Otherwise they are
+done in the request thread. In both cases no more than
+BIKA_REPORTS_PDF_CONCURRENCY conversions run at a time, the others wait for
+their turn.
+
+A long report can be rendered as several chunks, converted in parallel and
+merged afterwards. Merging requires PyPDF2.
+
+The pool is started when the Zope process starts (start_renderer), before it
+serves requests: forking a process with other threads running is not safe,
+as the child inherits the locks those threads hold. A conversion that takes
+longer than BIKA_REPORTS_PDF_TIMEOUT seconds raises PdfTimeout. Its process
+can not be stopped on its own, so the pool is retired: new conversions go
+to a new pool, and the old one is terminated once the conversions it was
+running had the time to finish. Only that new pool is forked while serving
+requests, its processes only run the conversions.
+"""
+
+import StringIO
+import multiprocessing
+import threading
+
+from bika.lims import logger
+from bika.lims.browser.reports.config import REPORT_PDF_CONCURRENCY
+from bika.lims.browser.reports.config import REPORT_PDF_PROCESSES
+from bika.lims.browser.reports.config import REPORT_PDF_TIMEOUT
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.utils import createPdf
+
+try:
+    from PyPDF2 import PdfFileMerger
+except ImportError:
+    PdfFileMerger = None
+
+# Conversions done by a process before it is replaced by a new one
+MAX_TASKS_PER_PROCESS = 50
+
+
+class PdfTimeout(Exception):
+    """The conversion of a report to PDF took too long
+    """
+
+
+def render_pdf(html):
+    """Converts the html passed in to PDF. Runs in the pool processes
+    """
+    return createPdf(html)
+
+
+def merge_pdfs(pdfs):
+    """Returns a single PDF with the pages of the PDFs passed in
+    """
+    merger = PdfFileMerger()
+    for pdf in pdfs:
+        merger.append(StringIO.StringIO(pdf))
+    output = StringIO.StringIO()
+    merger.write(output)
+    merged = output.getvalue()
+    output.close()
+    return merged
+
+
+class PdfRenderer(object):
+    """Converts report html to PDF with bounded concurrency
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.slots = None
+
+    @property
+    def processes(self):
+        return get_setting(REPORT_PDF_PROCESSES, 0, int)
+
+    @property
+    def timeout(self):
+        return get_setting(REPORT_PDF_TIMEOUT, 600, int)
+
+    def can_render_chunks(self):
+        """Returns whether the chunks of a report can be rendered in parallel
+        """
+        return self.processes > 1 and PdfFileMerger is not None
+
+    def get_slots(self):
+        """Returns the semaphore that bounds the concurrent conversions
+        """
+        with self.lock:
+            if self.slots is None:
+                concurrency = get_setting(REPORT_PDF_CONCURRENCY,
+                                          max(self.processes, 1), int)
+                self.slots = threading.BoundedSemaphore(max(concurrency, 1))
+            return self.slots
+
+    def get_pool(self):
+        """Returns the process pool, started on first use, or None if PDFs
+        are rendered in the request thread
+        """
+        processes = self.processes
+        if processes <= 0:
+            return None
+        with self.lock:
+            if self.pool is None:
+                logger.info("Starting {} PDF rendering processes".format(
+                    processes))
+                self.pool = multiprocessing.Pool(
+                    processes, maxtasksperchild=MAX_TASKS_PER_PROCESS)
+            return self.pool
+
+    def retire_pool(self, pool):
+        """Replaces the pool passed in, with a conversion stuck in one of its
+        processes, by a new one. The old pool is terminated once the other
+        conversions it is running timed out
+        """
+        with self.lock:
+            if self.pool is not pool:
+                # Retired already by another timed out conversion
+                return
+            self.pool = None
+        pool.close()
+        timer = threading.Timer(self.timeout, pool.terminate)
+        timer.daemon = True
+        timer.start()
+
+    def render(self, html):
+        """Returns the PDF of the html passed in
+        """
+        return self.render_chunks([html])
+
+    def render_chunks(self, htmls):
+        """Returns a single PDF with the pages of the htmls passed in, each
+        one converted separately
+        """
+        slots = self.get_slots()
+        pool = self.get_pool()
+        with SlotsHolder(slots, min(len(htmls), max(self.processes, 1))):
+            if pool is None:
+                pdfs = [render_pdf(html) for html in htmls]
+            else:
+                results = [pool.apply_async(render_pdf, (html, ))
+                           for html in htmls]
+                try:
+                    pdfs = [result.get(self.timeout) for result in results]
+                except multiprocessing.TimeoutError:
+                    logger.error("PDF conversion timed out after {} seconds"
+                                 .format(self.timeout))
+                    self.retire_pool(pool)
+                    raise PdfTimeout()
+
+        if not all(pdfs):
+            return None
+        if len(pdfs) == 1:
+            return pdfs[0]
+        return merge_pdfs(pdfs)
+
+
+class SlotsHolder(object):
+    """Acquires a number of slots of the semaphore and releases them on exit
+    """
+
+    def __init__(self, semaphore, num):
+        self.semaphore = semaphore
+        self.num = num
+        self.acquired = 0
+
+    def __enter__(self):
+        # Wait for one slot, then take the free ones up to num. The chunks
+        # are distributed among the slots held
+        self.semaphore.acquire()
+        self.acquired = 1
+        while self.acquired < self.num and self.semaphore.acquire(False):
+            self.acquired += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for num in range(self.acquired):
+            self.semaphore.release()
+        self.acquired = 0
+
+
+# The PDF renderer of this Zope instance
+renderer = PdfRenderer()
+
+
+def get_renderer():
+    """Returns the PDF renderer of this Zope instance
+    """
+    return renderer
+
+
+def start_renderer(event):
+    """Event handler that starts the pool of PDF rendering processes when the
+    Zope process starts
+    """
+    renderer.get_pool()
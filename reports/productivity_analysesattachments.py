@@ -7,6 +7,8 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -76,39 +78,42 @@ class Report(BrowserView):
         }
 
         datalines = []
-        attachments = pc(query)
-        for a_proxy in attachments:
-            attachment = a_proxy.getObject()
-            attachment_file = attachment.getAttachmentFile()
-            icon = attachment_file.icon
-            filename = attachment_file.filename
-            filesize = attachment_file.get_size()
-            filesize = filesize / 1024
-            sizeunit = "Kb"
-            if filesize > 1024:
+        with stage(self.request, 'query'):
+            attachments = pc(query)
+        with stage(self.request, 'rows'):
+            for a_proxy in attachments:
+                check_cancelled(self.request)
+                attachment = a_proxy.getObject()
+                attachment_file = attachment.getAttachmentFile()
+                icon = attachment_file.icon
+                filename = attachment_file.filename
+                filesize = attachment_file.get_size()
                 filesize = filesize / 1024
-                sizeunit = "Mb"
-            dateloaded = attachment.getDateLoaded()
-            dataline = []
-            dataitem = {'value': attachment.Title()}
-            dataline.append(dataitem)
-            dataitem = {'value': filename,
-                        'img_before': icon}
-            dataline.append(dataitem)
-            dataitem = {
-            'value': attachment.getAttachmentType().Title() if attachment.getAttachmentType() else ''}
-            dataline.append(dataitem)
-            dataitem = {
-            'value': self.context.lookupMime(attachment_file.getContentType())}
-            dataline.append(dataitem)
-            dataitem = {'value': '%s%s' % (filesize, sizeunit)}
-            dataline.append(dataitem)
-            dataitem = {'value': self.ulocalized_time(dateloaded)}
-            dataline.append(dataitem)
-
-            datalines.append(dataline)
-
-            count_all += 1
+                sizeunit = "Kb"
+                if filesize > 1024:
+                    filesize = filesize / 1024
+                    sizeunit = "Mb"
+                dateloaded = attachment.getDateLoaded()
+                dataline = []
+                dataitem = {'value': attachment.Title()}
+                dataline.append(dataitem)
+                dataitem = {'value': filename,
+                            'img_before': icon}
+                dataline.append(dataitem)
+                dataitem = {
+                'value': attachment.getAttachmentType().Title() if attachment.getAttachmentType() else ''}
+                dataline.append(dataitem)
+                dataitem = {
+                'value': self.context.lookupMime(attachment_file.getContentType())}
+                dataline.append(dataitem)
+                dataitem = {'value': '%s%s' % (filesize, sizeunit)}
+                dataline.append(dataitem)
+                dataitem = {'value': self.ulocalized_time(dateloaded)}
+                dataline.append(dataitem)
+
+                datalines.append(dataline)
+
+                count_all += 1
 
         # footer data
         footlines = []
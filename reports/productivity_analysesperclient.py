@@ -7,6 +7,10 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import count_query
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.counting import count_by
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -109,30 +113,39 @@ class Report(BrowserView):
 
         datalines = []
 
-        if this_client:
-            c_proxies = pc(portal_type="Client", UID=this_client.UID())
-        else:
-            c_proxies = pc(portal_type="Client", sort_on='sortable_title')
+        with stage(self.request, 'query'):
+            if this_client:
+                c_proxies = pc(portal_type="Client", UID=this_client.UID())
+                query['getClientUID'] = this_client.UID()
+            else:
+                c_proxies = pc(portal_type="Client", sort_on='sortable_title')
 
-        for client in c_proxies:
-            query['getClientUID'] = client.UID
-            dataline = [{'value': client.Title}, ]
+            # Count the requests and analyses of all clients at once
             query['portal_type'] = 'AnalysisRequest'
-            ars = bc(query)
-            count_ars = len(ars)
-            dataitem = {'value': count_ars}
-            dataline.append(dataitem)
-
+            ars_counts = count_by(bc, query, 'getClientUID',
+                                  request=self.request)
             query['portal_type'] = 'Analysis'
-            analyses = bac(query)
-            count_analyses = len(analyses)
-            dataitem = {'value': count_analyses}
-            dataline.append(dataitem)
-
-            datalines.append(dataline)
-
-            count_all_analyses += count_analyses
-            count_all_ars += count_ars
+            analyses_counts = count_query(query, 'getClientUID')
+            if analyses_counts is None:
+                analyses_counts = count_by(bac, query, 'getClientUID',
+                                           request=self.request)
+
+        with stage(self.request, 'rows'):
+            for client in c_proxies:
+                check_cancelled(self.request)
+                dataline = [{'value': client.Title}, ]
+                count_ars = ars_counts.get(client.UID, 0)
+                dataitem = {'value': count_ars}
+                dataline.append(dataitem)
+
+                count_analyses = analyses_counts.get(client.UID, 0)
+                dataitem = {'value': count_analyses}
+                dataline.append(dataitem)
+
+                datalines.append(dataline)
+
+                count_all_analyses += count_analyses
+                count_all_ars += count_ars
 
         # footer data
         footlines = []
@@ -5,14 +5,36 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
-from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import count_groups
+from bika.lims.browser.reports.aggregates import from_day
+from bika.lims.browser.reports.aggregates import get_date_range
+from bika.lims.browser.reports.aggregates import to_day
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.daycache import DayCache
+from bika.lims.browser.reports.daycache import date_query
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.ratios import GroupedRatios
+from bika.lims.browser.reports.resolver import ARStates
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the analysis brains
+COLUMNS = (
+    Column("created"),
+    Column("getDateRequested"),
+    Column("getResult"),
+    Column("getDepartmentUID"),
+)
+
+# Fields the daily aggregates are grouped by
+GROUP_BY = ("created_day", "department", "performed", "ar_published")
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -24,6 +46,7 @@ class Report(BrowserView):
         super(Report, self).__init__(context, request)
         self.report = report
         self.selection_macros = SelectionMacrosView(self.context, self.request)
+        self.titles = {}
 
     def __call__(self):
 
@@ -49,9 +72,31 @@ class Report(BrowserView):
             parms.append(val['parms'])
             titles.append(val['titles'])
 
-        # Query the catalog and store results in a dictionary
-        analyses = self.bika_analysis_catalog(self.contentFilter)
-        if not analyses:
+        # Count the analyses from the daily aggregates if possible, or query
+        # the catalog otherwise, combining the counts per day requested
+        # cached for the closed days
+        counts = count_groups(self.contentFilter, GROUP_BY)
+        if counts is None:
+            date_from, date_to = get_date_range(
+                self.contentFilter.get('getDateRequested', None)) or \
+                (None, None)
+            criteria = dict((key, value) for key, value in
+                            self.contentFilter.items()
+                            if key != 'getDateRequested')
+            day_cache = DayCache('productivity_analysesperdepartment',
+                                 criteria, 'getDateRequested')
+            counts = {}
+            for partial in day_cache.get_partials(date_from, date_to,
+                                                  self.get_daily_counts):
+                for created, department_uid, performed, published, num \
+                        in partial:
+                    key = (created, department_uid, performed, published)
+                    counts[key] = counts.get(key, 0) + num
+        totalcount = sum(counts.values())
+        records = [(from_day(day), department_uid, performed, published,
+                    num) for (day, department_uid, performed, published),
+                   num in counts.items()]
+        if not totalcount:
             message = _("No analyses matched your query")
             self.context.plone_utils.addPortalMessage(message, "error")
             return self.default_template()
@@ -60,110 +105,16 @@ class Report(BrowserView):
         if (groupby != ''):
             parms.append({"title": _("Grouping period"), "value": _(groupby)})
 
-        datalines = {}
-        footlines = {}
-        totalcount = len(analyses)
-        totalpublishedcount = 0
-        totalperformedcount = 0
-        for analysis in analyses:
-            analysis = analysis.getObject()
-            department = analysis.getDepartment()
-            department = department.Title() if department else ''
-            daterequested = analysis.created()
-
-            group = ''
-            if groupby == 'Day':
-                group = self.ulocalized_time(daterequested)
-            elif groupby == 'Week':
-                group = daterequested.strftime(
-                    "%Y") + ", " + daterequested.strftime("%U")
-            elif groupby == 'Month':
-                group = daterequested.strftime(
-                    "%B") + " " + daterequested.strftime("%Y")
-            elif groupby == 'Year':
-                group = daterequested.strftime("%Y")
-            else:
-                group = ''
-
-            dataline = {'Group': group, 'Requested': 0, 'Performed': 0,
-                        'Published': 0, 'Departments': {}}
-            deptline = {'Department': department, 'Requested': 0, 'Performed': 0,
-                        'Published': 0}
-            if (group in datalines):
-                dataline = datalines[group]
-                if (department in dataline['Departments']):
-                    deptline = dataline['Departments'][department]
-
-            grouptotalcount = dataline['Requested'] + 1
-            groupperformedcount = dataline['Performed']
-            grouppublishedcount = dataline['Published']
-
-            depttotalcount = deptline['Requested'] + 1
-            deptperformedcount = deptline['Performed']
-            deptpubishedcount = deptline['Published']
-
-            workflow = getToolByName(self.context, 'portal_workflow')
-            arstate = workflow.getInfoFor(analysis.aq_parent, 'review_state', '')
-            if (arstate == 'published'):
-                deptpubishedcount += 1
-                grouppublishedcount += 1
-                totalpublishedcount += 1
-
-            if (analysis.getResult()):
-                deptperformedcount += 1
-                groupperformedcount += 1
-                totalperformedcount += 1
-
-            group_performedrequested_ratio = float(groupperformedcount) / float(
-                grouptotalcount)
-            group_publishedperformed_ratio = groupperformedcount > 0 and float(
-                grouppublishedcount) / float(groupperformedcount) or 0
-
-            anl_performedrequested_ratio = float(deptperformedcount) / float(
-                depttotalcount)
-            anl_publishedperformed_ratio = deptperformedcount > 0 and float(
-                deptpubishedcount) / float(deptperformedcount) or 0
-
-            dataline['Requested'] = grouptotalcount
-            dataline['Performed'] = groupperformedcount
-            dataline['Published'] = grouppublishedcount
-            dataline['PerformedRequestedRatio'] = group_performedrequested_ratio
-            dataline['PerformedRequestedRatioPercentage'] = ('{0:.0f}'.format(
-                group_performedrequested_ratio * 100)) + "%"
-            dataline['PublishedPerformedRatio'] = group_publishedperformed_ratio
-            dataline['PublishedPerformedRatioPercentage'] = ('{0:.0f}'.format(
-                group_publishedperformed_ratio * 100)) + "%"
-
-            deptline['Requested'] = depttotalcount
-            deptline['Performed'] = deptperformedcount
-            deptline['Published'] = deptpubishedcount
-            deptline['PerformedRequestedRatio'] = anl_performedrequested_ratio
-            deptline['PerformedRequestedRatioPercentage'] = ('{0:.0f}'.format(
-                anl_performedrequested_ratio * 100)) + "%"
-            deptline['PublishedPerformedRatio'] = anl_publishedperformed_ratio
-            deptline['PublishedPerformedRatioPercentage'] = ('{0:.0f}'.format(
-                anl_publishedperformed_ratio * 100)) + "%"
-
-            dataline['Departments'][department] = deptline
-            datalines[group] = dataline
-
-        # Footer total data
-        total_performedrequested_ratio = float(totalperformedcount) / float(
-            totalcount)
-        total_publishedperformed_ratio = totalperformedcount > 0 and float(
-            totalpublishedcount) / float(totalperformedcount) or 0
-
-        footline = {'Requested': totalcount,
-                    'Performed': totalperformedcount,
-                    'Published': totalpublishedcount,
-                    'PerformedRequestedRatio': total_performedrequested_ratio,
-                    'PerformedRequestedRatioPercentage': ('{0:.0f}'.format(
-                        total_performedrequested_ratio * 100)) + "%",
-                    'PublishedPerformedRatio': total_publishedperformed_ratio,
-                    'PublishedPerformedRatioPercentage': ('{0:.0f}'.format(
-                        total_publishedperformed_ratio * 100)) + "%"}
-
-        footlines['Total'] = footline
+        with stage(self.request, 'rows'):
+            ratios = GroupedRatios(groupby, 'Departments', 'Department',
+                                   self.ulocalized_time)
+            for daterequested, department_uid, performed, published, num \
+                    in records:
+                check_cancelled(self.request)
+                department = self.get_title(department_uid)
+                ratios.add(daterequested, department, department, performed,
+                           published, num)
+            datalines, footlines = ratios.finalize()
 
         self.report_data = {'parameters': parms,
                             'datalines': datalines,
@@ -205,3 +156,47 @@ class Report(BrowserView):
         else:
             return {'report_title': _('Analyses summary per department'),
                     'report_data': self.template()}
+
+    def get_daily_counts(self, date_from, date_to):
+        """Returns a dict of day requested -> list of [day created, department
+        UID, performed, published, number of analyses] of the analyses of
+        the filter requested that day, for the days from date_from to date_to
+        """
+        query = dict(self.contentFilter)
+        dates = date_query(date_from, date_to)
+        if dates is not None:
+            query['getDateRequested'] = dates
+        with stage(self.request, 'query'):
+            analyses = self.bika_analysis_catalog(query)
+            # The review states of the ARs are read from their brains
+            ar_states = ARStates(analyses)
+        counts = {}
+        with stage(self.request, 'rows'):
+            extractor = RowExtractor(self.request, COLUMNS)
+            for analysis in analyses:
+                check_cancelled(self.request)
+                published = ar_states.is_published(analysis)
+                analysis = extractor.extract(analysis)
+                key = (to_day(analysis['getDateRequested']),
+                       to_day(analysis['created']),
+                       analysis['getDepartmentUID'],
+                       bool(analysis['getResult']), published)
+                counts[key] = counts.get(key, 0) + 1
+            extractor.finish()
+
+        days = {}
+        for (requested, created, department_uid, performed, published), num \
+                in counts.items():
+            days.setdefault(requested, []).append(
+                [created, department_uid, performed, published, num])
+        return days
+
+    def get_title(self, uid):
+        """Returns the title of the department with the UID passed in
+        """
+        if not uid:
+            return ''
+        if uid not in self.titles:
+            brains = self.bika_setup_catalog(UID=uid)
+            self.titles[uid] = brains and brains[0].Title or ''
+        return self.titles[uid]
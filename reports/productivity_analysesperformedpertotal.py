@@ -5,14 +5,35 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
-from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import count_groups
+from bika.lims.browser.reports.aggregates import from_day
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.ratios import GroupedRatios
+from bika.lims.browser.reports.resolver import ARStates
+from bika.lims.browser.reports.resolver import BrainResolver
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the analysis brains
+COLUMNS = (
+    Column("created"),
+    Column("getResult"),
+    Column("getKeyword"),
+    Column("Title"),
+)
+
+# Fields the daily aggregates are grouped by
+GROUP_BY = ("created_day", "service", "performed", "ar_published")
+
+SETUP_CATALOG = "bika_setup_catalog"
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -40,9 +61,18 @@ class Report(BrowserView):
             parms.append(val['parms'])
             titles.append(val['titles'])
 
-        # Query the catalog and store results in a dictionary
-        analyses = self.bika_analysis_catalog(self.contentFilter)
-        if not analyses:
+        # Count the analyses from the daily aggregates if possible, or query
+        # the catalog otherwise
+        counts = count_groups(self.contentFilter, GROUP_BY)
+        if counts is not None:
+            totalcount = sum(counts.values())
+            records = self.get_aggregated_records(counts)
+        else:
+            with stage(self.request, 'query'):
+                analyses = self.bika_analysis_catalog(self.contentFilter)
+            totalcount = len(analyses)
+            records = self.get_records(analyses)
+        if not totalcount:
             message = _("No analyses matched your query")
             self.context.plone_utils.addPortalMessage(message, "error")
             return self.default_template()
@@ -51,110 +81,15 @@ class Report(BrowserView):
         if (groupby != ''):
             parms.append({"title": _("Grouping period"), "value": _(groupby)})
 
-        datalines = {}
-        footlines = {}
-        totalcount = len(analyses)
-        totalpublishedcount = 0
-        totalperformedcount = 0
-        for analysis in analyses:
-            analysis = analysis.getObject()
-            ankeyword = analysis.getKeyword()
-            antitle = analysis.Title()
-            daterequested = analysis.created()
-
-            group = ''
-            if groupby == 'Day':
-                group = self.ulocalized_time(daterequested)
-            elif groupby == 'Week':
-                group = daterequested.strftime(
-                    "%Y") + ", " + daterequested.strftime("%U")
-            elif groupby == 'Month':
-                group = daterequested.strftime(
-                    "%B") + " " + daterequested.strftime("%Y")
-            elif groupby == 'Year':
-                group = daterequested.strftime("%Y")
-            else:
-                group = ''
-
-            dataline = {'Group': group, 'Requested': 0, 'Performed': 0,
-                        'Published': 0, 'Analyses': {}}
-            anline = {'Analysis': antitle, 'Requested': 0, 'Performed': 0,
-                      'Published': 0}
-            if (group in datalines):
-                dataline = datalines[group]
-                if (ankeyword in dataline['Analyses']):
-                    anline = dataline['Analyses'][ankeyword]
-
-            grouptotalcount = dataline['Requested'] + 1
-            groupperformedcount = dataline['Performed']
-            grouppublishedcount = dataline['Published']
-
-            anltotalcount = anline['Requested'] + 1
-            anlperformedcount = anline['Performed']
-            anlpublishedcount = anline['Published']
-
-            workflow = getToolByName(self.context, 'portal_workflow')
-            arstate = workflow.getInfoFor(analysis.aq_parent, 'review_state', '')
-            if (arstate == 'published'):
-                anlpublishedcount += 1
-                grouppublishedcount += 1
-                totalpublishedcount += 1
-
-            if (analysis.getResult()):
-                anlperformedcount += 1
-                groupperformedcount += 1
-                totalperformedcount += 1
-
-            group_performedrequested_ratio = float(groupperformedcount) / float(
-                grouptotalcount)
-            group_publishedperformed_ratio = groupperformedcount > 0 and float(
-                grouppublishedcount) / float(groupperformedcount) or 0
-
-            anl_performedrequested_ratio = float(anlperformedcount) / float(
-                anltotalcount)
-            anl_publishedperformed_ratio = anlperformedcount > 0 and float(
-                anlpublishedcount) / float(anlperformedcount) or 0
-
-            dataline['Requested'] = grouptotalcount
-            dataline['Performed'] = groupperformedcount
-            dataline['Published'] = grouppublishedcount
-            dataline['PerformedRequestedRatio'] = group_performedrequested_ratio
-            dataline['PerformedRequestedRatioPercentage'] = ('{0:.0f}'.format(
-                group_performedrequested_ratio * 100)) + "%"
-            dataline['PublishedPerformedRatio'] = group_publishedperformed_ratio
-            dataline['PublishedPerformedRatioPercentage'] = ('{0:.0f}'.format(
-                group_publishedperformed_ratio * 100)) + "%"
-
-            anline['Requested'] = anltotalcount
-            anline['Performed'] = anlperformedcount
-            anline['Published'] = anlpublishedcount
-            anline['PerformedRequestedRatio'] = anl_performedrequested_ratio
-            anline['PerformedRequestedRatioPercentage'] = ('{0:.0f}'.format(
-                anl_performedrequested_ratio * 100)) + "%"
-            anline['PublishedPerformedRatio'] = anl_publishedperformed_ratio
-            anline['PublishedPerformedRatioPercentage'] = ('{0:.0f}'.format(
-                anl_publishedperformed_ratio * 100)) + "%"
-
-            dataline['Analyses'][ankeyword] = anline
-            datalines[group] = dataline
-
-        # Footer total data
-        total_performedrequested_ratio = float(totalperformedcount) / float(
-            totalcount)
-        total_publishedperformed_ratio = totalperformedcount > 0 and float(
-            totalpublishedcount) / float(totalperformedcount) or 0
-
-        footline = {'Requested': totalcount,
-                    'Performed': totalperformedcount,
-                    'Published': totalpublishedcount,
-                    'PerformedRequestedRatio': total_performedrequested_ratio,
-                    'PerformedRequestedRatioPercentage': ('{0:.0f}'.format(
-                        total_performedrequested_ratio * 100)) + "%",
-                    'PublishedPerformedRatio': total_publishedperformed_ratio,
-                    'PublishedPerformedRatioPercentage': ('{0:.0f}'.format(
-                        total_publishedperformed_ratio * 100)) + "%"}
-
-        footlines['Total'] = footline
+        with stage(self.request, 'rows'):
+            ratios = GroupedRatios(groupby, 'Analyses', 'Analysis',
+                                   self.ulocalized_time)
+            for daterequested, ankeyword, antitle, performed, published, \
+                    num in records:
+                check_cancelled(self.request)
+                ratios.add(daterequested, ankeyword, antitle, performed,
+                           published, num)
+            datalines, footlines = ratios.finalize()
 
         self.report_data = {'parameters': parms,
                             'datalines': datalines,
@@ -196,3 +131,33 @@ class Report(BrowserView):
         else:
             return {'report_title': _('Analyses performed as % of total'),
                     'report_data': self.template()}
+
+    def get_records(self, analyses):
+        """Generates the (date requested, keyword, title, performed,
+        published, 1) record of each analysis brain passed in
+        """
+        extractor = RowExtractor(self.request, COLUMNS)
+        # The review states of the ARs are read from their brains
+        ar_states = ARStates(analyses)
+        for analysis in analyses:
+            published = ar_states.is_published(analysis)
+            analysis = extractor.extract(analysis)
+            yield (analysis['created'], analysis['getKeyword'],
+                   analysis['Title'], bool(analysis['getResult']),
+                   published, 1)
+        extractor.finish()
+
+    def get_aggregated_records(self, counts):
+        """Returns the (date requested, keyword, title, performed, published,
+        number of analyses) records of the daily aggregates passed in
+        """
+        resolver = BrainResolver()
+        resolver.fetch(set([group[1] for group in counts]), SETUP_CATALOG)
+        records = []
+        for (day, service_uid, performed, published), num in counts.items():
+            service = resolver.get(service_uid, SETUP_CATALOG)
+            keyword = service and service.getKeyword or service_uid
+            title = service and service.Title or ''
+            records.append((from_day(day), keyword, title, performed,
+                            published, num))
+        return records
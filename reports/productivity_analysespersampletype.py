@@ -7,6 +7,10 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import count_query
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.counting import count_by
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -101,22 +105,28 @@ class Report(BrowserView):
         }
 
         datalines = []
-        for sampletype in sc(portal_type="SampleType",
-                             sort_on='sortable_title'):
-            query['getSampleTypeUID'] = sampletype.UID
-            analyses = bac(query)
-            count_analyses = len(analyses)
-
-            dataline = []
-            dataitem = {'value': sampletype.Title}
-            dataline.append(dataitem)
-            dataitem = {'value': count_analyses}
-
-            dataline.append(dataitem)
-
-            datalines.append(dataline)
-
-            count_all += count_analyses
+        with stage(self.request, 'query'):
+            counts = count_query(query, 'getSampleTypeUID')
+            if counts is None:
+                counts = count_by(bac, query, 'getSampleTypeUID',
+                                  request=self.request)
+            sampletypes = sc(portal_type="SampleType",
+                             sort_on='sortable_title')
+        with stage(self.request, 'rows'):
+            for sampletype in sampletypes:
+                check_cancelled(self.request)
+                count_analyses = counts.get(sampletype.UID, 0)
+
+                dataline = []
+                dataitem = {'value': sampletype.Title}
+                dataline.append(dataitem)
+                dataitem = {'value': count_analyses}
+
+                dataline.append(dataitem)
+
+                datalines.append(dataline)
+
+                count_all += count_analyses
 
         # footer data
         footlines = []
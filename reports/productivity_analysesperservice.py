@@ -7,6 +7,11 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import count_query
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.counting import count_by
+from bika.lims.browser.reports.servicetree import get_service_tree
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -27,7 +32,6 @@ class Report(BrowserView):
     def __call__(self):
         # get all the data into datalines
 
-        sc = getToolByName(self.context, 'bika_setup_catalog')
         bc = getToolByName(self.context, 'bika_analysis_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
         self.report_content = {}
@@ -100,29 +104,32 @@ class Report(BrowserView):
 
         datalines = []
         count_all = 0
-        for cat in sc(portal_type="AnalysisCategory",
-                      sort_on='sortable_title'):
-            dataline = [{'value': cat.Title,
-                         'class': 'category_heading',
-                         'colspan': 2}, ]
-            datalines.append(dataline)
-            for service in sc(portal_type="AnalysisService",
-                              getCategoryUID=cat.UID,
-                              sort_on='sortable_title'):
-                query['getServiceUID'] = service.UID
-                analyses = bc(query)
-                count_analyses = len(analyses)
-
-                dataline = []
-                dataitem = {'value': service.Title}
-                dataline.append(dataitem)
-                dataitem = {'value': count_analyses}
-
-                dataline.append(dataitem)
-
+        with stage(self.request, 'query'):
+            counts = count_query(query, 'getServiceUID')
+            if counts is None:
+                counts = count_by(bc, query, 'getServiceUID',
+                                  request=self.request)
+            tree = get_service_tree(self.context)
+        with stage(self.request, 'rows'):
+            for cat, cat_services in tree:
+                dataline = [{'value': cat.Title,
+                             'class': 'category_heading',
+                             'colspan': 2}, ]
                 datalines.append(dataline)
+                for service in cat_services:
+                    check_cancelled(self.request)
+                    count_analyses = counts.get(service.UID, 0)
+
+                    dataline = []
+                    dataitem = {'value': service.Title}
+                    dataline.append(dataitem)
+                    dataitem = {'value': count_analyses}
+
+                    dataline.append(dataitem)
+
+                    datalines.append(dataline)
 
-                count_all += count_analyses
+                    count_all += count_analyses
 
         # footer data
         footlines = []
@@ -5,8 +5,29 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import time
+
+from DateTime import DateTime
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.aggregates import get_date_range
+from bika.lims.browser.reports.aggregates import to_day
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.daycache import DayCache
+from bika.lims.browser.reports.daycache import date_query
+from bika.lims.browser.reports.daycache import merge_counts
+from bika.lims.browser.reports.daycache import merge_days
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.shards import aggregate
+from bika.lims.browser.reports.servicetree import get_service_tree
+from bika.lims.browser.reports.snapshot import from_local_day
+from bika.lims.browser.reports.snapshot import get_snapshot_store
+from bika.lims.browser.reports.snapshot import to_local_days
+from bika.lims.browser.reports.tat import PERCENTILES
+from bika.lims.browser.reports.tat import TDigest
+from bika.lims.browser.reports.tat import get_duration
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -15,6 +36,193 @@ from bika.lims.utils import formatDateQuery, formatDateParms, formatDuration, \
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+try:
+    import numpy
+except ImportError:
+    # Only needed to read the snapshot, see snapshot.py
+    numpy = None
+
+# Columns read from the analysis brains
+COLUMNS = (
+    Column("getServiceUID"),
+    Column("getDueDate"),
+    Column("getResultCaptureDate"),
+    Column("getDateReceived"),
+    Column("getDateVerified"),
+)
+
+# Version of the partial aggregates cached per day
+CACHE_VERSION = 2
+
+
+def get_earliness(analysis):
+    """Returns the minutes between the due date and the result capture date
+    of the analysis row, as Analysis.getEarliness does
+    """
+    due_date = analysis["getDueDate"]
+    if not due_date:
+        return 0
+    end = analysis["getResultCaptureDate"] or DateTime()
+    return int(round((due_date - end) * 24 * 60))
+
+
+def map_daily_services(context, request, query, date_from, date_to):
+    """Returns a dict of day created -> get_services of the analyses of the
+    query created that day, for the days from date_from to date_to. Mapper
+    of the sharded aggregation, see shards.py
+    """
+    dates = date_query(date_from, date_to)
+    if dates is not None:
+        query = dict(query, created=dates)
+    snapshot = get_snapshot_store().get_fresh(request)
+    with stage(request, 'query'):
+        mask = snapshot and snapshot.select(query)
+    if mask is None:
+        bc = getToolByName(context, 'bika_analysis_catalog')
+        with stage(request, 'query'):
+            results = bc(query)
+        with stage(request, 'rows'):
+            analyses = {}
+            for analysis in results:
+                day = to_day(analysis.created)
+                analyses.setdefault(day, []).append(analysis)
+            return dict((day, get_services(request, brains))
+                        for day, brains in analyses.items())
+
+    with stage(request, 'rows'):
+        created = snapshot.column("created")
+        days = numpy.full(len(created), -1, dtype="i8")
+        days[mask] = to_local_days(created[mask])
+        services = {}
+        for day in numpy.unique(days[mask]):
+            services[to_day(from_local_day(day))] = \
+                get_services_from_snapshot(snapshot, days == day)
+    return services
+
+
+
+def get_services(request, analyses):
+    """Returns a dict of service UID -> number of early, late and undefined
+    analyses, minutes early and late and the sketch of the turnaround times
+    (see tat.py), from the analysis brains passed in
+    """
+    services = {}
+    durations = {}
+    extractor = RowExtractor(request, COLUMNS)
+    for a in analyses:
+        check_cancelled(request)
+        analysis = extractor.extract(a)
+        service_uid = analysis['getServiceUID']
+        duration = get_duration(analysis['getDateReceived'],
+                                analysis['getDateVerified'])
+        if duration is not None:
+            durations.setdefault(service_uid, []).append(duration)
+        if service_uid not in services:
+            services[service_uid] = {'count_early': 0,
+                                     'count_late': 0,
+                                     'mins_early': 0,
+                                     'mins_late': 0,
+                                     'count_undefined': 0,
+            }
+        earliness = get_earliness(analysis)
+        if earliness < 0:
+            count_late = services[service_uid]['count_late']
+            mins_late = services[service_uid]['mins_late']
+            count_late += 1
+            mins_late -= earliness
+            services[service_uid]['count_late'] = count_late
+            services[service_uid]['mins_late'] = mins_late
+        if earliness > 0:
+            count_early = services[service_uid]['count_early']
+            mins_early = services[service_uid]['mins_early']
+            count_early += 1
+            mins_early += earliness
+            services[service_uid]['count_early'] = count_early
+            services[service_uid]['mins_early'] = mins_early
+        if earliness == 0:
+            count_undefined = services[service_uid]['count_undefined']
+            count_undefined += 1
+            services[service_uid]['count_undefined'] = count_undefined
+    extractor.finish()
+
+    # sketch of the turnaround times of each service
+    for service_uid, values in durations.items():
+        digest = TDigest()
+        digest.update(values)
+        services[service_uid]['tat'] = digest.to_json()
+    return services
+
+def get_services_from_snapshot(snapshot, mask):
+    """Returns the same dict as get_services, computed from the rows of the
+    snapshot in the mask
+    """
+    due = snapshot.column("due")[mask]
+    captured = snapshot.column("captured")[mask]
+    end = numpy.where(numpy.isnan(captured), time.time(), captured)
+    earliness = numpy.where(numpy.isnan(due), 0,
+                            numpy.round((due - end) / 60))
+    early = earliness > 0
+    late = earliness < 0
+    sums = {
+        'count_early': snapshot.sum_by("service", mask, early),
+        'count_late': snapshot.sum_by("service", mask, late),
+        'count_undefined': snapshot.sum_by("service", mask,
+                                           earliness == 0),
+        'mins_early': snapshot.sum_by("service", mask,
+                                      numpy.where(early, earliness, 0)),
+        'mins_late': snapshot.sum_by("service", mask,
+                                     numpy.where(late, -earliness, 0)),
+    }
+    services = {}
+    for key, values in sums.items():
+        for service_uid, value in values.items():
+            services.setdefault(service_uid, {})[key] = int(value)
+
+    # sketch of the turnaround times of each service, from the number of
+    # analyses of each duration in minutes
+    codes = snapshot.column("service")[mask]
+    received = snapshot.column("received")[mask]
+    verified = snapshot.column("verified")[mask]
+    end = numpy.where(numpy.isnan(verified), time.time(), verified)
+    durations = numpy.round((end - received) / 60)
+    valid = ~numpy.isnan(received)
+    for code in numpy.unique(codes[valid]):
+        values, weights = numpy.unique(durations[valid & (codes == code)],
+                                       return_counts=True)
+        digest = TDigest()
+        digest.update(values.tolist(), weights.tolist())
+        service_uid = snapshot.get_value("service", code)
+        services[service_uid]['tat'] = digest.to_json()
+    return services
+
+
+def merge_services(total, partial):
+    """Adds the counts and turnaround times of the services of partial to
+    the ones of total. The turnaround times of total are TDigest objects
+    """
+    for service_uid, counts in partial.items():
+        counts = dict(counts)
+        tat = counts.pop('tat', None)
+        service = total.setdefault(service_uid, {})
+        merge_counts(service, counts)
+        digest = service.setdefault('tat', TDigest())
+        digest.merge(TDigest.from_json(tat))
+    return total
+
+
+def get_percentiles(context, digest):
+    """Returns the formatted percentiles of the turnaround times of the
+    digest, or empty strings if it is empty
+    """
+    values = []
+    for percentile in PERCENTILES:
+        value = digest.quantile(percentile)
+        if value is None:
+            values.append('')
+        else:
+            values.append(formatDuration(context, int(round(value))))
+    return values
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -27,8 +235,6 @@ class Report(BrowserView):
     def __call__(self):
         # get all the data into datalines
 
-        sc = getToolByName(self.context, 'bika_setup_catalog')
-        bc = getToolByName(self.context, 'bika_analysis_catalog')
         rc = getToolByName(self.context, 'reference_catalog')
         self.report_content = {}
         parms = []
@@ -75,44 +281,31 @@ class Report(BrowserView):
                 {'title': _('Assigned to worksheet'), 'value': ws_review_state,
                  'type': 'text'})
 
-        # query all the analyses and increment the counts
-        count_early = 0
-        mins_early = 0
-        count_late = 0
-        mins_late = 0
-        count_undefined = 0
+        # query all the analyses and increment the counts, combining the
+        # counts per day created cached for the closed days
+        date_range = get_date_range(query.get('created', None))
+        if date_range is None:
+            date_from, date_to = None, None
+            criteria = query
+        else:
+            date_from, date_to = date_range
+            criteria = dict((key, value) for key, value in query.items()
+                            if key != 'created')
+        # Reading the snapshot is fast already, the aggregation is only
+        # sharded when the catalog is walked
+        snapshot = get_snapshot_store().get_snapshot()
+        shards = None
+        if snapshot is not None and snapshot.select(query) is not None:
+            shards = 1
+        day_cache = DayCache('productivity_analysestats', criteria, 'created',
+                             version=CACHE_VERSION)
         services = {}
-
-        analyses = bc(query)
-        for a in analyses:
-            analysis = a.getObject()
-            service_uid = analysis.getServiceUID()
-            if service_uid not in services:
-                services[service_uid] = {'count_early': 0,
-                                         'count_late': 0,
-                                         'mins_early': 0,
-                                         'mins_late': 0,
-                                         'count_undefined': 0,
-                }
-            earliness = analysis.getEarliness()
-            if earliness < 0:
-                count_late = services[service_uid]['count_late']
-                mins_late = services[service_uid]['mins_late']
-                count_late += 1
-                mins_late -= earliness
-                services[service_uid]['count_late'] = count_late
-                services[service_uid]['mins_late'] = mins_late
-            if earliness > 0:
-                count_early = services[service_uid]['count_early']
-                mins_early = services[service_uid]['mins_early']
-                count_early += 1
-                mins_early += earliness
-                services[service_uid]['count_early'] = count_early
-                services[service_uid]['mins_early'] = mins_early
-            if earliness == 0:
-                count_undefined = services[service_uid]['count_undefined']
-                count_undefined += 1
-                services[service_uid]['count_undefined'] = count_undefined
+        for partial in day_cache.get_partials(
+                date_from, date_to,
+                lambda start, end: aggregate(
+                    self.context, self.request, map_daily_services, criteria,
+                    start, end, merge=merge_days, shards=shards)):
+            merge_services(services, partial)
 
         # calculate averages
         for service_uid in services.keys():
@@ -134,7 +327,7 @@ class Report(BrowserView):
                                                                    avemins)
 
         # and now lets do the actual report lines
-        formats = {'columns': 7,
+        formats = {'columns': 10,
                    'col_heads': [_('Analysis'),
                                  _('Count'),
                                  _('Undefined'),
@@ -142,6 +335,9 @@ class Report(BrowserView):
                                  _('Average late'),
                                  _('Early'),
                                  _('Average early'),
+                                 _('TAT p50'),
+                                 _('TAT p90'),
+                                 _('TAT p95'),
                    ],
                    'class': '',
         }
@@ -151,22 +347,22 @@ class Report(BrowserView):
         total_mins_early = 0
         total_mins_late = 0
         total_count_undefined = 0
+        total_tat = TDigest()
         datalines = []
 
-        for cat in sc(portal_type='AnalysisCategory',
-                      sort_on='sortable_title'):
+        for cat, cat_services in get_service_tree(self.context):
             catline = [{'value': cat.Title,
                         'class': 'category_heading',
-                        'colspan': 7}, ]
+                        'colspan': 10}, ]
             first_time = True
             cat_count_early = 0
             cat_count_late = 0
             cat_count_undefined = 0
             cat_mins_early = 0
             cat_mins_late = 0
-            for service in sc(portal_type="AnalysisService",
-                              getCategoryUID=cat.UID,
-                              sort_on='sortable_title'):
+            cat_tat = TDigest()
+            for service in cat_services:
+                check_cancelled(self.request)
 
                 dataline = [{'value': service.Title,
                              'class': 'testgreen'}, ]
@@ -183,6 +379,7 @@ class Report(BrowserView):
                 cat_count_undefined += services[service.UID]['count_undefined']
                 cat_mins_early += services[service.UID]['mins_early']
                 cat_mins_late += services[service.UID]['mins_late']
+                cat_tat.merge(services[service.UID]['tat'])
 
                 count = services[service.UID]['count_early'] + \
                         services[service.UID]['count_late'] + \
@@ -201,6 +398,10 @@ class Report(BrowserView):
                                  'class': 'number'})
                 dataline.append({'value': services[service.UID]['ave_early'],
                                  'class': 'number'})
+                for value in get_percentiles(self.context,
+                                             services[service.UID]['tat']):
+                    dataline.append({'value': value,
+                                     'class': 'number'})
 
                 datalines.append(dataline)
 
@@ -240,11 +441,16 @@ class Report(BrowserView):
 
             dataline.append(dataitem)
 
+            for value in get_percentiles(self.context, cat_tat):
+                dataline.append({'value': value,
+                                 'class': 'subtotal_number'})
+
             total_count_early += cat_count_early
             total_count_late += cat_count_late
             total_count_undefined += cat_count_undefined
             total_mins_early += cat_mins_early
             total_mins_late += cat_mins_late
+            total_tat.merge(cat_tat)
 
         # footer data
         footlines = []
@@ -281,6 +487,10 @@ class Report(BrowserView):
             footline.append({'value': '',
                              'class': 'total number'})
 
+        for value in get_percentiles(self.context, total_tat):
+            footline.append({'value': value,
+                             'class': 'total number'})
+
         footlines.append(footline)
 
         self.report_content = {
@@ -303,6 +513,9 @@ class Report(BrowserView):
                 'Average late',
                 'Early',
                 'Average early',
+                'TAT p50',
+                'TAT p90',
+                'TAT p95',
             ]
             output = StringIO.StringIO()
             dw = csv.DictWriter(output, extrasaction='ignore',
@@ -320,6 +533,9 @@ class Report(BrowserView):
                     'Average late': row[4]['value'],
                     'Early': row[5]['value'],
                     'Average early': row[6]['value'],
+                    'TAT p50': row[7]['value'],
+                    'TAT p90': row[8]['value'],
+                    'TAT p95': row[9]['value'],
                 })
             report_data = output.getvalue()
             output.close()
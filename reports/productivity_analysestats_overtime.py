@@ -5,8 +5,20 @@
 # Copyright 2018 by it's authors.
 # Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
 
+import time
+
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.snapshot import get_snapshot_store
+from bika.lims.browser.reports.snapshot import to_local_days
+from bika.lims.browser.reports.tat import get_duration
+from bika.lims.browser.reports.timeseries import PERIODS
+from bika.lims.browser.reports.timeseries import get_series
+from bika.lims.browser.reports.timeseries import to_local_day
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -14,6 +26,18 @@ from bika.lims.utils import formatDateQuery, formatDateParms, formatDuration
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+try:
+    import numpy
+except ImportError:
+    # Only needed to read the snapshot, see snapshot.py
+    numpy = None
+
+# Columns read from the analysis brains
+COLUMNS = (
+    Column("getDateReceived"),
+    Column("getDateVerified"),
+)
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -66,9 +90,8 @@ class Report(BrowserView):
                  'value': instrument_title,
                  'type': 'text'})
 
-        if 'Period' in self.request.form:
-            period = self.request.form['Period']
-        else:
+        period = self.request.form.get('Period', 'Day')
+        if period not in PERIODS:
             period = 'Day'
 
         date_query = formatDateQuery(self.context, 'tats_DateReceived')
@@ -82,69 +105,50 @@ class Report(BrowserView):
 
         query['review_state'] = 'published'
 
-        # query all the analyses and increment the counts
-
-        periods = {}
-        total_count = 0
-        total_duration = 0
-
-        analyses = bc(query)
-        for a in analyses:
-            analysis = a.getObject()
-            received = analysis.created()
-            if period == 'Day':
-                datekey = received.strftime('%d %b %Y')
-            elif period == 'Week':
-                # key period on Monday
-                dayofweek = received.strftime('%w')  # Sunday = 0
-                if dayofweek == 0:
-                    firstday = received - 6
-                else:
-                    firstday = received - (int(dayofweek) - 1)
-                datekey = firstday.strftime(self.date_format_short)
-            elif period == 'Month':
-                datekey = received.strftime('%m-%d')
-            if datekey not in periods:
-                periods[datekey] = {'count': 0,
-                                    'duration': 0,
-                }
-            count = periods[datekey]['count']
-            duration = periods[datekey]['duration']
-            count += 1
-            duration += analysis.getDuration()
-            periods[datekey]['duration'] = duration
-            periods[datekey]['count'] = count
-            total_count += 1
-            total_duration += duration
-
-        # calculate averages
-        for datekey in periods.keys():
-            count = periods[datekey]['count']
-            duration = periods[datekey]['duration']
-            ave_duration = (duration) / count
-            periods[datekey]['duration'] = \
-                formatDuration(self.context, ave_duration)
+        # query all the analyses and bucket their turnaround times
+        snapshot = get_snapshot_store().get_fresh(self.request)
+        with stage(self.request, 'query'):
+            mask = snapshot and snapshot.select(query)
+            if mask is None:
+                analyses = bc(query)
+        with stage(self.request, 'rows'):
+            if mask is None:
+                days, durations = self.get_durations(analyses)
+            else:
+                days, durations = self.get_durations_from_snapshot(snapshot,
+                                                                   mask)
+            points = get_series(days, durations, period)[None][None]
+        total_count = sum([point['count'] for point in points])
+        total_duration = sum([point['mean'] * point['count']
+                              for point in points])
 
         # and now lets do the actual report lines
-        formats = {'columns': 2,
+        formats = {'columns': 4,
                    'col_heads': [_('Date'),
+                                 _('Number of analyses'),
                                  _('Turnaround time (h)'),
+                                 _('Turnaround time p90 (h)'),
                    ],
                    'class': '',
         }
 
         datalines = []
 
-        period_keys = periods.keys()
-        for period in period_keys:
-            dataline = [{'value': period,
+        for point in points:
+            dataline = [{'value': point['label'],
                          'class': ''}, ]
-            dataline.append({'value': periods[period]['duration'],
+            dataline.append({'value': point['count'],
+                             'class': 'number'})
+            dataline.append({'value': formatDuration(
+                self.context, int(round(point['mean']))),
+                             'class': 'number'})
+            dataline.append({'value': formatDuration(
+                self.context, int(round(point['percentiles'][1]))),
                              'class': 'number'})
             datalines.append(dataline)
 
         if total_count > 0:
-            ave_total_duration = total_duration / total_count
+            ave_total_duration = int(round(total_duration / total_count))
         else:
             ave_total_duration = 0
         ave_total_duration = formatDuration(self.context, ave_total_duration)
@@ -180,7 +184,9 @@ class Report(BrowserView):
 
             fieldnames = [
                 'Date',
+                'Number of analyses',
                 'Turnaround time (h)',
+                'Turnaround time p90 (h)',
             ]
             output = StringIO.StringIO()
             dw = csv.DictWriter(output, extrasaction='ignore',
@@ -189,7 +195,9 @@ class Report(BrowserView):
             for row in datalines:
                 dw.writerow({
                     'Date': row[0]['value'],
-                    'Turnaround time (h)': row[1]['value'],
+                    'Number of analyses': row[1]['value'],
+                    'Turnaround time (h)': row[2]['value'],
+                    'Turnaround time p90 (h)': row[3]['value'],
                 })
             report_data = output.getvalue()
             output.close()
@@ -202,3 +210,36 @@ class Report(BrowserView):
         else:
             return {'report_title': t(headings['header']),
                     'report_data': self.template()}
+
+    def get_durations(self, analyses):
+        """Returns the local days the analysis brains passed in were received
+        and their durations in minutes. The duration of an analysis is the
+        time from its reception to its verification (or now), as
+        Analysis.getDuration computes it
+        """
+        days = []
+        durations = []
+        extractor = RowExtractor(self.request, COLUMNS)
+        for a in analyses:
+            check_cancelled(self.request)
+            analysis = extractor.extract(a)
+            received = analysis['getDateReceived']
+            duration = get_duration(received, analysis['getDateVerified'])
+            if duration is None:
+                continue
+            days.append(to_local_day(received))
+            durations.append(duration)
+        extractor.finish()
+        return days, durations
+
+    def get_durations_from_snapshot(self, snapshot, mask):
+        """Returns the same days and durations as get_durations, as arrays
+        computed from the rows of the snapshot in the mask
+        """
+        received = snapshot.column("received")[mask]
+        verified = snapshot.column("verified")[mask]
+        valid = ~numpy.isnan(received)
+        received = received[valid]
+        verified = verified[valid]
+        end = numpy.where(numpy.isnan(verified), time.time(), verified)
+        return to_local_days(received), numpy.round((end - received) / 60)
@@ -8,10 +8,31 @@
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.streaming import stream_csv
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the sample brains
+SAMPLE_COLUMNS = (
+    Column("getSampleID"),
+    Column("getSampleTypeTitle",
+           accessor=lambda sample: sample.getSampleType().Title()),
+    Column("getDateReceived"),
+    Column("getDateSampled"),
+    Column("getSamplingDate"),
+)
+
+# Columns read from the analysis brains
+ANALYSIS_COLUMNS = (
+    Column("getKeyword"),
+    Column("Title"),
+)
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -43,42 +64,35 @@ class Report(BrowserView):
             titles.append(val['titles'])
 
         # Query the catalog and store results in a dictionary
-        samples = self.bika_catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            samples = self.bika_catalog(self.contentFilter)
         if not samples:
             message = _("No samples matched your query")
             self.context.plone_utils.addPortalMessage(message, "error")
             return self.default_template()
 
-        datalines = []
-        analyses_count = 0
-        for sample in samples:
-            sample = sample.getObject()
+        if self.request.get('output_format', '') == 'CSV':
+            fieldnames = [
+                'SampleID',
+                'SampleType',
+                'DateSampled',
+                'DateReceived',
+                'AnalysisTitle',
+                'AnalysisKeyword',
+            ]
+            if self.context.bika_setup.getSamplingWorkflowEnabled():
+                fieldnames.append('SamplingDate')
+            self.rows_streamed = stream_csv(self.request,
+                                            'dailysamplesreceived', fieldnames,
+                                            self.get_datalines(samples))
+            return
 
-            # For each sample, retrieve the analyses and generate
-            # a data line for each one
-            analyses = sample.getAnalyses({})
-            for analysis in analyses:
-                analysis = analysis.getObject()
-                ds = sample.getDateSampled()
-                sd = sample.getSamplingDate()
-                dataline = {'AnalysisKeyword': analysis.getKeyword(),
-                            'AnalysisTitle': analysis.Title(),
-                            'SampleID': sample.getSampleID(),
-                            'SampleType': sample.getSampleType().Title(),
-                            'DateReceived': self.ulocalized_time(
-                                sample.getDateReceived(), long_format=1),
-                            'DateSampled': self.ulocalized_time(
-                                ds, long_format=1),
-                            }
-                if self.context.bika_setup.getSamplingWorkflowEnabled():
-                    dataline['SamplingDate']= self.ulocalized_time(
-                                              sd, long_format=1)
-                datalines.append(dataline)
-                analyses_count += 1
+        with stage(self.request, 'rows'):
+            datalines = list(self.get_datalines(samples))
 
         # Footer total data
         footlines = []
-        footline = {'TotalCount': analyses_count}
+        footline = {'TotalCount': len(datalines)}
         footlines.append(footline)
 
         self.report_data = {
@@ -86,34 +100,38 @@ class Report(BrowserView):
             'datalines': datalines,
             'footlines': footlines}
 
-        if self.request.get('output_format', '') == 'CSV':
-            import csv
-            import StringIO
-            import datetime
+        return {'report_title': _('Daily samples received'),
+                'report_data': self.template()}
 
-            fieldnames = [
-                'SampleID',
-                'SampleType',
-                'DateSampled',
-                'DateReceived',
-                'AnalysisTitle',
-                'AnalysisKeyword',
-            ]
-            if self.context.bika_setup.getSamplingWorkflowEnabled():
-                fieldnames.append('SamplingDate')
-            output = StringIO.StringIO()
-            dw = csv.DictWriter(output, fieldnames=fieldnames)
-            dw.writerow(dict((fn, fn) for fn in fieldnames))
-            for row in datalines:
-                dw.writerow(row)
-            report_data = output.getvalue()
-            output.close()
-            date = datetime.datetime.now().strftime("%Y%m%d%H%M")
-            setheader = self.request.RESPONSE.setHeader
-            setheader('Content-Type', 'text/csv')
-            setheader("Content-Disposition",
-                      "attachment;filename=\"dailysamplesreceived_%s.csv\"" % date)
-            self.request.RESPONSE.write(report_data)
-        else:
-            return {'report_title': _('Daily samples received'),
-                    'report_data': self.template()}
+    def get_datalines(self, samples):
+        """Generates a data line for each analysis of the samples passed in
+        """
+        sampling_enabled = self.context.bika_setup.getSamplingWorkflowEnabled()
+        sample_extractor = RowExtractor(self.request, SAMPLE_COLUMNS)
+        analysis_extractor = RowExtractor(self.request, ANALYSIS_COLUMNS)
+        for sample in samples:
+            sample = sample_extractor.extract(sample)
+
+            # For each sample, retrieve the analyses and generate
+            # a data line for each one
+            analyses = sample.get_object('analyses').getAnalyses({})
+            for analysis in analyses:
+                check_cancelled(self.request)
+                analysis = analysis_extractor.extract(analysis)
+                ds = sample['getDateSampled']
+                sd = sample['getSamplingDate']
+                dataline = {'AnalysisKeyword': analysis['getKeyword'],
+                            'AnalysisTitle': analysis['Title'],
+                            'SampleID': sample['getSampleID'],
+                            'SampleType': sample['getSampleTypeTitle'],
+                            'DateReceived': self.ulocalized_time(
+                                sample['getDateReceived'], long_format=1),
+                            'DateSampled': self.ulocalized_time(
+                                ds, long_format=1),
+                            }
+                if sampling_enabled:
+                    dataline['SamplingDate']= self.ulocalized_time(
+                                              sd, long_format=1)
+                yield dataline
+        sample_extractor.finish()
+        analysis_extractor.finish()
@@ -10,7 +10,13 @@ from bika.lims.workflow import getTransitionDate
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import MISSING
+from bika.lims.browser.reports.extract import RowExtractor
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.streaming import stream_csv
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
@@ -18,6 +24,40 @@ from Products.CMFCore.utils import getToolByName
 from bika.lims import logger
 
 
+def get_batch_id(ar):
+    batch = ar.getBatch()
+    return batch and batch.getId() or ''
+
+
+def count_analyses(analyses_num):
+    """Returns the total number of analyses from the getAnalysesNum metadata
+    ([verified, total, not submitted, to be verified])
+    """
+    if isinstance(analyses_num, (list, tuple)) and len(analyses_num) > 1:
+        return analyses_num[1]
+    return MISSING
+
+
+# Columns read from the Analysis Request brains
+COLUMNS = (
+    Column("getId"),
+    Column("created"),
+    Column("getDateReceived"),
+    Column("DatePublished", metadata="getDatePublished",
+           accessor=lambda ar: getTransitionDate(ar, 'publish')),
+    Column("BatchID", metadata="getBatchID", accessor=get_batch_id),
+    Column("SampleID", metadata="getSampleID",
+           accessor=lambda ar: ar.getSample().Title()),
+    Column("getSampleTypeTitle"),
+    Column("NumAnalyses", metadata="getAnalysesNum", convert=count_analyses,
+           accessor=lambda ar: len(ar.getAnalyses())),
+    Column("ClientID", metadata="getClientID",
+           accessor=lambda ar: ar.aq_parent.id),
+    Column("Creator"),
+    Column("getRemarks"),
+)
+
+
 class Report(BrowserView):
     implements(IViewView)
     default_template = ViewPageTemplateFile("templates/productivity.pt")
@@ -45,7 +85,8 @@ class Report(BrowserView):
 
         # Query the catalog and store results in a dictionary
         catalog = getToolByName(self.context, CATALOG_ANALYSIS_REQUEST_LISTING)
-        ars = catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            ars = catalog(self.contentFilter)
 
         logger.info("Catalog Query '{}' returned {} results".format(
             self.contentFilter, len(ars)))
@@ -55,48 +96,40 @@ class Report(BrowserView):
             self.context.plone_utils.addPortalMessage(message, "error")
             return self.default_template()
 
+        if self.request.get('output_format', '') == 'CSV':
+            fieldnames = [
+                "AnalysisRequestID",
+                "DateCreated",
+                "DateReceived",
+                "DatePublished",
+                "ReceptionLag",
+                "PublicationLag",
+                "TotalLag",
+                "BatchID",
+                "SampleID",
+                "SampleType",
+                "NumAnalyses",
+                "ClientID",
+                "Creator",
+                "Remarks",
+            ]
+            self.rows_streamed = stream_csv(self.request, 'dataentrydaybook',
+                                            fieldnames,
+                                            self.get_datalines(ars, {}))
+            return
+
         datalines = {}
         footlines = {}
+        totals = {}
+        with stage(self.request, 'rows'):
+            for dataline in self.get_datalines(ars, totals):
+                datalines[dataline['AnalysisRequestID']] = dataline
         totalcreatedcount = len(ars)
-        totalreceivedcount = 0
-        totalpublishedcount = 0
-        totalanlcount = 0
-        totalreceptionlag = 0
-        totalpublicationlag = 0
-
-        for ar in ars:
-            ar = ar.getObject()
-            datecreated = ar.created()
-            datereceived = ar.getDateReceived()
-            datepublished = getTransitionDate(ar, 'publish')
-            receptionlag = 0
-            publicationlag = 0
-            anlcount = len(ar.getAnalyses())
-
-            dataline = {
-                "AnalysisRequestID": ar.getId(),
-                "DateCreated": self.ulocalized_time(datecreated),
-                "DateReceived": self.ulocalized_time(datereceived),
-                "DatePublished": self.ulocalized_time(datepublished),
-                "ReceptionLag": receptionlag,
-                "PublicationLag": publicationlag,
-                "TotalLag": receptionlag + publicationlag,
-                "BatchID": ar.getBatch().getId() if ar.getBatch() else '',
-                "SampleID": ar.getSample().Title(),
-                "SampleType": ar.getSampleTypeTitle(),
-                "NumAnalyses": anlcount,
-                "ClientID": ar.aq_parent.id,
-                "Creator": ar.Creator(),
-                "Remarks": ar.getRemarks()
-            }
-
-            datalines[ar.getId()] = dataline
-
-            totalreceivedcount += ar.getDateReceived() and 1 or 0
-            totalpublishedcount += 1 if datepublished else 0
-            totalanlcount += anlcount
-            totalreceptionlag += receptionlag
-            totalpublicationlag += publicationlag
+        totalreceivedcount = totals['received']
+        totalpublishedcount = totals['published']
+        totalanlcount = totals['analyses']
+        totalreceptionlag = totals['receptionlag']
+        totalpublicationlag = totals['publicationlag']
 
         # Footer total data
         totalreceivedcreated_ratio = float(totalreceivedcount) / float(
@@ -133,56 +166,50 @@ class Report(BrowserView):
                             'datalines': datalines,
                             'footlines': footlines}
 
-        if self.request.get('output_format', '') == 'CSV':
-            import csv
-            import StringIO
-            import datetime
+        return {'report_title': _('Data entry day book'),
+                'report_data': self.template()}
+
+    def get_datalines(self, ars, totals):
+        """Generates the data line of each Analysis Request brain passed in,
+        adding up the totals of the report in the totals dict
+        """
+        totals.update({'received': 0,
+                       'published': 0,
+                       'analyses': 0,
+                       'receptionlag': 0,
+                       'publicationlag': 0})
+        extractor = RowExtractor(self.request, COLUMNS)
+        for ar in ars:
+            check_cancelled(self.request)
+            ar = extractor.extract(ar)
+            datecreated = ar['created']
+            datereceived = ar['getDateReceived']
+            datepublished = ar['DatePublished']
+            receptionlag = 0
+            publicationlag = 0
+            anlcount = ar['NumAnalyses']
 
-            fieldnames = [
-                "AnalysisRequestID",
-                "DateCreated",
-                "DateReceived",
-                "DatePublished",
-                "ReceptionLag",
-                "PublicationLag",
-                "TotalLag",
-                "BatchID",
-                "SampleID",
-                "SampleType",
-                "NumAnalyses",
-                "ClientID",
-                "Creator",
-                "Remarks",
-            ]
-            output = StringIO.StringIO()
-            dw = csv.DictWriter(output, extrasaction='ignore',
-                                fieldnames=fieldnames)
-            dw.writerow(dict((fn, fn) for fn in fieldnames))
-            for ar_id, row in datalines.items():
-                dw.writerow({
-                    "AnalysisRequestID": row["AnalysisRequestID"],
-                    "DateCreated": row["DateCreated"],
-                    "DateReceived": row["DateReceived"],
-                    "DatePublished": row["DatePublished"],
-                    "ReceptionLag": row["ReceptionLag"],
-                    "PublicationLag": row["PublicationLag"],
-                    "TotalLag": row["TotalLag"],
-                    "BatchID": row["BatchID"],
-                    "SampleID": row["SampleID"],
-                    "SampleType": row["SampleType"],
-                    "NumAnalyses": row["NumAnalyses"],
-                    "ClientID": row["ClientID"],
-                    "Creator": row["Creator"],
-                    "Remarks": row["Remarks"],
-                })
-            report_data = output.getvalue()
-            output.close()
-            date = datetime.datetime.now().strftime("%Y%m%d%H%M")
-            setheader = self.request.RESPONSE.setHeader
-            setheader('Content-Type', 'text/csv')
-            setheader("Content-Disposition",
-                      "attachment;filename=\"dataentrydaybook_%s.csv\"" % date)
-            self.request.RESPONSE.write(report_data)
-        else:
-            return {'report_title': _('Data entry day book'),
-                    'report_data': self.template()}
+            dataline = {
+                "AnalysisRequestID": ar['getId'],
+                "DateCreated": self.ulocalized_time(datecreated),
+                "DateReceived": self.ulocalized_time(datereceived),
+                "DatePublished": self.ulocalized_time(datepublished),
+                "ReceptionLag": receptionlag,
+                "PublicationLag": publicationlag,
+                "TotalLag": receptionlag + publicationlag,
+                "BatchID": ar.get('BatchID', ''),
+                "SampleID": ar['SampleID'],
+                "SampleType": ar['getSampleTypeTitle'],
+                "NumAnalyses": anlcount,
+                "ClientID": ar['ClientID'],
+                "Creator": ar['Creator'],
+                "Remarks": ar['getRemarks']
+            }
+            yield dataline
+
+            totals['received'] += datereceived and 1 or 0
+            totals['published'] += 1 if datepublished else 0
+            totals['analyses'] += anlcount
+            totals['receptionlag'] += receptionlag
+            totals['publicationlag'] += publicationlag
+        extractor.finish()
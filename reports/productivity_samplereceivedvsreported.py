@@ -8,7 +8,9 @@
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
@@ -47,7 +49,8 @@ class Report(BrowserView):
             titles.append(val['titles'])
 
         # Query the catalog and store results in a dictionary
-        samples = self.bika_catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            samples = self.bika_catalog(self.contentFilter)
         if not samples:
             message = _("No samples matched your query")
             self.context.plone_utils.addPortalMessage(message, "error")
@@ -57,39 +60,42 @@ class Report(BrowserView):
         footlines = {}
         total_received_count = 0
         total_published_count = 0
-        for sample in samples:
-            sample = sample.getObject()
-
-            # Check if the sample has at least one Analysis Request published
-            published = False
-            for ar in sample.getAnalysisRequests():
-                datepublished = ar.getDatePublished()
-                if datepublished:
-                    published = True
-                    break
-
-            datereceived = sample.getDateReceived()
-            monthyear = datereceived.strftime("%B") + " " + datereceived.strftime(
-                "%Y")
-            received = 1
-            publishedcnt = published and 1 or 0
-            if (monthyear in datalines):
-                received = datalines[monthyear]['ReceivedCount'] + 1
-                publishedcnt = published and datalines[monthyear][
-                                                 'PublishedCount'] + 1 or \
-                               datalines[monthyear]['PublishedCount']
-            ratio = publishedcnt / received
-            dataline = {'MonthYear': monthyear,
-                        'ReceivedCount': received,
-                        'PublishedCount': publishedcnt,
-                        'UnpublishedCount': received - publishedcnt,
-                        'Ratio': ratio,
-                        'RatioPercentage': '%02d' % (
-                        100 * (float(publishedcnt) / float(received))) + '%'}
-            datalines[monthyear] = dataline
-
-            total_received_count += 1
-            total_published_count = published and total_published_count + 1 or total_published_count
+        with stage(self.request, 'rows'):
+            for sample in samples:
+                sample = sample.getObject()
+
+                # Check if the sample has at least one Analysis Request published
+                published = False
+                for ar in sample.getAnalysisRequests():
+                    check_cancelled(self.request)
+                    datepublished = ar.getDatePublished()
+                    if datepublished:
+                        published = True
+                        break
+
+                datereceived = sample.getDateReceived()
+                monthyear = datereceived.strftime("%B") + " " + datereceived.strftime(
+                    "%Y")
+                received = 1
+                publishedcnt = published and 1 or 0
+                if (monthyear in datalines):
+                    received = datalines[monthyear]['ReceivedCount'] + 1
+                    publishedcnt = published and datalines[monthyear][
+                                                     'PublishedCount'] + 1 or \
+                                   datalines[monthyear]['PublishedCount']
+                ratio = publishedcnt / received
+                dataline = {'MonthYear': monthyear,
+                            'ReceivedCount': received,
+                            'PublishedCount': publishedcnt,
+                            'UnpublishedCount': received - publishedcnt,
+                            'Ratio': ratio,
+                            'RatioPercentage': '%02d' % (
+                            100 * (float(publishedcnt) / float(received))) + '%'}
+                datalines[monthyear] = dataline
+
+                total_received_count += 1
+                total_published_count = published and \
+                    total_published_count + 1 or total_published_count
 
         # Footer total data
         ratio = total_published_count / total_received_count
@@ -4,21 +4,69 @@ from collections import OrderedDict
 from DateTime import DateTime
 from bika.lims import api
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.daycache import date_query
+from bika.lims.browser.reports.daycache import merge_counts
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.resolver import BrainResolver
+from bika.lims.browser.reports.resolver import CATALOG_CLIENT
+from bika.lims.browser.reports.resolver import CATALOG_PATIENT_LISTING
+from bika.lims.browser.reports.shards import aggregate
+from bika.lims.browser.reports.snapshot import get_snapshot_store
+from bika.lims.browser.reports.timing import stage
 from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from openpyxl import load_workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from plone.app.layout.globals.interfaces import IViewView
-from plone.memoize import view as viewcache
 from zope.interface import implements
 from bika.lims import logger
 import calendar
 import datetime
 
+try:
+    import numpy
+except ImportError:
+    # Only needed to read the snapshot, see snapshot.py
+    numpy = None
+
 XLS_TEMPLATE = "ViralLoadStatistics.xlsx"
 SHEET_STATISTICS = "VIRAL LOAD STATISTICS"
 
+# Column mappings
+LAB_KEY = 'B'
+PROVINCE = 'C'
+DISTRICT = 'D'
+CLIENT_NAME = 'E'
+CLIENT_CODE = 'F'
+NUM_REJECTIONS = 'G'
+VL_L14_LEQ1000 = 'H'
+VL_L14_G1000 = 'I'
+VL_MALE_LEQ1000 = 'J'
+VL_MALE_G1000 = 'K'
+VL_FEMALE_LEQ1000 = 'L'
+VL_FEMALE_G1000 = 'M'
+VL_SUBTOTAL_LEQ1000 = 'N'
+VL_SUBTOTAL_G1000 = 'O'
+VL_UNK_LEQ1000 = 'P'
+VL_UNK_G1000 = 'Q'
+VL_TOTAL_LEQ1000 = 'R'
+VL_TOTAL_G1000 = 'S'
+VL_TOTAL_CLIENT = 'T'
+
+# Groups of patients of the snapshot path
+GROUP_UNKNOWN = 0
+GROUP_L14 = 1
+GROUP_MALE = 2
+GROUP_FEMALE = 3
+
+# Group of patients -> columns of the results <=1000 and >1000
+GROUP_COLUMNS = {
+    GROUP_UNKNOWN: (VL_UNK_LEQ1000, VL_UNK_G1000),
+    GROUP_L14: (VL_L14_LEQ1000, VL_L14_G1000),
+    GROUP_MALE: (VL_MALE_LEQ1000, VL_MALE_G1000),
+    GROUP_FEMALE: (VL_FEMALE_LEQ1000, VL_FEMALE_G1000),
+}
+
 def save_in_memory_and_return(wb):
     virtual_workbook = save_virtual_workbook(wb)
     return {'report_title': "Saving report",
@@ -26,6 +74,16 @@ def save_in_memory_and_return(wb):
             'report_data': virtual_workbook}
 
 
+def map_statistics(context, request, criteria, date_from, date_to):
+    """Returns the statistics rows of the analyses published from date_from
+    to date_to. Mapper of the sharded aggregation, see shards.py
+    """
+    report = Report(context, request)
+    query = dict(criteria, getDatePublished=date_query(date_from, date_to))
+    report.fill_statistics(query)
+    return report.cells
+
+
 class Report(BrowserView):
     implements(IViewView)
 
@@ -35,6 +93,7 @@ class Report(BrowserView):
         self.selection_macros = SelectionMacrosView(self.context, self.request)
         self.cells = dict()
         self.workbook = None
+        self.resolver = BrainResolver(batches=False)
 
     def __call__(self):
         year = int(self.request.form.get('year_viralloadstatistics', DateTime().year()))
@@ -70,13 +129,18 @@ class Report(BrowserView):
             'sort_on': 'getClientTitle',
             'sort_order': 'ascending'}
 
-        catalog = api.get_tool(CATALOG_ANALYSIS_LISTING)
-        for analysis_brain in catalog(query):
-            patient_brain = self.get_patient_brain(analysis_brain)
-            if not patient_brain:
-                continue
-
-            self.render_statistics_row(analysis_brain)
+        # Aggregate the statistics of the month, in shards if enabled.
+        # Reading the snapshot is fast already, the aggregation is only
+        # sharded when the catalog is walked
+        criteria = dict((key, value) for key, value in query.items()
+                        if key != 'getDatePublished')
+        snapshot = get_snapshot_store().get_snapshot()
+        shards = None
+        if snapshot is not None and snapshot.select(query) is not None:
+            shards = 1
+        self.cells = aggregate(self.context, self.request, map_statistics,
+                               criteria, date_from, date_to,
+                               merge=merge_counts, shards=shards)
 
         # Fill statistics sheet
         row_num_start = 6
@@ -105,8 +169,33 @@ class Report(BrowserView):
         # Save the file in memory
         return save_in_memory_and_return(self.workbook)
 
+    def fill_statistics(self, query):
+        """Fills the statistics rows with the analyses of the query
+        """
+        snapshot = get_snapshot_store().get_fresh(self.request)
+        with stage(self.request, 'query'):
+            mask = snapshot and snapshot.select(query)
+        if mask is not None:
+            with stage(self.request, 'rows'):
+                self.render_statistics_from_snapshot(snapshot, mask)
+            return
+
+        catalog = api.get_tool(CATALOG_ANALYSIS_LISTING)
+        with stage(self.request, 'query'):
+            brains = catalog(query)
+
+            # Fetch the ARs, clients and patients of all analyses at once
+            self.resolver.prefetch(brains)
+        with stage(self.request, 'rows'):
+            for analysis_brain in brains:
+                check_cancelled(self.request)
+                patient_brain = self.get_patient_brain(analysis_brain)
+                if not patient_brain:
+                    continue
+
+                self.render_statistics_row(analysis_brain)
+
     def render_statistics_row(self, analysis_brain):
-        lab = self.context.bika_setup.laboratory
         client_brain = self.get_client_brain(analysis_brain)
         if not client_brain:
             return
@@ -114,36 +203,7 @@ class Report(BrowserView):
         if not patient_brain:
             return
 
-        # Column mappings
-        LAB_KEY = 'B'
-        PROVINCE = 'C'
-        DISTRICT = 'D'
-        CLIENT_NAME = 'E'
-        CLIENT_CODE = 'F'
-        NUM_REJECTIONS = 'G'
-        VL_L14_LEQ1000 = 'H'
-        VL_L14_G1000 = 'I'
-        VL_MALE_LEQ1000 = 'J'
-        VL_MALE_G1000 = 'K'
-        VL_FEMALE_LEQ1000 = 'L'
-        VL_FEMALE_G1000 = 'M'
-        VL_SUBTOTAL_LEQ1000 = 'N'
-        VL_SUBTOTAL_G1000 = 'O'
-        VL_UNK_LEQ1000 = 'P'
-        VL_UNK_G1000 = 'Q'
-        VL_TOTAL_LEQ1000 = 'R'
-        VL_TOTAL_G1000 = 'S'
-        VL_TOTAL_CLIENT = 'T'
-
-        province_rows = self.cells.get(SHEET_STATISTICS, dict())
-        district_rows = province_rows.get(client_brain.getProvince, dict())
-        client_rows = district_rows.get(client_brain.getDistrict, dict())
-        row = client_rows.get(client_brain.UID, dict())
-        row[LAB_KEY] = lab.getTaxNumber()
-        row[PROVINCE] = client_brain.getProvince
-        row[DISTRICT] = client_brain.getDistrict
-        row[CLIENT_NAME] = client_brain.Title
-        row[CLIENT_CODE] = client_brain.id
+        row = self.get_row(client_brain)
 
         result = self.to_float(analysis_brain.getResult)
         if result is None:
@@ -215,11 +275,122 @@ class Report(BrowserView):
 
         row[VL_TOTAL_CLIENT] = row.get(VL_TOTAL_CLIENT, 0) + 1
 
+        self.set_row(client_brain, row)
+
+    def get_row(self, client_brain):
+        """Returns the row of the statistics sheet of the client
+        """
+        lab = self.context.bika_setup.laboratory
+        province_rows = self.cells.get(SHEET_STATISTICS, dict())
+        district_rows = province_rows.get(client_brain.getProvince, dict())
+        client_rows = district_rows.get(client_brain.getDistrict, dict())
+        row = client_rows.get(client_brain.UID, dict())
+        row[LAB_KEY] = lab.getTaxNumber()
+        row[PROVINCE] = client_brain.getProvince
+        row[DISTRICT] = client_brain.getDistrict
+        row[CLIENT_NAME] = client_brain.Title
+        row[CLIENT_CODE] = client_brain.id
+        return row
+
+    def set_row(self, client_brain, row):
+        """Stores the row of the statistics sheet of the client
+        """
+        province_rows = self.cells.get(SHEET_STATISTICS, dict())
+        district_rows = province_rows.get(client_brain.getProvince, dict())
+        client_rows = district_rows.get(client_brain.getDistrict, dict())
         client_rows[client_brain.UID] = row
         district_rows[client_brain.getDistrict] = client_rows
         province_rows[client_brain.getProvince] = district_rows
         self.cells[SHEET_STATISTICS] = province_rows
 
+    def get_group(self, patient_brain):
+        """Returns the group of the patient in the statistics
+        """
+        age = self.get_age(patient_brain)
+        if age is None:
+            return GROUP_UNKNOWN
+        if age < 14:
+            return GROUP_L14
+        sex = patient_brain.getGender
+        if sex == 'male':
+            return GROUP_MALE
+        if sex == 'female':
+            return GROUP_FEMALE
+        return GROUP_UNKNOWN
+
+    def render_statistics_from_snapshot(self, snapshot, mask):
+        """Fills the statistics rows from the rows of the snapshot in the
+        mask, as render_statistics_row does for each analysis. The patients
+        and clients are fetched once each
+        """
+        results = snapshot.column("result")[mask]
+        texts = snapshot.column("result_text")[mask]
+        invalid = snapshot.find_codes(
+            "result_text", lambda text: text.lower() == "invalid")
+        # "invalid" and 3 ("Collect new sample") results are skipped, other
+        # not numeric results are "target not detectable", counted as 1
+        keep = ~numpy.isin(texts, invalid) & (results != 3)
+        results = numpy.where(numpy.isnan(results), 1, results)
+        low = (results <= 1000).astype("i8")
+        rejected = snapshot.isin("review_state", "rejected")[mask]
+
+        # Group of the patient of each row, -1 if the patient is not found
+        patients, patient_index = numpy.unique(
+            snapshot.column("patient")[mask], return_inverse=True)
+        patient_uids = [snapshot.get_value("patient", code)
+                        for code in patients]
+        self.resolver.fetch(patient_uids, CATALOG_PATIENT_LISTING)
+        groups = []
+        for uid in patient_uids:
+            patient_brain = self.resolver.get(uid, CATALOG_PATIENT_LISTING)
+            groups.append(patient_brain and self.get_group(patient_brain))
+        groups = numpy.array([-1 if group is None else group
+                              for group in groups], dtype="i8")
+        groups = groups[patient_index]
+
+        clients, client_index = numpy.unique(
+            snapshot.column("client")[mask], return_inverse=True)
+        client_uids = [snapshot.get_value("client", code) for code in clients]
+        self.resolver.fetch(client_uids, CATALOG_CLIENT)
+        client_brains = [self.resolver.get(uid, CATALOG_CLIENT)
+                         for uid in client_uids]
+        found = numpy.array([brain is not None for brain in client_brains],
+                            dtype=bool)
+
+        keep &= (groups >= 0) & found[client_index]
+        client_index = client_index[keep]
+        # Number of results per client, group and <=1000 or >1000
+        bins = (client_index * len(GROUP_COLUMNS) + groups[keep]) * 2 + \
+            (1 - low[keep])
+        counts = numpy.bincount(
+            bins, minlength=len(clients) * len(GROUP_COLUMNS) * 2)
+        counts = counts.reshape(len(clients), len(GROUP_COLUMNS), 2)
+        rejections = numpy.bincount(client_index, weights=rejected[keep],
+                                    minlength=len(clients))
+
+        for num, client_brain in enumerate(client_brains):
+            check_cancelled(self.request)
+            if client_brain is None or not counts[num].sum():
+                continue
+            row = self.get_row(client_brain)
+            row[NUM_REJECTIONS] = row.get(NUM_REJECTIONS, 0) + \
+                int(rejections[num])
+            totals = {}
+            for group, columns in GROUP_COLUMNS.items():
+                for column, count in zip(columns, counts[num][group]):
+                    totals[column] = int(count)
+            subtotals = counts[num][GROUP_L14:].sum(axis=0)
+            totals[VL_SUBTOTAL_LEQ1000] = int(subtotals[0])
+            totals[VL_SUBTOTAL_G1000] = int(subtotals[1])
+            group_totals = counts[num].sum(axis=0)
+            totals[VL_TOTAL_LEQ1000] = int(group_totals[0])
+            totals[VL_TOTAL_G1000] = int(group_totals[1])
+            totals[VL_TOTAL_CLIENT] = int(group_totals.sum())
+            for column, count in totals.items():
+                if count:
+                    row[column] = row.get(column, 0) + count
+            self.set_row(client_brain, row)
+
     def get_age(self, patient_brain):
         age_splitted = patient_brain.getAgeSplittedStr
         if not age_splitted:
@@ -244,49 +415,11 @@ class Report(BrowserView):
         except:
             return None
 
-    @viewcache.memoize
-    def get_brain(self, uid, catalog):
-        cat = api.get_tool(catalog)
-        brain = cat(UID=uid)
-        if not brain or len(brain) == 0:
-            return None
-        return brain[0]
-
-    @viewcache.memoize
-    def get_object(self, brain_or_object_or_uid):
-        """Get the full content object. Returns None if the param passed in is
-        not a valid, not a valid object or not found
-
-        :param brain_or_object_or_uid: UID/Catalog brain/content object
-        :returns: content object
-        """
-        if api.is_uid(brain_or_object_or_uid):
-            return api.get_object_by_uid(brain_or_object_or_uid, default=None)
-        if api.is_object(brain_or_object_or_uid):
-            return api.get_object(brain_or_object_or_uid)
-        return None
-
     def get_ar_brain(self, analysis_brain):
-        ar_uid = analysis_brain.getParentUID
-        if not ar_uid:
-            return None
-        return self.get_brain(ar_uid, CATALOG_ANALYSIS_REQUEST_LISTING)
+        return self.resolver.get_ar(analysis_brain)
 
     def get_client_brain(self, analysis_brain):
-        ar = self.get_ar_brain(analysis_brain)
-        if not ar:
-            return None
-        client_uid = ar.getClientUID
-        if not client_uid:
-            return None
-        return self.get_brain(client_uid, 'portal_catalog')
+        return self.resolver.get_client(analysis_brain)
 
     def get_patient_brain(self, analysis_brain):
-        ar = self.get_ar_brain(analysis_brain)
-        if not ar:
-            return None
-        patient_uid = ar.getPatientUID
-        if not patient_uid:
-            return None
-        patient = self.get_brain(patient_uid, 'bikahealth_catalog_patient_listing')
-        return patient
+        return self.resolver.get_patient(analysis_brain)
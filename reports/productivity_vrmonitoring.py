@@ -3,13 +3,15 @@ import os
 from DateTime import DateTime
 from bika.lims import api
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.resolver import CATALOG_BATCH
+from bika.lims.browser.reports.resolver import BrainResolver
+from bika.lims.browser.reports.timing import stage
 from bika.lims.catalog import CATALOG_ANALYSIS_LISTING
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from openpyxl import load_workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from plone.app.layout.globals.interfaces import IViewView
-from plone.memoize import view as viewcache
 from zope.interface import implements
 
 
@@ -28,6 +30,7 @@ class Report(BrowserView):
         self.report = report
         self.selection_macros = SelectionMacrosView(self.context, self.request)
         self.cells = dict()
+        self.resolver = BrainResolver(clients=False)
 
     def __call__(self):
         year = self.request.form.get('year', DateTime().year())
@@ -61,17 +64,24 @@ class Report(BrowserView):
             'cancellation_state': 'active',}
         self.cells = dict()
         catalog = api.get_tool(CATALOG_ANALYSIS_LISTING)
-        for analysis_brain in catalog(query):
-            result = self.to_float(analysis_brain.getResult)
-            if not result:
-                continue
-            patient_brain = self.get_patient_brain(analysis_brain)
-            if not patient_brain:
-                continue
-            self.fill_reported(result)
-            self.fill_results_by_sex(result, patient_brain)
-            self.fill_results_by_age(result, patient_brain)
-            self.fill_results_by_pregnancy(result, analysis_brain)
+        with stage(self.request, 'query'):
+            brains = catalog(query)
+
+            # Fetch the ARs, patients and batches of all analyses at once
+            self.resolver.prefetch(brains)
+        with stage(self.request, 'rows'):
+            for analysis_brain in brains:
+                check_cancelled(self.request)
+                result = self.to_float(analysis_brain.getResult)
+                if not result:
+                    continue
+                patient_brain = self.get_patient_brain(analysis_brain)
+                if not patient_brain:
+                    continue
+                self.fill_reported(result)
+                self.fill_results_by_sex(result, patient_brain)
+                self.fill_results_by_age(result, patient_brain)
+                self.fill_results_by_pregnancy(result, analysis_brain)
 
         # Build report
         this_dir = os.path.dirname(os.path.abspath(__file__))
@@ -172,16 +182,10 @@ class Report(BrowserView):
         self.add_count_cell(cell_total_id)
 
     def fill_results_by_pregnancy(self, result, analysis):
-        ar_uid = analysis.getParentUID
-        if not ar_uid:
-            return
-        ar = self.get_brain(ar_uid, CATALOG_ANALYSIS_REQUEST_LISTING)
-        if not ar:
-            return
-        batch_uid = ar.getBatchUID
-        if not batch_uid:
-            return
-        batch = self.get_object(batch_uid)
+        batch = self.resolver.get_batch(analysis)
+        if not batch:
+            return None
+        batch = self.resolver.get_object(api.get_uid(batch), CATALOG_BATCH)
         if not batch:
             return None
 
@@ -208,37 +212,5 @@ class Report(BrowserView):
         current = self.cells.get(id_cell, 0)
         self.cells[id_cell] = current + count
 
-    @viewcache.memoize
-    def get_brain(self, uid, catalog):
-        cat = api.get_tool(catalog)
-        brain = cat(UID=uid)
-        if not brain or len(brain) == 0:
-            return None
-        return brain[0]
-
-    @viewcache.memoize
-    def get_object(self, brain_or_object_or_uid):
-        """Get the full content object. Returns None if the param passed in is
-        not a valid, not a valid object or not found
-
-        :param brain_or_object_or_uid: UID/Catalog brain/content object
-        :returns: content object
-        """
-        if api.is_uid(brain_or_object_or_uid):
-            return api.get_object_by_uid(brain_or_object_or_uid, default=None)
-        if api.is_object(brain_or_object_or_uid):
-            return api.get_object(brain_or_object_or_uid)
-        return None
-
     def get_patient_brain(self, analysis_brain):
-        ar_uid = analysis_brain.getParentUID
-        if not ar_uid:
-            return None
-        ar = self.get_brain(ar_uid, CATALOG_ANALYSIS_REQUEST_LISTING)
-        if not ar:
-            return None
-        patient_uid = ar.getPatientUID
-        if not patient_uid:
-            return None
-        patient = self.get_brain(patient_uid, 'bikahealth_catalog_patient_listing')
-        return patient
+        return self.resolver.get_patient(analysis_brain)
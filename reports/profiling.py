@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Profiling of a single report run.
+
+Managers can add profile=1 to the createreport request to run the report
+under cProfile, and profile_memory=1 to trace its memory allocations too
+(requires tracemalloc, pytracemalloc on Python 2). The pstats dump, its
+summary and the top allocation sites are stored in the annotations of the
+Report object and can be downloaded with the report_profile view of the
+reports folder.
+"""
+
+import StringIO
+import cProfile
+import marshal
+import pstats
+from contextlib import contextmanager
+
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+try:
+    import tracemalloc
+except ImportError:
+    # Memory allocations are not traced
+    tracemalloc = None
+
+# Key of the profile in the annotations of the Report objects
+PROFILE_ANNOTATION_KEY = "bika.lims.reports.profile"
+
+# Number of functions listed in the summary of the profile
+SUMMARY_LINES = 60
+
+# Number of allocation sites listed
+ALLOCATION_LINES = 30
+
+
+class RunProfile(object):
+    """Profile of a report run
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.profiler = cProfile.Profile()
+        self.snapshot = None
+
+    @contextmanager
+    def profile(self):
+        """Profiles the code run within the block
+        """
+        if self.trace_memory:
+            tracemalloc.start(25)
+        self.profiler.enable()
+        try:
+            yield self
+        finally:
+            self.profiler.disable()
+            if self.trace_memory:
+                self.snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+
+    def get_pstats(self):
+        """Returns the profile as a pstats dump, as written by
+        pstats.Stats.dump_stats
+        """
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+    def get_summary(self):
+        """Returns the functions with the highest cumulative time, as text
+        """
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+        return stream.getvalue()
+
+    def get_allocations(self):
+        """Returns the top allocation sites, as text
+        """
+        if self.snapshot is None:
+            return ""
+        lines = []
+        for stat in self.snapshot.statistics("lineno")[:ALLOCATION_LINES]:
+            lines.append(str(stat))
+        return "\n".join(lines)
+
+
+def store_profile(report, profile):
+    """Stores the profile in the annotations of the Report object
+    """
+    annotations = IAnnotations(report)
+    annotations[PROFILE_ANNOTATION_KEY] = PersistentMapping({
+        "pstats": profile.get_pstats(),
+        "summary": profile.get_summary(),
+        "allocations": profile.get_allocations(),
+    })
+
+
+def get_stored_profile(report):
+    """Returns the profile stored in the Report object passed in, or None
+    """
+    profile = IAnnotations(report).get(PROFILE_ANNOTATION_KEY, None)
+    return profile and dict(profile) or None
@@ -7,14 +7,39 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.resolver import BrainResolver
+from bika.lims.browser.reports.table import Table
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from bika.lims import api
 from bika.lims import bikaMessageFactory as _
+from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from bika.lims.utils import t, dicts_to_dict
 from bika.lims.utils \
     import formatDateQuery, formatDateParms, isAttributeHidden
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the analysis brains
+ANALYSIS_COLUMNS = (
+    Column("getClientTitle"),
+    Column("getRequestID"),
+    Column("getCategoryTitle"),
+    Column("Title"),
+    Column("getResult"),
+    Column("getKeyword"),
+    Column("review_state", accessor=api.get_workflow_status_of),
+)
+
+# Columns read from the Analysis Request brains
+AR_COLUMNS = (
+    Column("getSampleTypeTitle"),
+    Column("getSamplePointTitle"),
+)
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -118,106 +143,115 @@ class Report(BrowserView):
                    'class': '',
         }
 
-        datalines = []
+        datalines = Table()
+
+        with stage(self.request, 'query'):
+            analyses = bac(query)
+            resolver = BrainResolver(clients=False, patients=False,
+                                     batches=False)
+            resolver.prefetch(analyses)
+        # Analysis Request UID -> results ranges by keyword
+        ar_ranges = {}
+        with stage(self.request, 'rows'):
+            extractor = RowExtractor(self.request, ANALYSIS_COLUMNS)
+            ar_extractor = RowExtractor(self.request, AR_COLUMNS)
+            for a_proxy in analyses:
+                check_cancelled(self.request)
+                analysis = extractor.extract(a_proxy)
+                if analysis['getResult']:
+                    try:
+                        result = float(analysis['getResult'])
+                    except:
+                        continue
+                else:
+                    continue
 
-        for a_proxy in bac(query):
-            analysis = a_proxy.getObject()
-            if analysis.getResult():
+                keyword = analysis['getKeyword']
+
+                # determine which specs to use for this particular analysis
+                # 1) if a spec is given in the query form, use it.
+                # 2) if a spec is entered directly on the analysis, use it.
+                # otherwise just continue to the next object.
+                spec_dict = False
+                if spec_obj:
+                    rr = spec_obj.getResultsRangeDict()
+                    if keyword in rr:
+                        spec_dict = rr[keyword]
+                else:
+                    ar_uid = a_proxy.getParentUID
+                    if ar_uid not in ar_ranges:
+                        # Wake up each Analysis Request once
+                        ar_obj = resolver.get_object(
+                            ar_uid, CATALOG_ANALYSIS_REQUEST_LISTING)
+                        ar_ranges[ar_uid] = ar_obj and dicts_to_dict(
+                            ar_obj.getResultsRange(), 'keyword') or {}
+                    rr = ar_ranges[ar_uid]
+                    if keyword in rr:
+                        spec_dict = rr[keyword]
+                    else:
+                        continue
+                if not spec_dict:
+                    continue
                 try:
-                    result = float(analysis.getResult())
-                except:
+                    spec_min = float(spec_dict['min'])
+                    spec_max = float(spec_dict['max'])
+                except ValueError:
                     continue
-            else:
-                continue
-
-            keyword = analysis.getKeyword()
-
-            # determine which specs to use for this particular analysis
-            # 1) if a spec is given in the query form, use it.
-            # 2) if a spec is entered directly on the analysis, use it.
-            # otherwise just continue to the next object.
-            spec_dict = False
-            if spec_obj:
-                rr = spec_obj.getResultsRangeDict()
-                if keyword in rr:
-                    spec_dict = rr[keyword]
-            else:
-                ar = analysis.aq_parent
-                rr = dicts_to_dict(ar.getResultsRange(), 'keyword')
-                if keyword in rr:
-                    spec_dict = rr[keyword]
-                else:
+                if spec_min <= result <= spec_max:
                     continue
-            if not spec_dict:
-                continue
-            try:
-                spec_min = float(spec_dict['min'])
-                spec_max = float(spec_dict['max'])
-            except ValueError:
-                continue
-            if spec_min <= result <= spec_max:
-                continue
-
-            # check if in shoulder: out of range, but in acceptable
-            # error percentage
-            shoulder = False
-            error = 0
-            try:
-                error = float(spec_dict.get('error', '0'))
-            except:
-                error = 0
-                pass
-            error_amount = (result / 100) * error
-            error_min = result - error_amount
-            error_max = result + error_amount
-            if ((result < spec_min) and (error_max >= spec_min)) or \
-                    ((result > spec_max) and (error_min <= spec_max)):
-                shoulder = True
 
-            dataline = []
+                # check if in shoulder: out of range, but in acceptable
+                # error percentage
+                shoulder = False
+                error = 0
+                try:
+                    error = float(spec_dict.get('error', '0'))
+                except:
+                    error = 0
+                    pass
+                error_amount = (result / 100) * error
+                error_min = result - error_amount
+                error_max = result + error_amount
+                if ((result < spec_min) and (error_max >= spec_min)) or \
+                        ((result > spec_max) and (error_min <= spec_max)):
+                    shoulder = True
 
-            dataitem = {'value': analysis.getClientTitle()}
-            dataline.append(dataitem)
+                ar = ar_extractor.extract(resolver.get_ar(a_proxy))
+                dataline = []
+                styles = {}
 
-            dataitem = {'value': analysis.getRequestID()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getClientTitle'])
 
-            dataitem = {'value': analysis.aq_parent.getSampleTypeTitle()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getRequestID'])
 
-            if isAttributeHidden('Sample', 'SamplePoint'):
-                dataitem = {'value': analysis.aq_parent.getSamplePointTitle()}
-                dataline.append(dataitem)
+                dataline.append(ar['getSampleTypeTitle'])
 
-            dataitem = {'value': analysis.getCategoryTitle()}
-            dataline.append(dataitem)
+                if isAttributeHidden('Sample', 'SamplePoint'):
+                    dataline.append(ar['getSamplePointTitle'])
 
-            dataitem = {'value': analysis.Title()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getCategoryTitle'])
 
-            if shoulder:
-                dataitem = {'value': analysis.getResult(),
-                            'img_after': '++resource++bika.lims.images/exclamation.png'}
-            else:
-                dataitem = {'value': analysis.getResult()}
+                dataline.append(analysis['Title'])
 
-            dataline.append(dataitem)
+                if shoulder:
+                    styles[len(dataline)] = {
+                        'img_after': '++resource++bika.lims.images/exclamation.png'}
+                dataline.append(analysis['getResult'])
 
-            dataitem = {'value': spec_dict['min']}
-            dataline.append(dataitem)
+                dataline.append(spec_dict['min'])
 
-            dataitem = {'value': spec_dict['max']}
-            dataline.append(dataitem)
+                dataline.append(spec_dict['max'])
 
-            state = wf_tool.getInfoFor(analysis, 'review_state', '')
-            review_state = wf_tool.getTitleForStateOnType(
-                state, 'Analysis')
-            dataitem = {'value': review_state}
-            dataline.append(dataitem)
+                state = analysis['review_state'] or ''
+                review_state = wf_tool.getTitleForStateOnType(
+                    state, 'Analysis')
+                dataline.append(review_state)
 
-            datalines.append(dataline)
+                datalines.append(dataline, styles)
 
-            count_all += 1
+                count_all += 1
+            extractor.finish()
+            ar_extractor.finish()
 
         # table footer data
         footlines = []
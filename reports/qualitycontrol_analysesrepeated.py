@@ -7,13 +7,38 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.resolver import BrainResolver
+from bika.lims.browser.reports.table import Table
+from bika.lims.browser.reports.timing import stage
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from bika.lims import api
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
 from bika.lims.utils import formatDateQuery, formatDateParms
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
+# Columns read from the analysis brains
+ANALYSIS_COLUMNS = (
+    Column("getClientTitle"),
+    Column("getRequestID"),
+    Column("getCategoryTitle"),
+    Column("Title"),
+    Column("getDateReceived"),
+    Column("getResult"),
+    Column("getKeyword"),
+    Column("review_state", accessor=api.get_workflow_status_of),
+)
+
+# Columns read from the Analysis Request brains
+AR_COLUMNS = (
+    Column("getSampleTypeTitle"),
+    Column("getSamplePointTitle"),
+)
+
 
 class Report(BrowserView):
     implements(IViewView)
@@ -100,48 +125,53 @@ class Report(BrowserView):
                    'class': '',
         }
 
-        datalines = []
+        datalines = Table()
         clients = {}
         sampletypes = {}
         samplepoints = {}
         categories = {}
         services = {}
 
-        for a_proxy in bac(query):
-            analysis = a_proxy.getObject()
+        with stage(self.request, 'query'):
+            analyses = bac(query)
+            resolver = BrainResolver(clients=False, patients=False,
+                                     batches=False)
+            resolver.prefetch(analyses)
+        with stage(self.request, 'rows'):
+            extractor = RowExtractor(self.request, ANALYSIS_COLUMNS)
+            ar_extractor = RowExtractor(self.request, AR_COLUMNS)
+            for a_proxy in analyses:
+                check_cancelled(self.request)
+                analysis = extractor.extract(a_proxy)
+                ar = ar_extractor.extract(resolver.get_ar(a_proxy))
 
-            dataline = []
+                dataline = []
 
-            dataitem = {'value': analysis.getClientTitle()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getClientTitle'])
 
-            dataitem = {'value': analysis.getRequestID()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getRequestID'])
 
-            dataitem = {'value': analysis.aq_parent.getSampleTypeTitle()}
-            dataline.append(dataitem)
+                dataline.append(ar['getSampleTypeTitle'])
 
-            dataitem = {'value': analysis.aq_parent.getSamplePointTitle()}
-            dataline.append(dataitem)
+                dataline.append(ar['getSamplePointTitle'])
 
-            dataitem = {'value': analysis.getCategoryTitle()}
-            dataline.append(dataitem)
+                dataline.append(analysis['getCategoryTitle'])
 
-            dataitem = {'value': analysis.Title()}
-            dataline.append(dataitem)
+                dataline.append(analysis['Title'])
 
-            dataitem = {'value': self.ulocalized_time(analysis.getDateReceived())}
-            dataline.append(dataitem)
+                dataline.append(self.ulocalized_time(
+                    analysis['getDateReceived']))
 
-            state = wf_tool.getInfoFor(analysis, 'review_state', '')
-            review_state = wf_tool.getTitleForStateOnType(
-                state, 'Analysis')
-            dataitem = {'value': review_state}
-            dataline.append(dataitem)
+                state = analysis['review_state'] or ''
+                review_state = wf_tool.getTitleForStateOnType(
+                    state, 'Analysis')
+                dataline.append(review_state)
 
-            datalines.append(dataline)
+                datalines.append(dataline)
 
-            count_all += 1
+                count_all += 1
+            extractor.finish()
+            ar_extractor.finish()
 
         # table footer data
         footlines = []
@@ -15,7 +15,9 @@ from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t, isAttributeHidden
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from gpw import plot
 from bika.lims.utils import to_utf8
 from plone.app.content.browser.interfaces import IFolderContentsView
@@ -87,7 +89,8 @@ class Report(BrowserView):
             self.parms.append(val['parms'])
             titles.append(val['titles'])
 
-        proxies = self.bika_analysis_catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            proxies = self.bika_analysis_catalog(self.contentFilter)
         if not proxies:
             message = _("No analyses matched your query")
             self.context.plone_utils.addPortalMessage(message, 'error')
@@ -103,45 +106,47 @@ class Report(BrowserView):
         plotdata = ""
         tabledata = []
 
-        for analysis in proxies:
-            analysis = analysis.getObject()
-            resultsrange = \
-            [x for x in sample.getReferenceResults() if x['uid'] == service_uid][
-                0]
-            try:
-                result = float(analysis.getResult())
-                results.append(result)
-            except:
-                result = analysis.getResult()
-            capture_dates.append(analysis.getResultCaptureDate())
-
-            if result < float(resultsrange['min']) or result > float(
-                    resultsrange['max']):
-                out_of_range_count += 1
-
-            try:
-                precision = str(analysis.getPrecision())
-            except:
-                precision = "2"
-
-            try:
-                formatted_result = str("%." + precision + "f") % result
-            except:
-                formatted_result = result
-
-            tabledata.append({_("Analysis"): analysis.getId(),
-                              _("Result"): formatted_result,
-                              _("Analyst"): analysis.getAnalyst(),
-                              _(
-                                  "Captured"): analysis.getResultCaptureDate().strftime(
-                                  self.date_format_long)})
-
-            plotdata += "%s\t%s\t%s\t%s\n" % (
-                analysis.getResultCaptureDate().strftime(self.date_format_long),
-                result,
-                resultsrange['min'],
-                resultsrange['max']
-            )
+        with stage(self.request, 'rows'):
+            for analysis in proxies:
+                check_cancelled(self.request)
+                analysis = analysis.getObject()
+                resultsrange = \
+                [x for x in sample.getReferenceResults() if x['uid'] == service_uid][
+                    0]
+                try:
+                    result = float(analysis.getResult())
+                    results.append(result)
+                except:
+                    result = analysis.getResult()
+                capture_dates.append(analysis.getResultCaptureDate())
+
+                if result < float(resultsrange['min']) or result > float(
+                        resultsrange['max']):
+                    out_of_range_count += 1
+
+                try:
+                    precision = str(analysis.getPrecision())
+                except:
+                    precision = "2"
+
+                try:
+                    formatted_result = str("%." + precision + "f") % result
+                except:
+                    formatted_result = result
+
+                tabledata.append({_("Analysis"): analysis.getId(),
+                                  _("Result"): formatted_result,
+                                  _("Analyst"): analysis.getAnalyst(),
+                                  _(
+                                      "Captured"): analysis.getResultCaptureDate().strftime(
+                                      self.date_format_long)})
+
+                plotdata += "%s\t%s\t%s\t%s\n" % (
+                    analysis.getResultCaptureDate().strftime(self.date_format_long),
+                    result,
+                    resultsrange['min'],
+                    resultsrange['max']
+                )
         plotdata.encode('utf-8')
 
         result_values = [int(r) for r in results]
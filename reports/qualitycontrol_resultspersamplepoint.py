@@ -12,7 +12,9 @@ from bika.lims import bikaMessageFactory as _
 from bika.lims.api.analysis import is_out_of_range
 from bika.lims.utils import t, dicts_to_dict
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports.cancel import check_cancelled
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.browser.reports.timing import stage
 from gpw import plot
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
@@ -101,7 +103,8 @@ class Report(BrowserView):
         in_shoulder_range_count = 0
         analysis_count = 0
 
-        proxies = self.bika_analysis_catalog(self.contentFilter)
+        with stage(self.request, 'query'):
+            proxies = self.bika_analysis_catalog(self.contentFilter)
 
         if not proxies:
             message = _("No analyses matched your query")
@@ -109,40 +112,42 @@ class Report(BrowserView):
             return self.default_template()
 
         # # Compile a list of dictionaries, with all relevant analysis data
-        for analysis in proxies:
-            analysis = analysis.getObject()
-            result = analysis.getResult()
-            client = analysis.aq_parent.aq_parent
-            uid = analysis.UID()
-            keyword = analysis.getKeyword()
-            service_title = "%s (%s)" % (analysis.Title(), keyword)
-            # First tuple element is the out-of-range flag
-            result_in_range = is_out_of_range(analysis)[0]
-
-            if service_title not in analyses.keys():
-                analyses[service_title] = []
-            try:
-                result = float(analysis.getResult())
-            except:
-                # XXX Unfloatable analysis results should be indicated
-                continue
-            analyses[service_title].append({
-                # The report should not mind taking 'analysis' in place of
-                # 'service' - the service field values are placed in analysis.
-                'service': analysis,
-                'obj': analysis,
-                'Request ID': analysis.aq_parent.getId(),
-                'Analyst': analysis.getAnalyst(),
-                'Result': result,
-                'Sampled': analysis.getDateSampled(),
-                'Captured': analysis.getResultCaptureDate(),
-                'Uncertainty': analysis.getUncertainty(),
-                'result_in_range': result_in_range,
-                'Unit': analysis.getUnit(),
-                'Keyword': keyword,
-                'icons': '',
-            })
-            analysis_count += 1
+        with stage(self.request, 'rows'):
+            for analysis in proxies:
+                check_cancelled(self.request)
+                analysis = analysis.getObject()
+                result = analysis.getResult()
+                client = analysis.aq_parent.aq_parent
+                uid = analysis.UID()
+                keyword = analysis.getKeyword()
+                service_title = "%s (%s)" % (analysis.Title(), keyword)
+                # First tuple element is the out-of-range flag
+                result_in_range = is_out_of_range(analysis)[0]
+
+                if service_title not in analyses.keys():
+                    analyses[service_title] = []
+                try:
+                    result = float(analysis.getResult())
+                except:
+                    # XXX Unfloatable analysis results should be indicated
+                    continue
+                analyses[service_title].append({
+                    # The report should not mind taking 'analysis' in place of
+                    # 'service' - the service field values are placed in analysis.
+                    'service': analysis,
+                    'obj': analysis,
+                    'Request ID': analysis.aq_parent.getId(),
+                    'Analyst': analysis.getAnalyst(),
+                    'Result': result,
+                    'Sampled': analysis.getDateSampled(),
+                    'Captured': analysis.getResultCaptureDate(),
+                    'Uncertainty': analysis.getUncertainty(),
+                    'result_in_range': result_in_range,
+                    'Unit': analysis.getUnit(),
+                    'Keyword': keyword,
+                    'icons': '',
+                })
+                analysis_count += 1
 
         keys = analyses.keys()
         keys.sort()
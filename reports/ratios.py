@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Requested, performed and published analyses per period and item.
+
+The analyses per department and the analyses performed as % of total show,
+for each grouping period and each department or service, the number of
+analyses requested, performed and published, and the ratios of performed
+to requested and of published to performed. GroupedRatios accumulates the
+integer counts of the records of a report, keyed by period and by any
+item (department, service, client, sample type...), and computes the
+ratios once, when the lines of the report are built:
+
+    ratios = GroupedRatios(groupby, "Departments", "Department",
+                           self.ulocalized_time)
+    for date, department, performed, published, num in records:
+        ratios.add(date, department, department, performed, published, num)
+    datalines, footlines = ratios.finalize()
+
+The report records tell whether the Analysis Request of the analyses is
+published. They read the review states of the Analysis Requests in bulk,
+with ARStates (see resolver.py).
+"""
+
+
+def get_group(date, groupby, localize):
+    """Returns the label of the grouping period of the date passed in, or an
+    empty string if the records are not grouped by period. localize is the
+    function that formats a date for the Day period
+    """
+    if groupby == 'Day':
+        return localize(date)
+    if groupby == 'Week':
+        return date.strftime("%Y") + ", " + date.strftime("%U")
+    if groupby == 'Month':
+        return date.strftime("%B") + " " + date.strftime("%Y")
+    if groupby == 'Year':
+        return date.strftime("%Y")
+    return ''
+
+
+def get_ratio(count, total):
+    """Returns count / total as a float, or 0 if total is 0
+    """
+    if not total:
+        return 0
+    return float(count) / float(total)
+
+
+def to_line(requested, performed, published):
+    """Returns the line of the report with the counts passed in and their
+    ratios
+    """
+    performed_ratio = get_ratio(performed, requested)
+    published_ratio = get_ratio(published, performed)
+    return {
+        'Requested': requested,
+        'Performed': performed,
+        'Published': published,
+        'PerformedRequestedRatio': performed_ratio,
+        'PerformedRequestedRatioPercentage': '{0:.0f}%'.format(
+            performed_ratio * 100),
+        'PublishedPerformedRatio': published_ratio,
+        'PublishedPerformedRatioPercentage': '{0:.0f}%'.format(
+            published_ratio * 100),
+    }
+
+
+class GroupedRatios(object):
+    """Counts of requested, performed and published analyses per grouping
+    period and item. items is the key of the lines of the items in the line
+    of a period, item the key of the title in the line of an item
+    """
+
+    def __init__(self, groupby, items, item, localize):
+        self.groupby = groupby
+        self.items = items
+        self.item = item
+        self.localize = localize
+        # (period, item key) -> [requested, performed, published]
+        self.counts = {}
+        self.titles = {}
+        # labels of the periods of the dates already seen
+        self.groups = {}
+
+    def add(self, date, key, title, performed, published, num=1):
+        """Adds num analyses requested on the date passed in
+        """
+        if date not in self.groups:
+            self.groups[date] = get_group(date, self.groupby, self.localize)
+        group_key = (self.groups[date], key)
+        counts = self.counts.get(group_key, None)
+        if counts is None:
+            counts = self.counts[group_key] = [0, 0, 0]
+            self.titles[key] = title
+        counts[0] += num
+        if performed:
+            counts[1] += num
+        if published:
+            counts[2] += num
+
+    def finalize(self):
+        """Returns the datalines and footlines of the report
+        """
+        datalines = {}
+        group_totals = {}
+        totals = [0, 0, 0]
+        for (group, key), counts in self.counts.items():
+            line = to_line(*counts)
+            line[self.item] = self.titles[key]
+            dataline = datalines.setdefault(group, {'Group': group,
+                                                    self.items: {}})
+            dataline[self.items][key] = line
+            group_total = group_totals.setdefault(group, [0, 0, 0])
+            for num, count in enumerate(counts):
+                group_total[num] += count
+                totals[num] += count
+        for group, counts in group_totals.items():
+            datalines[group].update(to_line(*counts))
+        footlines = {'Total': to_line(*totals)}
+        return datalines, footlines
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Registry of the reports that can be generated with createreport.
+
+The registry maps each report_id to the module that contains its Report
+class, the category it belongs to and the output formats it supports. The
+reports shipped with this package are declared in BUILTIN_REPORTS, the ones
+provided by add-ons are registered as IProductivityReport,
+IQualityControlReport or IAdministrationReport adapters and added to the
+registry on first use.
+
+Report classes are imported once and kept in the registry, so neither the
+report views nor SubmitForm go through the import machinery or the adapter
+lookup on every request.
+"""
+
+import threading
+from collections import OrderedDict
+from importlib import import_module
+
+from bika.lims.interfaces import IAdministrationReport
+from bika.lims.interfaces import IProductivityReport
+from bika.lims.interfaces import IQualityControlReport
+from zope.component import getAdapters
+
+PDF = "PDF"
+CSV = "CSV"
+XLSX = "XLSX"
+
+# Cost classes of the reports, used by the admission control of report runs
+COST_LIGHT = 1
+COST_NORMAL = 2
+COST_HEAVY = 4
+
+# Report categories and the interface add-on reports are registered with
+CATEGORIES = OrderedDict((
+    ("productivity", IProductivityReport),
+    ("qualitycontrol", IQualityControlReport),
+    ("administration", IAdministrationReport),
+))
+
+REPORTS_PACKAGE = "bika.lims.browser.reports"
+
+
+class ReportInfo(object):
+    """Metadata of a report
+    """
+
+    def __init__(self, report_id, module=None, formats=(PDF, ), title=None,
+                 description=None, cost=COST_NORMAL, budget=None):
+        self.id = report_id
+        self.category = report_id.split("_")[0]
+        self.module = module or "{}.{}".format(REPORTS_PACKAGE, report_id)
+        self.formats = tuple(formats)
+        self.title = title
+        self.description = description
+        self.cost = cost
+        # seconds the report can run, None for the instance default
+        self.budget = budget
+        self._report_class = None
+
+    def get_report_class(self):
+        """Returns the Report class of this report. Raises ImportError if
+        the module or the class do not exist
+        """
+        if self._report_class is None:
+            module = import_module(self.module)
+            try:
+                self._report_class = module.Report
+            except AttributeError:
+                raise ImportError("No Report class in {}".format(self.module))
+        return self._report_class
+
+
+BUILTIN_REPORTS = (
+    ReportInfo("administration_arsnotinvoiced"),
+    ReportInfo("administration_usershistory", cost=COST_HEAVY),
+    ReportInfo("productivity_analysesattachments", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysesperclient", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysesperdepartment", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysesperformedpertotal", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysespersampletype", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysesperservice", formats=(PDF, CSV)),
+    ReportInfo("productivity_analysestats", formats=(PDF, CSV),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_analysestats_overtime", formats=(PDF, CSV),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_dailysamplesreceived", formats=(PDF, CSV),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_dataentrydaybook", formats=(PDF, CSV),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_resultsbyclient", formats=(PDF, CSV),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_samplereceivedvsreported", formats=(PDF, CSV)),
+    ReportInfo("productivity_viralloadstatistics", formats=(XLSX, ),
+               cost=COST_HEAVY),
+    ReportInfo("productivity_vrmonitoring", formats=(XLSX, ),
+               cost=COST_HEAVY),
+    ReportInfo("qualitycontrol_analysesoutofrange"),
+    ReportInfo("qualitycontrol_analysesrepeated"),
+    ReportInfo("qualitycontrol_referenceanalysisqc"),
+    ReportInfo("qualitycontrol_resultspersamplepoint", cost=COST_HEAVY),
+)
+
+
+class ReportRegistry(object):
+    """Maps report ids to their ReportInfo
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = OrderedDict((info.id, info) for info in BUILTIN_REPORTS)
+        # (site path, language) -> {category: [report dicts]}
+        self.additional = {}
+
+    def load_additional_reports(self, context, request):
+        """Looks up the reports registered by add-ons for the site and
+        language of the request passed in, and registers them
+        """
+        site_path = "/".join(context.getPhysicalPath()[:2])
+        key = (site_path, request.get("LANGUAGE", ""))
+        additional = self.additional.get(key, None)
+        if additional is not None:
+            return additional
+
+        with self.lock:
+            if key in self.additional:
+                return self.additional[key]
+            additional = {}
+            for category, interface in CATEGORIES.items():
+                additional[category] = []
+                for name, adapter in getAdapters((context, ), interface):
+                    report_dict = adapter(context, request)
+                    report_dict["id"] = name
+                    additional[category].append(report_dict)
+
+                    report_id = "{}_{}".format(category, name)
+                    if report_id in self.reports:
+                        continue
+                    self.reports[report_id] = ReportInfo(
+                        report_id,
+                        module=report_dict.get("module"),
+                        formats=report_dict.get("formats", (PDF, )),
+                        title=report_dict.get("title"),
+                        description=report_dict.get("description"),
+                        cost=report_dict.get("cost", COST_NORMAL),
+                        budget=report_dict.get("budget", None))
+            self.additional[key] = additional
+        return additional
+
+    def additional_reports(self, category, context, request):
+        """Returns the report dicts of the add-on reports of the category
+        passed in, as rendered by the report category views
+        """
+        additional = self.load_additional_reports(context, request)
+        return additional.get(category, [])
+
+    def get(self, report_id, context=None, request=None):
+        """Returns the ReportInfo of the report_id passed in or None
+        """
+        info = self.reports.get(report_id, None)
+        if info is None and context is not None and request is not None:
+            self.load_additional_reports(context, request)
+            info = self.reports.get(report_id, None)
+        return info
+
+
+# The registry of this Zope instance
+registry = ReportRegistry()
+
+
+def get_registry():
+    """Returns the report registry of this Zope instance
+    """
+    return registry
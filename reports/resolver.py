@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Batched resolution of the objects related to analyses.
+
+Reports that list analyses usually need the Analysis Request, the client,
+the patient and the batch of each analysis. Querying the catalogs for each
+of them means several queries per analysis. BrainResolver collects the UIDs
+of all the analyses first, fetches the related brains with a few
+UID=[...] queries, and then resolves each of them with a dict lookup:
+
+    resolver = BrainResolver()
+    resolver.prefetch(analyses)
+    for analysis in analyses:
+        patient = resolver.get_patient(analysis)
+
+Reports that only need the review state of the Analysis Request of each
+analysis use ARStates instead, that keeps the states only.
+"""
+
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
+
+CATALOG_CLIENT = "portal_catalog"
+CATALOG_PATIENT_LISTING = "bikahealth_catalog_patient_listing"
+CATALOG_BATCH = "bika_catalog"
+
+# Maximum number of UIDs queried at once
+UIDS_PER_QUERY = 1000
+
+
+class BrainResolver(object):
+    """Resolves the Analysis Request, client, patient and batch of analysis
+    brains from brains fetched in bulk
+    """
+
+    def __init__(self, clients=True, patients=True, batches=True):
+        self.clients = clients
+        self.patients = patients
+        self.batches = batches
+        self.brains = {}
+        self.objects = {}
+        self.queries = 0
+        self.misses = 0
+
+    def prefetch(self, analyses):
+        """Fetches the brains related to the analysis brains passed in
+        """
+        ar_uids = set([analysis.getParentUID for analysis in analyses])
+        ars = self.fetch(ar_uids, CATALOG_ANALYSIS_REQUEST_LISTING)
+
+        related = (
+            (self.clients, "getClientUID", CATALOG_CLIENT),
+            (self.patients, "getPatientUID", CATALOG_PATIENT_LISTING),
+            (self.batches, "getBatchUID", CATALOG_BATCH),
+        )
+        for enabled, metadata, catalog in related:
+            if not enabled:
+                continue
+            uids = set([getattr(ar, metadata, None) for ar in ars])
+            self.fetch(uids, catalog)
+
+        logger.info("Resolved {} brains with {} queries".format(
+            len(self.brains), self.queries))
+
+    def fetch(self, uids, catalog):
+        """Fetches the brains with the UIDs passed in from the catalog and
+        returns them. UIDs already fetched are not queried again
+        """
+        uids = [uid for uid in uids if uid and uid not in self.brains]
+        brains = []
+        for start in range(0, len(uids), UIDS_PER_QUERY):
+            query = dict(UID=uids[start:start + UIDS_PER_QUERY])
+            brains.extend(api.search(query, catalog))
+            self.queries += 1
+        for brain in brains:
+            self.brains[api.get_uid(brain)] = brain
+        for uid in uids:
+            # Remember the ones not found, so they are not queried again
+            self.brains.setdefault(uid, None)
+        return brains
+
+    def get(self, uid, catalog):
+        """Returns the brain with the UID passed in. UIDs not prefetched are
+        queried one by one
+        """
+        if not uid:
+            return None
+        brain = self.brains.get(uid, None)
+        if brain is not None:
+            return brain
+        if uid in self.brains:
+            # Already queried, not found
+            return None
+
+        self.misses += 1
+        brains = api.search(dict(UID=uid), catalog)
+        self.queries += 1
+        brain = brains and brains[0] or None
+        self.brains[uid] = brain
+        return brain
+
+    def get_object(self, uid, catalog):
+        """Returns the object with the UID passed in, waken up once
+        """
+        if uid in self.objects:
+            return self.objects[uid]
+        brain = self.get(uid, catalog)
+        obj = brain and api.get_object(brain) or None
+        self.objects[uid] = obj
+        return obj
+
+    def get_ar(self, analysis):
+        """Returns the Analysis Request brain of the analysis brain
+        """
+        return self.get(analysis.getParentUID,
+                        CATALOG_ANALYSIS_REQUEST_LISTING)
+
+    def get_related(self, analysis, metadata, catalog):
+        ar = self.get_ar(analysis)
+        if not ar:
+            return None
+        return self.get(getattr(ar, metadata, None), catalog)
+
+    def get_client(self, analysis):
+        """Returns the client brain of the analysis brain
+        """
+        return self.get_related(analysis, "getClientUID", CATALOG_CLIENT)
+
+    def get_patient(self, analysis):
+        """Returns the patient brain of the analysis brain
+        """
+        return self.get_related(analysis, "getPatientUID",
+                                CATALOG_PATIENT_LISTING)
+
+    def get_batch(self, analysis):
+        """Returns the batch brain of the analysis brain
+        """
+        return self.get_related(analysis, "getBatchUID", CATALOG_BATCH)
+
+
+class ARStates(object):
+    """Review states of the Analysis Requests of analysis brains, fetched
+    with one query per UIDS_PER_QUERY distinct Analysis Requests:
+
+        ar_states = ARStates(analyses)
+        for analysis in analyses:
+            published = ar_states.get(analysis) == "published"
+    """
+
+    def __init__(self, analyses=None):
+        self.states = {}
+        self.queries = 0
+        if analyses is not None:
+            self.prefetch(analyses)
+
+    def prefetch(self, analyses):
+        """Fetches the states of the Analysis Requests of the analysis brains
+        passed in. Analysis Requests already fetched are not queried again
+        """
+        uids = set([analysis.getParentUID for analysis in analyses])
+        uids = [uid for uid in uids if uid and uid not in self.states]
+        for start in range(0, len(uids), UIDS_PER_QUERY):
+            query = dict(UID=uids[start:start + UIDS_PER_QUERY])
+            for brain in api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING):
+                self.states[api.get_uid(brain)] = brain.review_state
+            self.queries += 1
+        for uid in uids:
+            # Remember the ones not found, so they are not queried again
+            self.states.setdefault(uid, None)
+
+    def get(self, analysis):
+        """Returns the review state of the Analysis Request of the analysis
+        brain, or None. Analysis Requests not prefetched are queried one by
+        one
+        """
+        if analysis.getParentUID not in self.states:
+            self.prefetch([analysis])
+        return self.states.get(analysis.getParentUID, None)
+
+    def is_published(self, analysis):
+        return self.get(analysis) == "published"
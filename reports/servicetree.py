@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Tree of analysis categories and services rendered by the reports.
+
+Reports that render a section per analysis category used to query the
+setup catalog for the services of each category, one query per category
+on every run. The tree is built with a single query instead, and kept in
+memory until a category or a service is added, modified or removed:
+
+    for category, services in get_service_tree(self.context):
+        for service in services:
+            count = counts.get(service.UID, 0)
+
+The categories and the services of each category are sorted by title. The
+tree is also rebuilt when the change counter of the setup catalog changed,
+so the changes made through other Zope instances are seen too.
+"""
+
+import Missing
+import threading
+
+from bika.lims import api
+from bika.lims import logger
+
+CATALOG_SETUP = "bika_setup_catalog"
+
+
+class SetupItem(object):
+    """A category or a service of the tree, with the UID and Title of its
+    brain
+    """
+
+    def __init__(self, brain):
+        self.UID = brain.UID
+        self.Title = brain.Title
+
+
+def get_counter(catalog):
+    """Returns the change counter of the catalog, or None if it does not
+    keep one
+    """
+    get_counter = getattr(catalog, "getCounter", None)
+    if get_counter is None:
+        return None
+    return get_counter()
+
+
+def get_category_uid(brain):
+    """Returns the UID of the category of the service brain. The object is
+    only woken up if the catalog does not have it in the metadata
+    """
+    category_uid = getattr(brain, "getCategoryUID", None)
+    if category_uid is None or category_uid is Missing.Value:
+        category_uid = api.get_object(brain).getCategoryUID()
+    return category_uid
+
+
+def build_tree(catalog):
+    """Returns the list of (category, services) of the setup catalog
+    """
+    brains = catalog(portal_type=["AnalysisCategory", "AnalysisService"],
+                     sort_on="sortable_title")
+    categories = []
+    services = {}
+    for brain in brains:
+        if brain.portal_type == "AnalysisCategory":
+            categories.append(SetupItem(brain))
+        else:
+            services.setdefault(get_category_uid(brain), []).append(
+                SetupItem(brain))
+    return [(category, services.get(category.UID, []))
+            for category in categories]
+
+
+class ServiceTreeCache(object):
+    """Trees of categories and services of the sites of this Zope instance
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, context):
+        """Returns the tree of the site of the context passed in
+        """
+        catalog = api.get_tool(CATALOG_SETUP, context=context)
+        key = "/".join(api.get_portal().getPhysicalPath())
+        counter = get_counter(catalog)
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry is not None and entry[0] == counter:
+            return entry[1]
+
+        tree = build_tree(catalog)
+        logger.info("Built the tree of {} analysis categories".format(
+            len(tree)))
+        with self.lock:
+            self.entries[key] = (counter, tree)
+        return tree
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# The trees of this Zope instance
+tree_cache = ServiceTreeCache()
+
+
+def get_service_tree(context):
+    """Returns the list of (category, services) of the analysis categories
+    and services, sorted by title
+    """
+    return tree_cache.get(context)
+
+
+def setup_item_modified(obj, event):
+    """Event handler that discards the trees when a category or a service is
+    added, modified or removed
+    """
+    tree_cache.clear()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Worker of the sharded aggregations, see shards.py.
+
+Run by the report processes as
+
+    bin/instance run shard_worker.py <input file> <output file>
+
+bin/instance run binds the Zope application to the name app.
+"""
+
+import sys
+
+from bika.lims.browser.reports.shards import run_shard
+
+if __name__ == "__main__":
+    run_shard(globals()["app"], sys.argv[1], sys.argv[2])
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Sharded aggregation of reports over date ranges.
+
+Aggregating the analyses of a long date range is CPU bound, and a Zope
+process runs Python code in one thread at a time. An aggregation can be
+split in shards instead: the date range is split in sub-ranges, each one is
+aggregated by a separate worker process with its own connection to the
+database (ZEO), and the partial aggregates of the shards are merged in the
+report process.
+
+A report declares the aggregation of a sub-range as a module level function
+(the mapper), that returns a json serializable partial aggregate, and how
+two partial aggregates are merged:
+
+    def map_counts(context, request, criteria, date_from, date_to):
+        query = dict(criteria, created=date_query(date_from, date_to))
+        ...
+        return counts
+
+    counts = aggregate(self.context, self.request, map_counts, criteria,
+                       date_from, date_to, merge=merge_counts)
+
+Sharding is enabled with BIKA_REPORTS_SHARD_COMMAND, the command that runs a
+script in a Zope process connected to the database (bin/instance run). The
+date range is split in up to BIKA_REPORTS_SHARDS shards of at least
+BIKA_REPORTS_SHARD_MIN_DAYS days. The workers run shard_worker.py as the
+user of the report. Without the setting, or for short ranges, the mapper
+is called once in the report process. The shards a worker fails to compute
+are computed in the report process too.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+
+import transaction
+from AccessControl import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from DateTime import DateTime
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.aggregates import from_day
+from bika.lims.browser.reports.aggregates import to_day
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.config import REPORT_SHARDS
+from bika.lims.browser.reports.config import REPORT_SHARD_COMMAND
+from bika.lims.browser.reports.config import REPORT_SHARD_MIN_DAYS
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.daycache import end_of_day
+from bika.lims.browser.reports.daycache import iter_days
+from bika.lims.browser.reports.jobs import NullOutput
+from zope.component.hooks import setSite
+
+# Script run by the worker processes
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "shard_worker.py")
+
+# Seconds between two checks of the worker processes
+POLL_INTERVAL = 0.5
+
+
+def get_dotted_name(mapper):
+    """Returns the dotted name the workers import the mapper with
+    """
+    return "{}:{}".format(mapper.__module__, mapper.__name__)
+
+
+def resolve(dotted_name):
+    """Returns the mapper with the dotted name passed in
+    """
+    module_name, name = dotted_name.split(":")
+    module = __import__(module_name, fromlist=[name])
+    return getattr(module, name)
+
+
+def split_range(date_from, date_to, shards):
+    """Returns the (from, to) sub-ranges of whole days of the range passed in
+    """
+    days = list(iter_days(to_day(date_from), to_day(date_to)))
+    size = -(-len(days) // shards)
+    ranges = []
+    for start in range(0, len(days), size):
+        chunk = days[start:start + size]
+        ranges.append((max(from_day(chunk[0]), date_from),
+                       min(end_of_day(chunk[-1]), date_to)))
+    return ranges
+
+
+def get_num_shards(date_from, date_to):
+    """Returns the number of shards the date range passed in is split in
+    """
+    if not get_setting(REPORT_SHARD_COMMAND, None):
+        return 1
+    if date_from is None or date_to is None:
+        return 1
+    shards = get_setting(REPORT_SHARDS, 4, int)
+    min_days = max(get_setting(REPORT_SHARD_MIN_DAYS, 7, int), 1)
+    days = len(list(iter_days(to_day(date_from), to_day(date_to))))
+    return max(min(shards, days // min_days), 1)
+
+
+class ShardProcess(object):
+    """A worker process computing a shard of an aggregation
+    """
+
+    def __init__(self, directory, num, shard):
+        self.shard = shard
+        self.input_path = os.path.join(directory, "{}.in.json".format(num))
+        self.output_path = os.path.join(directory, "{}.out.json".format(num))
+        self.log_path = os.path.join(directory, "{}.log".format(num))
+        with open(self.input_path, "w") as input_file:
+            json.dump(shard, input_file)
+        command = get_setting(REPORT_SHARD_COMMAND, "").split()
+        command.extend([WORKER_SCRIPT, self.input_path, self.output_path])
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(command, stdout=log,
+                                            stderr=subprocess.STDOUT)
+
+    def running(self):
+        return self.process.poll() is None
+
+    def terminate(self):
+        if self.running():
+            self.process.terminate()
+            self.process.wait()
+
+    def result(self):
+        """Returns the partial aggregate of the shard, or None if the worker
+        failed
+        """
+        if self.process.returncode != 0:
+            with open(self.log_path) as log:
+                logger.error("Shard {date_from} - {date_to} failed: {log}"
+                             .format(log=log.read(), **self.shard))
+            return None
+        try:
+            with open(self.output_path) as output:
+                return json.load(output)
+        except (IOError, OSError, ValueError):
+            logger.error("Shard {date_from} - {date_to} without result"
+                         .format(**self.shard))
+            return None
+
+
+def aggregate(context, request, mapper, criteria, date_from, date_to, merge,
+              shards=None):
+    """Returns the merge of the partial aggregates mapper returns for the
+    shards of the date range. shards is the maximum number of shards, by
+    default it depends on the settings and the length of the range
+    """
+    num_shards = get_num_shards(date_from, date_to)
+    if shards is not None:
+        num_shards = min(num_shards, shards)
+    if num_shards <= 1:
+        return mapper(context, request, criteria, date_from, date_to)
+
+    ranges = split_range(date_from, date_to, num_shards)
+    portal = api.get_portal()
+    user = getSecurityManager().getUser()
+    directory = tempfile.mkdtemp(prefix="bika-reports-shards-")
+    processes = []
+    try:
+        for num, (start, end) in enumerate(ranges):
+            shard = {
+                "site_path": "/".join(portal.getPhysicalPath()),
+                "userid": user.getId(),
+                "mapper": get_dotted_name(mapper),
+                "criteria": criteria,
+                "date_from": start.ISO8601(),
+                "date_to": end.ISO8601(),
+            }
+            processes.append(ShardProcess(directory, num, shard))
+        logger.info("Aggregating {} in {} shards".format(
+            get_dotted_name(mapper), len(processes)))
+
+        while any([process.running() for process in processes]):
+            check_cancelled(request)
+            time.sleep(POLL_INTERVAL)
+
+        result = None
+        for process, (start, end) in zip(processes, ranges):
+            partial = process.result()
+            if partial is None:
+                # Compute the shard here instead
+                partial = mapper(context, request, criteria, start, end)
+            result = partial if result is None else merge(result, partial)
+        return result
+    finally:
+        # e.g. the report was cancelled while the workers were running
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_shard(app, input_path, output_path):
+    """Computes the shard described in the input file and writes its
+    partial aggregate to the output file. Runs in the worker processes
+    """
+    from Testing.makerequest import makerequest
+
+    with open(input_path) as input_file:
+        shard = json.load(input_file)
+    app = makerequest(app, stdout=NullOutput())
+    try:
+        site = app.unrestrictedTraverse(str(shard["site_path"]))
+        setSite(site)
+        acl_users = site.acl_users
+        user = acl_users.getUserById(shard["userid"])
+        if user is None:
+            acl_users = app.acl_users
+            user = acl_users.getUserById(shard["userid"])
+        if user is None:
+            raise ValueError("User {} not found".format(shard["userid"]))
+        newSecurityManager(None, user.__of__(acl_users))
+
+        mapper = resolve(shard["mapper"])
+        partial = mapper(site, app.REQUEST, shard["criteria"],
+                         DateTime(shard["date_from"]),
+                         DateTime(shard["date_to"]))
+    except Exception:
+        logger.error("Shard failed: {}".format(traceback.format_exc()))
+        raise
+    finally:
+        # Workers never write to the database
+        transaction.abort()
+        noSecurityManager()
+        setSite(None)
+
+    tmp_path = "{}.tmp".format(output_path)
+    with open(tmp_path, "w") as output:
+        json.dump(partial, output)
+    os.rename(tmp_path, output_path)
@@ -0,0 +1,775 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Columnar snapshot of the analyses, in memory mapped files.
+
+Statistics reports (turnaround times, viral load statistics) read a few
+values of every analysis of a date range, and walking the brains of
+hundreds of thousands of analyses is what makes them slow. The snapshot
+keeps those values for all the analyses as NumPy arrays, one file per
+field:
+
+- the service, client, sample type, department, category, analyst,
+  instrument, Analysis Request and patient, and the review and
+  cancellation states, as integer codes (-1 for none). The values of the
+  codes are kept in a json file per field
+- the dates created, received, due, captured, verified and published, as
+  seconds since the epoch (NaN for none)
+- the result as a float (NaN if not numeric) and, if it is not numeric,
+  its text as a code
+
+The files are memory mapped read-only, so their pages are shared by all the
+Zope processes of the host through the page cache. Reports filter and
+group the analyses with vectorized operations:
+
+    snapshot = get_snapshot_store().get_fresh(self.request)
+    mask = snapshot and snapshot.select(query)
+    if mask is None:
+        # no NumPy, not built, or the query filters by something the
+        # snapshot does not keep: walk the catalog
+        ...
+    counts = snapshot.sum_by("service", mask)
+
+The snapshot is built once, as a Manager, with reports_snapshot_refresh
+(full=1). From then on a report that finds it older than
+BIKA_REPORTS_SNAPSHOT_MAX_AGE seconds starts a refresh in a background
+thread, with its own ZODB connection, and reads the current snapshot in the
+meantime. The refresh reads the analyses the catalog has as modified since
+the last refresh, and the ones that had a workflow transition since then:
+transitions do not always change the modification date of the analysis,
+so the subscribers of the transitions of analyses and Analysis Requests
+record the UIDs of the analyses per minute in the annotations of the
+portal, for a week. The files mapped by the readers are never written to: each refresh copies the arrays to a new
+generation of files, updates the rows of the modified analyses and appends
+the new ones there, and publishes the generation in current.json once it
+is complete. The arrays have room to grow; when they are full, the new
+generation has twice their capacity. Analyses no longer in the catalog are
+flagged as not alive. Only one process refreshes the snapshot at a time,
+and the generations are removed an hour after they were replaced.
+
+The snapshot does not apply the security of the catalog, it is meant for
+the statistics of the lab. NumPy is optional: without it the reports walk
+the catalog as before.
+"""
+
+import calendar
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+
+import transaction
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOTreeSet
+from DateTime import DateTime
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.aggregates import get_date_range
+from bika.lims.browser.reports.aggregates import get_state
+from bika.lims.browser.reports.cancel import check_cancelled
+from bika.lims.browser.reports.coalesce import FileLock
+from bika.lims.browser.reports.config import REPORT_SNAPSHOT_DIR
+from bika.lims.browser.reports.config import REPORT_SNAPSHOT_MAX_AGE
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.counting import CHECK_EVERY
+from bika.lims.browser.reports.counting import get_index
+from bika.lims.browser.reports.extract import Column
+from bika.lims.browser.reports.extract import RowExtractor
+from bika.lims.browser.reports.resolver import BrainResolver
+from bika.lims.browser.reports.storage import get_default_directory
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    # The snapshot is optional, the reports walk the catalog without it
+    numpy = None
+
+CATALOG = "bika_analysis_catalog"
+
+# Fields kept as integer codes of their values
+CODE_FIELDS = ("service", "client", "sampletype", "department", "category",
+               "review_state", "cancellation_state", "analyst", "instrument",
+               "ar", "patient", "result_text")
+
+# Fields kept as seconds since the epoch
+DATE_FIELDS = ("created", "received", "due", "captured", "verified",
+               "published")
+
+# Fields kept as floats
+FLOAT_FIELDS = ("result", ) + DATE_FIELDS
+
+NAN = float("nan")
+
+# Arrays of the snapshot: name, dtype and value of the rows not in use
+ARRAYS = (("uid", "S40", b""), ("alive", "i1", 0)) + \
+    tuple((field, "i4", -1) for field in CODE_FIELDS) + \
+    tuple((field, "f8", NAN) for field in FLOAT_FIELDS)
+
+# Indexes of the analysis catalog a query can filter by -> field
+INDEX_FIELDS = {
+    "getServiceUID": "service",
+    "ServiceUID": "service",
+    "getClientUID": "client",
+    "getSampleTypeUID": "sampletype",
+    "getDepartmentUID": "department",
+    "getCategoryUID": "category",
+    "review_state": "review_state",
+    "cancellation_state": "cancellation_state",
+    "getAnalyst": "analyst",
+    "getInstrumentUID": "instrument",
+}
+
+# Date indexes of the analysis catalog a query can filter by -> field
+DATE_INDEXES = {
+    "created": "created",
+    "getDateReceived": "received",
+    "getDueDate": "due",
+    "getResultCaptureDate": "captured",
+    "getDatePublished": "published",
+}
+
+# Query keys that do not filter the analyses
+IGNORED_KEYS = ("portal_type", "sort_on", "sort_order")
+
+# Columns of the analysis brains the snapshot is refreshed from
+COLUMNS = (
+    Column("service", metadata="getServiceUID"),
+    Column("client", metadata="getClientUID"),
+    Column("sampletype", metadata="getSampleTypeUID"),
+    Column("department", metadata="getDepartmentUID"),
+    Column("category", metadata="getCategoryUID"),
+    Column("review_state", accessor=get_state),
+    Column("cancellation_state",
+           accessor=lambda obj: get_state(obj, "cancellation_state")),
+    Column("analyst", metadata="getAnalyst"),
+    Column("instrument", metadata="getInstrumentUID"),
+    Column("ar", metadata="getParentUID"),
+    Column("created"),
+    Column("received", metadata="getDateReceived"),
+    Column("due", metadata="getDueDate"),
+    Column("captured", metadata="getResultCaptureDate"),
+    Column("verified", metadata="getDateVerified"),
+    Column("published", metadata="getDatePublished"),
+    Column("result", metadata="getResult"),
+)
+
+# Minimum number of rows the arrays have room for
+MIN_CAPACITY = 1024
+
+# Seconds of changes read again on each refresh, for the transactions that
+# were committed after the previous refresh with an earlier modified date
+REFRESH_OVERLAP = 300
+
+# Seconds a report waits for the refresh of another process
+REFRESH_TIMEOUT = 300
+
+# Generations of files replaced longer than this ago are removed, the
+# reports that started before that are expected to be finished
+GENERATION_MAX_AGE = 3600
+
+# Key of the analyses with a workflow transition in the annotations of the
+# portal
+TRANSITIONS_ANNOTATION_KEY = "bika.lims.reports.snapshot.transitions"
+
+# Seconds the analyses with a workflow transition are kept for the refreshes
+TRANSITIONS_MAX_AGE = 7 * 24 * 3600
+
+# Number of analyses whose Analysis Requests are fetched at once
+PREFETCH_EVERY = 1000
+
+DAY = 86400
+
+
+def to_seconds(date):
+    """Returns the seconds since the epoch of the date passed in, or NaN
+    """
+    date = api.to_date(date, None)
+    if date is None:
+        return NAN
+    return date.timeTime()
+
+
+def split_result(result):
+    """Returns the result as a float and its text, if not numeric
+    """
+    if result is None or result == "":
+        return NAN, result or None
+    try:
+        return float(result), None
+    except (TypeError, ValueError):
+        return NAN, result
+
+
+def get_utc_offset(seconds):
+    """Returns the seconds local time is ahead of UTC at the time passed in
+    """
+    return calendar.timegm(time.localtime(seconds)) - int(seconds)
+
+
+def to_local_days(seconds):
+    """Returns the days since the epoch, in local time, of the array of
+    seconds passed in
+    """
+    utc_days = numpy.floor(seconds / DAY).astype("i8")
+    days, inverse = numpy.unique(utc_days, return_inverse=True)
+    offsets = numpy.array([get_utc_offset(day * DAY) for day in days],
+                          dtype="f8")
+    return numpy.floor((seconds + offsets[inverse]) / DAY).astype("i8")
+
+
+def from_local_day(day):
+    """Returns the DateTime of the noon of the local day passed in
+    """
+    year, month, day = time.gmtime(int(day) * DAY)[:3]
+    return DateTime(year, month, day, 12, 0, 0)
+
+
+class Snapshot(object):
+    """A version of the snapshot, with its arrays mapped read-only
+    """
+
+    def __init__(self, store, state, arrays):
+        self.store = store
+        self.state = state
+        self.rows = state["rows"]
+        self.arrays = arrays
+        # field -> values of the codes, read on demand
+        self.codes = {}
+        # field -> value -> code
+        self.lookups = {}
+
+    def column(self, name):
+        """Returns the array of the field passed in, for the rows in use
+        """
+        return self.arrays[name][:self.rows]
+
+    def get_codes(self, field):
+        """Returns the values of the codes of the field passed in
+        """
+        codes = self.codes.get(field, None)
+        if codes is None:
+            codes = self.store.read_codes(self.state, field)
+            self.codes[field] = codes
+        return codes
+
+    def get_code(self, field, value):
+        """Returns the code of the value of the field passed in, or None if
+        no row has that value
+        """
+        lookup = self.lookups.get(field, None)
+        if lookup is None:
+            codes = self.get_codes(field)
+            lookup = dict((value, code) for code, value in enumerate(codes))
+            self.lookups[field] = lookup
+        return lookup.get(value, None)
+
+    def get_value(self, field, code):
+        """Returns the value of the code of the field passed in
+        """
+        codes = self.get_codes(field)
+        if 0 <= code < len(codes):
+            return codes[code]
+        return None
+
+    def find_codes(self, field, predicate):
+        """Returns the codes of the field whose value passes the predicate
+        """
+        codes = self.get_codes(field)
+        return [code for code, value in enumerate(codes) if predicate(value)]
+
+    def isin(self, field, values):
+        """Returns the mask of the rows with any of the values passed in
+        """
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        codes = [self.get_code(field, value) for value in values]
+        codes = [code for code in codes if code is not None]
+        if None in values:
+            codes.append(-1)
+        return numpy.isin(self.column(field), codes)
+
+    def between(self, field, date_from=None, date_to=None):
+        """Returns the mask of the rows with a date from date_from to date_to
+        (both included, None for no limit)
+        """
+        dates = self.column(field)
+        mask = ~numpy.isnan(dates)
+        if date_from is not None:
+            mask &= dates >= to_seconds(date_from)
+        if date_to is not None:
+            mask &= dates <= to_seconds(date_to)
+        return mask
+
+    def select(self, query):
+        """Returns the mask of the analyses the catalog query passed in
+        returns, or None if the snapshot can not answer it
+        """
+        if query.get("portal_type", "Analysis") != "Analysis":
+            return None
+        mask = self.column("alive") == 1
+        for key, value in query.items():
+            if key in IGNORED_KEYS:
+                continue
+            if key in DATE_INDEXES:
+                date_range = get_date_range(value)
+                if date_range is None:
+                    return None
+                mask &= self.between(DATE_INDEXES[key], *date_range)
+            elif key in INDEX_FIELDS:
+                if isinstance(value, dict):
+                    if set(value.keys()) != set(["query"]):
+                        return None
+                    value = value["query"]
+                mask &= self.isin(INDEX_FIELDS[key], value)
+            else:
+                return None
+        return mask
+
+    def sum_by(self, field, mask, weights=None):
+        """Returns a dict of value of the field -> number of rows of the mask
+        with that value, or sum of their weights. weights is an array with
+        a value for each row of the mask
+        """
+        codes = self.column(field)[mask] + 1
+        if not len(codes):
+            return {}
+        sums = numpy.bincount(codes, weights=weights)
+        return dict((self.get_value(field, code - 1), sums[code])
+                    for code in numpy.unique(codes))
+
+
+class SnapshotWriter(object):
+    """Writes the rows of a refresh of the snapshot to a new generation of
+    files, the readers keep reading the current one until it is published
+    """
+
+    def __init__(self, store, state, expected):
+        self.store = store
+        self.state = dict(state or {"generation": None, "rows": 0,
+                                    "capacity": 0, "codes": {},
+                                    "version": 0})
+        self.rows = self.state["rows"]
+        self.codes = {}
+        self.lookups = {}
+        # the generation published, replaced by the one written
+        self.previous = self.state["generation"]
+        self.arrays = None
+        if self.previous is not None:
+            self.arrays = store.open(self.previous)
+        self.copy(self.rows + expected)
+        uids = self.arrays["uid"][:self.rows]
+        self.uids = dict((uid.decode("ascii"), row)
+                         for row, uid in enumerate(uids))
+
+    def copy(self, rows):
+        """Copies the arrays to a new generation of files with room for the
+        number of rows passed in
+        """
+        capacity = self.state["capacity"]
+        if rows > capacity:
+            capacity = max(MIN_CAPACITY, capacity * 2, rows)
+        generation = "{}-{}".format(time.strftime("%Y%m%d%H%M%S"),
+                                    uuid.uuid4().hex[:8])
+        os.makedirs(self.store.get_path(generation))
+        arrays = {}
+        for name, dtype, fill in ARRAYS:
+            path = self.store.get_path(generation, "{}.npy".format(name))
+            array = open_memmap(path, mode="w+", dtype=dtype,
+                                shape=(capacity, ))
+            array[:] = fill
+            if self.arrays is not None:
+                array[:self.rows] = self.arrays[name][:self.rows]
+            arrays[name] = array
+        # The codes are written to the new generation too
+        for field in CODE_FIELDS:
+            self.get_codes(field)
+        if self.state["generation"] != self.previous:
+            # Grown while writing, this generation was never published
+            shutil.rmtree(self.store.get_path(self.state["generation"]),
+                          ignore_errors=True)
+        self.arrays = arrays
+        self.state.update(generation=generation, capacity=capacity)
+
+    def get_codes(self, field):
+        codes = self.codes.get(field, None)
+        if codes is None:
+            codes = self.store.read_codes(self.state, field)
+            self.codes[field] = codes
+            self.lookups[field] = dict(
+                (value, code) for code, value in enumerate(codes))
+        return codes
+
+    def get_code(self, field, value):
+        """Returns the code of the value of the field, added if new
+        """
+        if value is None:
+            return -1
+        codes = self.get_codes(field)
+        code = self.lookups[field].get(value, None)
+        if code is None:
+            code = len(codes)
+            codes.append(value)
+            self.lookups[field][value] = code
+        return code
+
+    def write(self, uid, values):
+        """Writes the row of the analysis with the UID passed in
+        """
+        row = self.uids.get(uid, None)
+        if row is None:
+            if self.rows == self.state["capacity"]:
+                self.copy(self.rows + 1)
+            row = self.rows
+            self.rows += 1
+            self.uids[uid] = row
+            self.arrays["uid"][row] = uid.encode("ascii")
+        self.arrays["alive"][row] = 1
+        for field in CODE_FIELDS:
+            self.arrays[field][row] = self.get_code(field, values[field])
+        for field in FLOAT_FIELDS:
+            self.arrays[field][row] = values[field]
+
+    def remove_deleted(self, catalog):
+        """Flags the rows of the analyses that are not in the catalog
+        anymore. Returns the number of rows flagged
+        """
+        alive = self.arrays["alive"]
+        total = len(catalog.unrestrictedSearchResults(portal_type="Analysis"))
+        if total == int(numpy.count_nonzero(alive[:self.rows])):
+            return 0
+        index = getattr(get_index(catalog, "UID"), "_index", None)
+        if index is None:
+            return 0
+        removed = 0
+        for uid, row in self.uids.items():
+            if alive[row] and uid not in index:
+                alive[row] = 0
+                removed += 1
+        return removed
+
+    def publish(self, modified):
+        """Makes the generation written, with its codes, visible to the
+        readers
+        """
+        generation = self.state["generation"]
+        for field in CODE_FIELDS:
+            path = self.store.get_path(generation,
+                                       "codes-{}.json".format(field))
+            self.store.write_json(path, self.codes[field])
+        for array in self.arrays.values():
+            array.flush()
+        codes = dict((field, len(values))
+                     for field, values in self.codes.items())
+        self.state.update(rows=self.rows, codes=codes, modified=modified,
+                          refreshed=time.time(),
+                          version=self.state["version"] + 1)
+        self.store.write_json(self.store.get_state_path(), self.state)
+        if self.previous is not None:
+            # The age of a generation counts from when it was replaced
+            try:
+                os.utime(self.store.get_path(self.previous), None)
+            except OSError:
+                pass
+
+
+class SnapshotStore(object):
+    """Directory of the snapshot files, shared by the Zope processes of the
+    host
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.lock = threading.Lock()
+        # thread of the background refresh of this process
+        self.refresher = None
+
+    @property
+    def directory(self):
+        return get_setting(REPORT_SNAPSHOT_DIR, None) or \
+            get_default_directory("report-snapshot")
+
+    def get_state_path(self):
+        return os.path.join(self.directory, "current.json")
+
+    def get_path(self, generation, name=None):
+        if name is None:
+            return os.path.join(self.directory, generation)
+        return os.path.join(self.directory, generation, name)
+
+    def read_state(self):
+        """Returns the state of the current version, or None if the snapshot
+        is not built
+        """
+        try:
+            with open(self.get_state_path()) as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read_codes(self, state, field):
+        """Returns the values of the codes of the field, up to the number the
+        state passed in knows of
+        """
+        num = state["codes"].get(field, 0)
+        if not num:
+            return []
+        path = self.get_path(state["generation"],
+                             "codes-{}.json".format(field))
+        with open(path) as codes_file:
+            return json.load(codes_file)[:num]
+
+    def write_json(self, path, data):
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written file
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as json_file:
+            json.dump(data, json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.rename(tmp_path, path)
+
+    def open(self, generation, mode="r"):
+        """Maps the arrays of the generation passed in
+        """
+        arrays = {}
+        for name, dtype, fill in ARRAYS:
+            path = self.get_path(generation, "{}.npy".format(name))
+            arrays[name] = numpy.load(path, mmap_mode=mode)
+        return arrays
+
+    def get_snapshot(self):
+        """Returns the current Snapshot, or None if it is not built or NumPy
+        is not available
+        """
+        if numpy is None:
+            return None
+        state = self.read_state()
+        if state is None:
+            return None
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.state == state:
+            return snapshot
+        if snapshot is not None and \
+                snapshot.state["generation"] == state["generation"]:
+            arrays = snapshot.arrays
+        else:
+            arrays = self.open(state["generation"])
+        self.snapshot = Snapshot(self, state, arrays)
+        return self.snapshot
+
+    def get_fresh(self, request=None):
+        """Returns the current Snapshot, and starts its refresh in the
+        background if it is older than BIKA_REPORTS_SNAPSHOT_MAX_AGE seconds.
+        Returns None if it is not built or NumPy is not available
+        """
+        if numpy is None:
+            return None
+        state = self.read_state()
+        if state is None:
+            return None
+        max_age = get_setting(REPORT_SNAPSHOT_MAX_AGE, 300, int)
+        if time.time() - state["refreshed"] > max_age:
+            self.refresh_in_background()
+        return self.get_snapshot()
+
+    def refresh_in_background(self):
+        """Starts the refresh of the snapshot in a thread, unless this
+        process is refreshing it already
+        """
+        with self.lock:
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            site_path = "/".join(api.get_portal().getPhysicalPath())
+            self.refresher = threading.Thread(
+                target=self.refresh_site, args=(site_path, ),
+                name="report-snapshot-refresh")
+            self.refresher.daemon = True
+            self.refresher.start()
+
+    def refresh_site(self, site_path):
+        """Refreshes the snapshot of the site passed in, with a new
+        connection to the database
+        """
+        import Zope2
+        app = Zope2.app()
+        try:
+            setSite(app.unrestrictedTraverse(site_path))
+            self.refresh()
+        except Exception:
+            logger.error("Snapshot refresh failed: {}".format(
+                traceback.format_exc()))
+        finally:
+            transaction.abort()
+            setSite(None)
+            app._p_jar.close()
+
+    def refresh(self, request=None, full=False):
+        """Updates the snapshot with the analyses modified since the last
+        refresh, or with all the analyses if full. Returns the number of
+        analyses read from the catalog
+        """
+        if numpy is None:
+            return 0
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another instance in the meantime
+                pass
+        lock = FileLock("reports-snapshot")
+        state = self.read_state()
+        waited = lock.acquire(REFRESH_TIMEOUT)
+        if waited is None:
+            logger.warn("Snapshot not refreshed, another process is still "
+                        "refreshing it")
+            return 0
+        try:
+            if waited and not full and self.read_state() != state:
+                # Refreshed by the process we waited for
+                return 0
+            return self.update(request, None if full else state)
+        finally:
+            lock.release()
+
+    def update(self, request, state):
+        started = time.time()
+        catalog = api.get_tool(CATALOG)
+        query = {"portal_type": "Analysis"}
+        if state is not None:
+            since = DateTime(state["modified"] - REFRESH_OVERLAP)
+            query["modified"] = {"query": since, "range": "min"}
+        analyses = catalog.unrestrictedSearchResults(query)
+        if state is not None:
+            analyses = self.add_transitioned(catalog, analyses, since)
+        writer = SnapshotWriter(self, state, len(analyses))
+        extractor = RowExtractor(request, COLUMNS)
+        resolver = None
+        for num, brain in enumerate(analyses):
+            if num % PREFETCH_EVERY == 0:
+                resolver = BrainResolver(clients=False, patients=False,
+                                         batches=False)
+                resolver.prefetch(analyses[num:num + PREFETCH_EVERY])
+            if request is not None and num % CHECK_EVERY == 0:
+                check_cancelled(request)
+            row = extractor.extract(brain)
+            values = {}
+            for field in CODE_FIELDS[:-2]:
+                values[field] = row[field] or None
+            ar = resolver.get_ar(brain)
+            values["patient"] = getattr(ar, "getPatientUID", None) or None
+            values["result"], values["result_text"] = \
+                split_result(row["result"])
+            for field in DATE_FIELDS:
+                values[field] = to_seconds(row[field])
+            writer.write(api.get_uid(brain), values)
+        removed = 0
+        if state is not None:
+            removed = writer.remove_deleted(catalog)
+        writer.publish(started)
+        if request is not None:
+            extractor.finish()
+        self.cleanup()
+        logger.info("Snapshot refreshed with {} analyses, {} removed, {} rows"
+                    .format(len(analyses), removed, writer.rows))
+        return len(analyses)
+
+    def add_transitioned(self, catalog, analyses, since):
+        """Returns the brains passed in plus the ones of the analyses that
+        had a workflow transition since the date passed in
+        """
+        uids = get_transitioned(since.timeTime())
+        if not uids:
+            return analyses
+        uids.difference_update([brain.UID for brain in analyses])
+        if not uids:
+            return analyses
+        transitioned = catalog.unrestrictedSearchResults(
+            portal_type="Analysis", UID=list(uids))
+        return list(analyses) + list(transitioned)
+
+    def cleanup(self):
+        """Removes the files of the generations replaced more than
+        GENERATION_MAX_AGE seconds ago
+        """
+        state = self.read_state()
+        limit = time.time() - GENERATION_MAX_AGE
+        for name in os.listdir(self.directory):
+            path = self.get_path(name)
+            if not os.path.isdir(path) or name == state["generation"]:
+                continue
+            try:
+                if os.path.getmtime(path) < limit:
+                    shutil.rmtree(path)
+            except OSError:
+                # removed by another instance in the meantime
+                pass
+
+
+def get_transitioned(since):
+    """Returns the set of UIDs of the analyses that had a workflow
+    transition since the seconds since the epoch passed in
+    """
+    portal = api.get_portal()
+    minutes = IAnnotations(portal).get(TRANSITIONS_ANNOTATION_KEY, None)
+    if minutes is None:
+        return set()
+    uids = set()
+    for minute_uids in minutes.values(min=int(since / 60)):
+        uids.update(minute_uids)
+    return uids
+
+
+def mark_transitioned(analyses):
+    """Records the UIDs of the analyses passed in for the next refresh of
+    the snapshot. The analyses of the minutes older than TRANSITIONS_MAX_AGE
+    are forgotten
+    """
+    if numpy is None:
+        return
+    annotations = IAnnotations(api.get_portal())
+    minutes = annotations.get(TRANSITIONS_ANNOTATION_KEY, None)
+    if minutes is None:
+        minutes = annotations[TRANSITIONS_ANNOTATION_KEY] = IOBTree()
+    minute = int(time.time() / 60)
+    uids = minutes.get(minute, None)
+    if uids is None:
+        uids = minutes[minute] = OOTreeSet()
+        limit = minute - TRANSITIONS_MAX_AGE / 60
+        for old in list(minutes.keys(max=limit, excludemax=True)):
+            del minutes[old]
+    for analysis in analyses:
+        if api.get_portal_type(analysis) == "Analysis":
+            uids.insert(api.get_uid(analysis))
+
+
+def analysis_transition(analysis, event):
+    """Event handler called after a workflow transition of an analysis
+    """
+    mark_transitioned([analysis])
+
+
+def analysisrequest_transition(ar, event):
+    """Event handler called after a workflow transition of an Analysis
+    Request. The dates of its analyses might have changed (e.g. published)
+    """
+    mark_transitioned(ar.objectValues("Analysis"))
+
+
+# The snapshot store of this Zope instance
+store = SnapshotStore()
+
+
+def get_snapshot_store():
+    """Returns the snapshot store of this Zope instance
+    """
+    return store
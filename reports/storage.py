@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Storage of the generated report files.
+
+The files are not stored in the ZODB. They are written to a content
+addressed directory (BIKA_REPORTS_ARTIFACTS_DIR, by default the
+report-artifacts folder of the Zope client home), named after the sha256
+of their contents, so the same file generated twice is stored once.
+
+The Report object created in the reports folder is a lightweight index
+record: it keeps the title, client and the hash of the file in its
+annotations. Its id is made of a timestamp and a random suffix instead of
+a shared counter, so concurrent reports never conflict on it.
+
+The number of Report objects that point to each file is kept in the
+annotations of the portal, and the file is removed once the last one is
+deleted. The default directory is local to the Zope instance, so with ZEO
+BIKA_REPORTS_ARTIFACTS_DIR must be set to a directory shared by all the
+instances: they refuse to start otherwise.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+import transaction
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from bika.lims import api
+from bika.lims import logger
+from bika.lims.browser.reports.config import REPORT_ARTIFACTS_DIR
+from bika.lims.browser.reports.config import get_setting
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+from zope.configuration.exceptions import ConfigurationError
+
+# Key of the artifact metadata in the annotations of the Report objects
+ARTIFACT_ANNOTATION_KEY = "bika.lims.reports.artifact"
+
+# Key of the number of Report objects of each file in the annotations of
+# the portal
+REFERENCES_ANNOTATION_KEY = "bika.lims.reports.artifact.references"
+
+# Files stored again less than this seconds ago are not removed, a Report
+# object pointing to them might be committed in the meantime
+REMOVE_GRACE = 3600
+
+
+def get_default_directory(name="report-artifacts"):
+    """Returns the directory with the name passed in of the Zope client home
+    """
+    try:
+        from App.config import getConfiguration
+        clienthome = getConfiguration().clienthome
+    except (ImportError, AttributeError):
+        clienthome = None
+    return os.path.join(clienthome or tempfile.gettempdir(), name)
+
+
+class ArtifactStore(object):
+    """Content addressed directory of report files
+    """
+
+    @property
+    def directory(self):
+        return get_setting(REPORT_ARTIFACTS_DIR, None) or \
+            get_default_directory()
+
+    def get_path(self, digest):
+        """Returns the path of the file with the hash passed in
+        """
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """Stores the data and returns its hash. Data already stored is not
+        written again
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.get_path(digest)
+        if os.path.exists(path):
+            try:
+                os.utime(path, None)
+                return digest
+            except OSError:
+                # removed in the meantime, written again
+                pass
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another thread or instance in the meantime
+                pass
+
+        # Write to a temporary file and rename it, so readers never see a
+        # partially written file
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "wb") as artifact:
+            artifact.write(data)
+            artifact.flush()
+            os.fsync(artifact.fileno())
+        os.rename(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        """Returns the data with the hash passed in, or None
+        """
+        try:
+            with open(self.get_path(digest), "rb") as artifact:
+                return artifact.read()
+        except (IOError, OSError):
+            return None
+
+    def remove(self, digest):
+        """Removes the file with the hash passed in, unless it was stored
+        again less than REMOVE_GRACE seconds ago
+        """
+        path = self.get_path(digest)
+        try:
+            if os.path.getmtime(path) > time.time() - REMOVE_GRACE:
+                return
+            os.remove(path)
+        except OSError:
+            # removed by another instance in the meantime
+            pass
+
+
+def uses_zeo():
+    """Returns whether the main database of this Zope instance is a ZEO
+    client
+    """
+    try:
+        import Zope2
+        from ZEO.ClientStorage import ClientStorage
+    except ImportError:
+        return False
+    storage = getattr(getattr(Zope2, "DB", None), "storage", None)
+    return isinstance(storage, ClientStorage)
+
+
+def check_directory(event):
+    """Event handler that stops the Zope process when it starts as a ZEO
+    client without BIKA_REPORTS_ARTIFACTS_DIR. The files stored in its own
+    client home would not be found by the other instances
+    """
+    if uses_zeo() and not get_setting(REPORT_ARTIFACTS_DIR, None):
+        raise ConfigurationError(
+            "{} must be set to a directory shared by all the ZEO clients"
+            .format(REPORT_ARTIFACTS_DIR))
+
+
+def new_report_id():
+    """Returns a new id for a Report object. Unlike generateUniqueId, it does
+    not increment a counter shared by all concurrent transactions
+    """
+    return "report-{}-{}".format(DateTime().strftime("%Y%m%d%H%M%S"),
+                                 uuid.uuid4().hex[:8])
+
+
+def get_references(create=False):
+    """Returns the mapping of file hash -> number of Report objects that
+    point to the file
+    """
+    annotations = IAnnotations(api.get_portal())
+    references = annotations.get(REFERENCES_ANNOTATION_KEY, None)
+    if references is None and create:
+        references = annotations[REFERENCES_ANNOTATION_KEY] = OOBTree()
+    return references
+
+
+def set_artifact(report, digest, size, content_type, filename):
+    """Links the Report object to the stored file
+    """
+    annotations = IAnnotations(report)
+    annotations[ARTIFACT_ANNOTATION_KEY] = PersistentMapping({
+        "digest": digest,
+        "size": size,
+        "content_type": content_type,
+        "filename": filename,
+    })
+    references = get_references(create=True)
+    counter = references.get(digest, None)
+    if counter is None:
+        counter = references[digest] = Length()
+    counter.change(1)
+
+
+def get_artifact(report):
+    """Returns the metadata of the file of the Report object, or None if the
+    file is stored in the ZODB
+    """
+    artifact = IAnnotations(report).get(ARTIFACT_ANNOTATION_KEY, None)
+    return artifact and dict(artifact) or None
+
+
+def get_file_size(report):
+    """Returns the size of the stored file of the Report object, formatted
+    as Report.getFileSize does, or None if the file is stored in the ZODB
+    """
+    artifact = get_artifact(report)
+    if artifact is None:
+        return None
+    return "%.0f Kb" % (artifact["size"] / 1024.0)
+
+
+def get_report_data(report):
+    """Returns the contents of the file of the Report object passed in, or
+    None if it does not exist anymore
+    """
+    artifact = get_artifact(report)
+    if artifact is not None:
+        return get_store().get(artifact["digest"])
+    # Reports stored before the artifact store
+    report_file = report.getReportFile()
+    return report_file and str(report_file.data) or None
+
+
+def report_removed(report, event):
+    """Event handler called when a Report object is deleted. Its file is
+    removed once the transaction is committed, if no other Report object
+    points to it
+    """
+    artifact = get_artifact(report)
+    references = get_references()
+    if artifact is None or references is None:
+        return
+    digest = artifact["digest"]
+    counter = references.get(digest, None)
+    if counter is None:
+        # stored before the references were counted
+        return
+    counter.change(-1)
+    if counter() > 0:
+        return
+
+    def remove(committed):
+        if committed:
+            get_store().remove(digest)
+            logger.info("Report file {} removed".format(digest))
+
+    transaction.get().addAfterCommitHook(remove)
+
+
+# The artifact store of this Zope instance
+store = ArtifactStore()
+
+
+def get_store():
+    """Returns the artifact store of this Zope instance
+    """
+    return store
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Streaming of the CSV output of reports.
+
+Reports used to build the whole list of rows first, write them to a
+StringIO and send the resulting string to the response, keeping the output
+in memory about three times. stream_csv takes the rows from a generator
+instead, and writes them to the response in chunks of
+BIKA_REPORTS_CSV_CHUNK_SIZE bytes while they are produced. The memory used
+does not grow with the number of rows, and the browser gets the first
+bytes right away:
+
+    if self.request.get('output_format', '') == 'CSV':
+        self.rows_streamed = stream_csv(self.request, "dailysamplesreceived",
+                                        fieldnames, self.get_datalines(brains))
+        return
+"""
+
+import StringIO
+import csv
+import datetime
+
+from bika.lims.browser.reports.config import REPORT_CSV_CHUNK_SIZE
+from bika.lims.browser.reports.config import get_setting
+from bika.lims.browser.reports.timing import stage
+
+
+def encode(value):
+    """Returns the value as a string the csv module can write
+    """
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class CSVStream(object):
+    """Writes CSV rows to the response in chunks
+    """
+
+    def __init__(self, response, fieldnames, chunk_size=None):
+        self.response = response
+        self.fieldnames = fieldnames
+        if chunk_size is None:
+            chunk_size = get_setting(REPORT_CSV_CHUNK_SIZE, 65536, int)
+        self.chunk_size = chunk_size
+        self.buffer = StringIO.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.rows = 0
+
+    def writerow(self, row):
+        """Writes a row, either a dict (keys not in fieldnames are ignored)
+        or a sequence of values in the order of fieldnames
+        """
+        if isinstance(row, dict):
+            row = [row.get(name, "") for name in self.fieldnames]
+        self.writer.writerow([encode(value) for value in row])
+        self.rows += 1
+        if self.buffer.tell() >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        data = self.buffer.getvalue()
+        if data:
+            self.response.write(data)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+def stream_csv(request, name, fieldnames, rows):
+    """Writes the header and the rows passed in to the response as a CSV
+    file named after the report and the current time, timed as the rows
+    stage of the run. Returns the number of rows written
+    """
+    date = datetime.datetime.now().strftime("%Y%m%d%H%M")
+    setheader = request.RESPONSE.setHeader
+    setheader("Content-Type", "text/csv")
+    setheader("Content-Disposition",
+              "attachment;filename=\"%s_%s.csv\"" % (name, date))
+
+    stream = CSVStream(request.RESPONSE, fieldnames)
+    stream.writerow(fieldnames)
+    with stage(request, "rows"):
+        for row in rows:
+            stream.writerow(row)
+        stream.flush()
+    # The header row is not a row of the report
+    return stream.rows - 1
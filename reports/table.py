@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Compact storage of the data lines of a report.
+
+Reports rendered with report_out.pt used to build each cell of the table as
+a dict ({'value': ...}, sometimes with 'class', 'colspan', 'img_before' or
+'img_after'), so a report of 100k analyses kept millions of small dicts.
+A Table keeps each row as a tuple of values instead, and the attributes of
+the few cells that have any in a sparse dict:
+
+    table = Table()
+    for brain in brains:
+        table.append((brain.getRequestID, brain.Title, brain.getResult))
+    table.style(row=0, column=2, img_after="++resource++...")
+
+    self.report_content = {..., 'datalines': table, ...}
+
+report_out.pt iterates the Table as any other list of data lines: the cell
+dicts of a row are only created while that row is rendered. The CSV writers
+take the raw values from Table.values().
+"""
+
+
+class Line(object):
+    """A data line of a Table, as the list of cell dicts report_out.pt
+    expects. The dicts are created on access
+    """
+    __slots__ = ("values", "styles")
+
+    def __init__(self, values, styles):
+        self.values = values
+        self.styles = styles
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        cell = {"value": self.values[index]}
+        if self.styles:
+            cell.update(self.styles.get(index, {}))
+        return cell
+
+    def __iter__(self):
+        for index in range(len(self.values)):
+            yield self[index]
+
+
+class Table(object):
+    """Data lines of a report, as tuples of values with sparse cell
+    attributes
+    """
+
+    def __init__(self, rows=None, styles=None):
+        self.rows = rows or []
+        # row index -> column index -> attributes of the cell
+        self.styles = styles or {}
+
+    def append(self, values, styles=None):
+        """Adds a row with the values passed in. styles is an optional dict
+        of column index -> attributes of the cell
+        """
+        self.rows.append(tuple(values))
+        if styles:
+            self.styles[len(self.rows) - 1] = styles
+
+    def style(self, row, column, **attributes):
+        """Sets attributes of the cell passed in (e.g. class or colspan)
+        """
+        self.styles.setdefault(row, {}).setdefault(column, {}).update(
+            attributes)
+
+    def values(self):
+        """Returns an iterator over the rows, as tuples of values
+        """
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __nonzero__(self):
+        return bool(self.rows)
+
+    __bool__ = __nonzero__
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Used to render the report in chunks of rows
+            start, stop, step = index.indices(len(self.rows))
+            rows = self.rows[index]
+            styles = {}
+            for row in range(start, stop, step):
+                if row in self.styles:
+                    styles[(row - start) // step] = self.styles[row]
+            return Table(rows, styles)
+        if index < 0:
+            index += len(self.rows)
+        return Line(self.rows[index], self.styles.get(index, None))
+
+    def __iter__(self):
+        for index, values in enumerate(self.rows):
+            yield Line(values, self.styles.get(index, None))
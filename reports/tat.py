@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Percentiles of turnaround times.
+
+Average turnaround times hide the tail of slow analyses. Computing exact
+percentiles needs all the turnaround times at once though, and they cannot
+be combined from the partial aggregates of days (daycache.py) or shards
+(shards.py). A t-digest is a small sketch of the distribution of values
+that estimates their percentiles, with the best accuracy at the tails, and
+two t-digests merge into the t-digest of the values of both:
+
+    digest = TDigest()
+    digest.update(durations)
+    digest.merge(TDigest.from_json(partial["tat"]))
+    p90 = digest.quantile(0.9)
+
+The sketch is a list of centroids (mean and number of values), at most
+about COMPRESSION of them whatever the number of values, and is stored in
+the partial aggregates as json with to_json.
+"""
+
+import math
+
+from DateTime import DateTime
+
+# Accuracy of the digests. The number of centroids is bounded by about this
+COMPRESSION = 100
+
+# Percentiles of the turnaround times shown by the reports
+PERCENTILES = (0.5, 0.9, 0.95)
+
+
+def get_duration(start, end):
+    """Returns the minutes from start to end (DateTime), or None if start is
+    not set. end is now if not set, as Analysis.getDuration computes it
+    """
+    if not start:
+        return None
+    if not end:
+        end = DateTime()
+    return int(round((end - start) * 24 * 60))
+
+
+class TDigest(object):
+    """Mergeable sketch of a distribution of values (merging t-digest)
+    """
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        # sorted list of [mean, weight]
+        self.centroids = []
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return int(self.total)
+
+    @classmethod
+    def from_json(cls, data, compression=COMPRESSION):
+        """Returns the digest of the json data returned by to_json
+        """
+        digest = cls(compression)
+        if data:
+            digest.min = data["min"]
+            digest.max = data["max"]
+            digest.centroids = [list(centroid)
+                                for centroid in data["centroids"]]
+            digest.total = sum([weight for mean, weight in digest.centroids])
+        return digest
+
+    def to_json(self):
+        return {
+            "min": self.min,
+            "max": self.max,
+            "centroids": self.centroids,
+        }
+
+    def update(self, values, weights=None):
+        """Adds the values passed in, each one weights times if set
+        """
+        if weights is None:
+            weights = [1] * len(values)
+        added = [[value, weight] for value, weight in zip(values, weights)
+                 if weight > 0]
+        if not added:
+            return
+        self.add_centroids(added, min([value for value, w in added]),
+                           max([value for value, w in added]))
+
+    def add(self, value, weight=1):
+        self.update([value], [weight])
+
+    def merge(self, other):
+        """Adds the values of the digest passed in
+        """
+        if other.total:
+            self.add_centroids(other.centroids, other.min, other.max)
+        return self
+
+    def add_centroids(self, centroids, minimum, maximum):
+        if self.min is None or minimum < self.min:
+            self.min = minimum
+        if self.max is None or maximum > self.max:
+            self.max = maximum
+        centroids = sorted(self.centroids + [list(c) for c in centroids])
+        self.total = sum([weight for mean, weight in centroids])
+        self.centroids = self.compress(centroids)
+
+    def get_limit(self, weight):
+        """Returns the weight up to which the centroid that starts at the
+        weight passed in can grow. The centroids are kept small near the
+        tails and large in the middle of the distribution
+        """
+        delta = self.compression
+        q = float(weight) / self.total
+        k = delta / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        angle = min(max(2 * math.pi * k / delta, -math.pi / 2), math.pi / 2)
+        return (math.sin(angle) + 1) / 2 * self.total
+
+    def compress(self, centroids):
+        """Merges the neighbour centroids of the sorted list passed in as
+        long as they are under the size limit of their position
+        """
+        merged = []
+        weight = 0
+        current = None
+        limit = 0
+        for centroid in centroids:
+            if current is None:
+                current = centroid
+                limit = self.get_limit(weight)
+                continue
+            if weight + current[1] + centroid[1] <= limit:
+                total = float(current[1] + centroid[1])
+                current[0] += (centroid[0] - current[0]) * centroid[1] / total
+                current[1] = total
+                continue
+            merged.append(current)
+            weight += current[1]
+            current = centroid
+            limit = self.get_limit(weight)
+        if current is not None:
+            merged.append(current)
+        return merged
+
+    def quantile(self, q):
+        """Returns the estimate of the value below which the fraction q of
+        the values lies, or None if the digest is empty
+        """
+        if not self.total:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        # Interpolate between the centers of the centroids, and the minimum
+        # and maximum at the ends
+        previous_value = self.min
+        previous_position = 0
+        position = 0
+        for mean, weight in self.centroids:
+            center = position + weight / 2.0
+            if target < center:
+                span = center - previous_position
+                if not span:
+                    return mean
+                fraction = (target - previous_position) / span
+                return previous_value + (mean - previous_value) * fraction
+            previous_value = mean
+            previous_position = center
+            position += weight
+        span = self.total - previous_position
+        if not span:
+            return self.max
+        fraction = (target - previous_position) / span
+        return previous_value + (self.max - previous_value) * fraction
+
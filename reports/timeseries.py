@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Time series of durations bucketed by period.
+
+The turnaround times over time are the durations of the analyses grouped
+by the Day, Week, Month or Quarter they were received. The days are passed
+in as days since the epoch (local time), and the bucket of each day is
+computed with integer arithmetic, so the days of all the analyses are
+bucketed at once when they are NumPy arrays:
+
+    days = to_local_days(snapshot.column("received")[mask])
+    series = get_series(days, durations, "Week",
+                        groupings={"service": services})
+    for point in series["service"][service_uid]:
+        point["label"], point["count"], point["mean"], point["percentiles"]
+
+Several groupings (e.g. per service, per analyst and per instrument) are
+computed in the same call, the buckets are only computed once. Without
+groupings the series of all the durations is returned with the key None.
+The points of each series are sorted by date.
+"""
+
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    # Only needed to read the snapshot, see snapshot.py
+    numpy = None
+
+PERIODS = ("Day", "Week", "Month", "Quarter")
+
+# Percentiles of the durations of each bucket
+PERCENTILES = (0.5, 0.9)
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def to_local_day(date):
+    """Returns the days since the epoch of the local day of the DateTime
+    passed in
+    """
+    day = datetime.date(date.year(), date.month(), date.day())
+    return (day - EPOCH).days
+
+
+def from_local_day(day):
+    return EPOCH + datetime.timedelta(days=int(day))
+
+
+def to_civil(days):
+    """Returns the year and month of the days since the epoch passed in, an
+    int or an array of ints. This is the civil_from_days algorithm of
+    http://howardhinnant.github.io/date_algorithms.html
+    """
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 -
+                   day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 -
+                                year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    month = shifted_month + 3 - 12 * (shifted_month // 10)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year, month
+
+
+def get_buckets(days, period):
+    """Returns the bucket of the days since the epoch passed in, an int or
+    an array of ints. Buckets sort as the periods they stand for
+    """
+    if period == "Day":
+        return days
+    if period == "Week":
+        # The epoch is a Thursday, weeks start on Monday
+        return days - (days + 3) % 7
+    year, month = to_civil(days)
+    if period == "Month":
+        return year * 12 + month - 1
+    if period == "Quarter":
+        return year * 4 + (month - 1) // 3
+    raise ValueError("Unknown period {}".format(period))
+
+
+def get_label(bucket, period):
+    """Returns the text of the bucket of the period passed in
+    """
+    bucket = int(bucket)
+    if period in ("Day", "Week"):
+        return from_local_day(bucket).strftime("%d %b %Y")
+    if period == "Month":
+        return datetime.date(bucket // 12, bucket % 12 + 1, 1).strftime(
+            "%b %Y")
+    return "Q{} {}".format(bucket % 4 + 1, bucket // 4)
+
+
+def get_percentile(values, q):
+    """Returns the percentile q of the sorted values, interpolated linearly
+    """
+    position = q * (len(values) - 1)
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def to_points(keys, buckets, counts, sums, percentiles, period):
+    """Returns the dict of key -> points of the series, from the key, bucket
+    and statistics of each point sorted by key and bucket
+    """
+    series = {}
+    for num, key in enumerate(keys):
+        series.setdefault(key, []).append({
+            "bucket": int(buckets[num]),
+            "label": get_label(buckets[num], period),
+            "count": int(counts[num]),
+            "mean": float(sums[num]) / counts[num],
+            "percentiles": [float(values[num]) for values in percentiles],
+        })
+    return series
+
+
+def get_grouped_points(buckets, durations, keys, period):
+    """Returns the points of the series of each key, with numpy arrays
+    """
+    keys, key_index = numpy.unique(keys, return_inverse=True)
+    keys = keys.tolist()
+    bucket_values, bucket_index = numpy.unique(buckets, return_inverse=True)
+    group = key_index * len(bucket_values) + bucket_index
+    order = numpy.lexsort((durations, group))
+    group = group[order]
+    durations = durations[order]
+    groups, starts, counts = numpy.unique(group, return_index=True,
+                                          return_counts=True)
+    sums = numpy.add.reduceat(durations, starts)
+    percentiles = []
+    for q in PERCENTILES:
+        position = starts + q * (counts - 1)
+        low = numpy.floor(position).astype("i8")
+        high = numpy.minimum(low + 1, starts + counts - 1)
+        percentiles.append(durations[low] + (durations[high] -
+                                             durations[low]) * (position - low))
+    return to_points([keys[num] for num in groups // len(bucket_values)],
+                     bucket_values[groups % len(bucket_values)], counts,
+                     sums, percentiles, period)
+
+
+def get_grouped_points_from_lists(buckets, durations, keys, period):
+    """Returns the points of the series of each key, with lists
+    """
+    values = {}
+    for key, bucket, duration in zip(keys, buckets, durations):
+        values.setdefault((key, bucket), []).append(duration)
+    groups = sorted(values.keys())
+    counts = []
+    sums = []
+    percentiles = [[] for q in PERCENTILES]
+    for group in groups:
+        group_values = sorted(values[group])
+        counts.append(len(group_values))
+        sums.append(sum(group_values))
+        for num, q in enumerate(PERCENTILES):
+            percentiles[num].append(get_percentile(group_values, q))
+    return to_points([key for key, bucket in groups],
+                     [bucket for key, bucket in groups], counts, sums,
+                     percentiles, period)
+
+
+def get_series(days, durations, period, groupings=None):
+    """Returns a dict of grouping -> dict of key -> points of the series of
+    the durations of the days passed in, by period. groupings is a dict of
+    grouping -> key of each duration. The points are dicts with the bucket,
+    the label, the count, the mean and the PERCENTILES of the durations
+    """
+    if numpy is not None:
+        days = numpy.asarray(days, dtype="i8")
+        durations = numpy.asarray(durations, dtype="f8")
+        group_points = get_grouped_points
+    else:
+        group_points = get_grouped_points_from_lists
+    if not len(days):
+        if not groupings:
+            return {None: {None: []}}
+        return dict((name, {}) for name in groupings)
+
+    if numpy is not None:
+        buckets = get_buckets(days, period)
+    else:
+        buckets = [get_buckets(day, period) for day in days]
+    if not groupings:
+        keys = [0] * len(days)
+        if numpy is not None:
+            keys = numpy.zeros(len(days), dtype="i8")
+        points = group_points(buckets, durations, keys, period)
+        return {None: {None: points.get(0, [])}}
+    series = {}
+    for name, keys in groupings.items():
+        if numpy is not None:
+            keys = numpy.asarray(keys)
+        series[name] = group_points(buckets, durations, keys, period)
+    return series
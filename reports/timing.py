@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.CORE
+#
+# Copyright 2018 by it's authors.
+# Some rights reserved. See LICENSE.rst, CONTRIBUTORS.rst.
+
+"""Timings of the report runs.
+
+Each run started by SubmitForm keeps a RunStats in the request, with the
+time spent in each stage, the number of rows of the report and how much the
+peak memory of the process grew during the run. The peak memory only grows
+if the run needs more than any earlier run of the process, and runs of other
+threads count too, so it flags the runs that pushed it rather than
+measuring the memory of each one.
+
+Report modules time their catalog queries as the query stage and their
+loops over the results as the rows stage, nested in the report stage:
+
+    with stage(self.request, "query"):
+        brains = self.bika_analysis_catalog(self.contentFilter)
+    with stage(self.request, "rows"):
+        datalines = list(self.get_datalines(brains))
+
+A stage entered several times in a run (e.g. once per day not cached) adds
+up the time of each block. stream_csv times the rows of the CSV output.
+
+When the run finishes, the stats are logged as a single json line, sent in
+the Server-Timing header of the response, stored in the annotations of the
+Report object and added to the history of durations of the report, that is
+ranked by the reports_stats view.
+"""
+
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+from contextlib import contextmanager
+
+from bika.lims import logger
+from bika.lims.browser.reports.config import REPORT_STATS_HISTORY
+from bika.lims.browser.reports.config import get_setting
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+try:
+    import resource
+except ImportError:
+    # Not available on this platform, peak memory is not reported
+    resource = None
+
+
+def get_peak_memory():
+    """Returns the peak memory of the process (kilobytes on Linux, bytes on
+    Mac OS), or None if it is not available
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Key of the stats in the annotations of the Report objects
+STATS_ANNOTATION_KEY = "bika.lims.reports.stats"
+
+# Key of the stats of the current run in the request
+STATS_REQUEST_KEY = "report_stats"
+
+
+class RunStats(object):
+    """Timings of a report run
+    """
+
+    def __init__(self, report_id):
+        self.report_id = report_id
+        self.started = time.time()
+        self.finished = None
+        self.stages = OrderedDict()
+        self.rows = None
+        self.cached = False
+        self.cancelled = None
+        self.start_peak_memory = get_peak_memory()
+        self.peak_memory_growth = None
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time spent in the block to the stage passed in
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def count(self, name, num=1):
+        """Adds num to the counter passed in (e.g. objects woken up)
+        """
+        self.counters[name] = self.counters.get(name, 0) + num
+
+    @property
+    def duration(self):
+        end = self.finished or time.time()
+        return end - self.started
+
+    def finish(self):
+        self.finished = time.time()
+        if self.start_peak_memory is not None:
+            self.peak_memory_growth = \
+                get_peak_memory() - self.start_peak_memory
+
+    def to_dict(self):
+        return {"report_id": self.report_id,
+                "duration": round(self.duration, 4),
+                "stages": OrderedDict((name, round(seconds, 4)) for
+                                      name, seconds in self.stages.items()),
+                "rows": self.rows,
+                "counters": self.counters,
+                "cached": self.cached,
+                "cancelled": self.cancelled,
+                "peak_memory_growth": self.peak_memory_growth}
+
+    def server_timing(self):
+        """Returns the value of the Server-Timing header
+        """
+        metrics = ["{};dur={:.1f}".format(name, seconds * 1000)
+                   for name, seconds in self.stages.items()]
+        metrics.append("total;dur={:.1f}".format(self.duration * 1000))
+        return ", ".join(metrics)
+
+
+class NullStats(RunStats):
+    """Stats of requests that are not report runs. Discards the timings
+    """
+
+    def __init__(self):
+        RunStats.__init__(self, None)
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, num=1):
+        pass
+
+
+def start_stats(request, report_id):
+    """Creates the RunStats of the report run of the request passed in
+    """
+    stats = RunStats(report_id)
+    request[STATS_REQUEST_KEY] = stats
+    return stats
+
+
+def get_stats(request):
+    """Returns the RunStats of the report run of the request passed in
+    """
+    stats = request.get(STATS_REQUEST_KEY, None)
+    if not isinstance(stats, RunStats):
+        return NullStats()
+    return stats
+
+
+def stage(request, name):
+    """Times the block as the stage passed in of the current report run
+    """
+    return get_stats(request).stage(name)
+
+
+def count_rows(report):
+    """Returns the number of rows of the report passed in, or None
+    """
+    streamed = getattr(report, "rows_streamed", None)
+    if isinstance(streamed, int):
+        # CSV output written to the response as it was generated
+        return streamed
+    content = getattr(report, "report_content", None)
+    if isinstance(content, dict) and "datalines" in content:
+        return len(content["datalines"])
+    datalines = getattr(report, "datalines", None)
+    if isinstance(datalines, (list, tuple, dict)):
+        return len(datalines)
+    return None
+
+
+def store_stats(report, stats):
+    """Stores the stats in the annotations of the Report object
+    """
+    annotations = IAnnotations(report)
+    annotations[STATS_ANNOTATION_KEY] = PersistentMapping(stats.to_dict())
+
+
+def get_stored_stats(report):
+    """Returns the stats stored in the Report object passed in, or None
+    """
+    stats = IAnnotations(report).get(STATS_ANNOTATION_KEY, None)
+    return stats and dict(stats) or None
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the sorted values passed in
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class RunHistory(object):
+    """Durations of the latest runs of each report in this Zope instance
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    @property
+    def max_runs(self):
+        return get_setting(REPORT_STATS_HISTORY, 200, int)
+
+    def add(self, stats):
+        """Adds the stats of a finished run. Runs served from the cache do
+        not count, they would hide the duration of the actual runs, and
+        neither do aborted runs
+        """
+        if stats.cached or stats.cancelled or stats.report_id is None:
+            return
+        with self.lock:
+            runs = self.runs.get(stats.report_id, None)
+            if runs is None or runs.maxlen != self.max_runs:
+                runs = deque(runs or [], maxlen=self.max_runs)
+                self.runs[stats.report_id] = runs
+            runs.append(stats.to_dict())
+
+    def ranking(self):
+        """Returns a list of dicts with the run count and p50, p95 and max
+        duration of each report, slowest p95 first
+        """
+        with self.lock:
+            items = [(report_id, list(runs)) for report_id, runs in
+                     self.runs.items()]
+
+        ranking = []
+        for report_id, runs in items:
+            durations = sorted([run["duration"] for run in runs])
+            stages = OrderedDict()
+            for run in runs:
+                for name, seconds in run["stages"].items():
+                    stages.setdefault(name, []).append(seconds)
+            ranking.append({
+                "report_id": report_id,
+                "runs": len(durations),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": durations[-1],
+                "stages": OrderedDict(
+                    (name, percentile(sorted(values), 50)) for
+                    name, values in stages.items()),
+            })
+        return sorted(ranking, key=lambda item: item["p95"], reverse=True)
+
+
+# The history of report runs of this Zope instance
+history = RunHistory()
+
+
+def get_history():
+    """Returns the run history of this Zope instance
+    """
+    return history
+
+
+def finish_stats(stats):
+    """Finishes the run, logs its stats and adds them to the history
+    """
+    stats.finish()
+    logger.info("Report run stats: {}".format(json.dumps(stats.to_dict())))
+    get_history().add(stats)